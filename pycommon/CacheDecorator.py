@@ -24,20 +24,535 @@
 #	File UUID 0a5de76f-52f7-4fe0-b0b7-41c4dbdf6983
 
 import time
+import collections
+import functools
+import threading
+import weakref
+import os
+import pickle
+import hashlib
+import sqlite3
+import tempfile
+import contextlib
+import asyncio
+import inspect
 
-def cacheresult(timeout = None):
-	def decorator(decoree):
-		cache = { }	
-		def decorated_function(*args, **kwargs):
-			refresh = True
-			if args in cache:
-				(lasttime, result) = cache[args]
-				refresh = (time.time() - lasttime) > timeout
-
-			if refresh:
-				result = decoree(*args, **kwargs)
-				cache[args] = (time.time(), result)				
+CacheInfo = collections.namedtuple("CacheInfo", [ "hits", "misses", "maxsize", "currsize" ])
+
+class _KWARGS_MARK():
+	"""Separates positional from keyword arguments in cache keys. A class is
+	used (instead of a plain object instance) because it pickles by name,
+	which keeps persistent cache keys stable across processes."""
+
+def _make_key(args, kwargs):
+	"""Creates a hashable cache key from positional and keyword arguments.
+	Keyword arguments are sorted so that their order does not matter."""
+	if len(kwargs) == 0:
+		return args
+	return args + (_KWARGS_MARK, ) + tuple(sorted(kwargs.items()))
+
+class _InFlightComputation():
+	"""A result which is currently being computed by one thread and which other
+	threads can wait for."""
+	def __init__(self):
+		self._thread_id = threading.get_ident()
+		self._event = threading.Event()
+		self._result = None
+		self._exception = None
+
+	def set_result(self, result):
+		self._result = result
+		self._event.set()
+
+	def set_exception(self, exception):
+		self._exception = exception
+		self._event.set()
+
+	def wait(self):
+		if threading.get_ident() == self._thread_id:
+			# Waiting for our own computation would never return
+			raise Exception("Recursive call of a cached function with the same arguments.")
+		self._event.wait()
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+class MemoryCacheBackend():
+	"""Keeps cached results in memory in LRU order. If 'maxsize' is given, the
+	least recently used results of a namespace are evicted when that size is
+	exceeded."""
+	persistent = False
+
+	def __init__(self, maxsize = None):
+		assert((maxsize is None) or (maxsize >= 0))
+		self._maxsize = maxsize
+		self._namespaces = { }
+		self._lock = threading.Lock()
+
+	@property
+	def maxsize(self):
+		return self._maxsize
+
+	def _entries(self, namespace):
+		entries = self._namespaces.get(namespace)
+		if entries is None:
+			entries = collections.OrderedDict()
+			self._namespaces[namespace] = entries
+		return entries
+
+	def get(self, namespace, key):
+		with self._lock:
+			entries = self._entries(namespace)
+			entry = entries.get(key)
+			if entry is not None:
+				entries.move_to_end(key)
+			return entry
+
+	def put(self, namespace, key, timestamp, result):
+		if self._maxsize == 0:
+			return
+		with self._lock:
+			entries = self._entries(namespace)
+			entries[key] = (timestamp, result)
+			entries.move_to_end(key)
+			if self._maxsize is not None:
+				while len(entries) > self._maxsize:
+					entries.popitem(last = False)
+
+	def delete(self, namespace, key):
+		with self._lock:
+			self._entries(namespace).pop(key, None)
+
+	def purge(self, namespace, expired_before):
+		with self._lock:
+			entries = self._entries(namespace)
+			expired_keys = [ key for (key, (timestamp, result)) in entries.items() if timestamp < expired_before ]
+			for key in expired_keys:
+				del entries[key]
+
+	def clear(self, namespace):
+		with self._lock:
+			self._namespaces.pop(namespace, None)
+
+	def close(self):
+		pass
+
+	def count(self, namespace):
+		with self._lock:
+			return len(self._entries(namespace))
+
+class SQLiteCacheBackend():
+	"""Keeps pickled results in a SQLite database which may be shared among
+	processes. Every thread and process uses its own connection; close()
+	closes all of them. A table from an older version without the namespace
+	column is dropped, since it only holds cached results."""
+	persistent = True
+	maxsize = None
+
+	def __init__(self, filename, timeout_secs = 30):
+		self._filename = filename
+		self._timeout_secs = timeout_secs
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._connections = [ ]
+		with self._cursor() as cursor:
+			columns = [ row[1] for row in cursor.execute("PRAGMA table_info(cached_results);").fetchall() ]
+			if (len(columns) > 0) and ("namespace" not in columns):
+				cursor.execute("DROP TABLE cached_results;")
+			cursor.execute("CREATE TABLE IF NOT EXISTS cached_results (key varchar PRIMARY KEY, namespace varchar NOT NULL, stored_timestamp float NOT NULL, result blob NOT NULL);")
+			cursor.execute("CREATE INDEX IF NOT EXISTS cached_results_namespace ON cached_results (namespace, stored_timestamp);")
+
+	def _connection(self):
+		if getattr(self._local, "pid", None) != os.getpid():
+			self._local.pid = os.getpid()
+			# Each connection is only ever used by the thread that created it,
+			# but close() may be called from any thread
+			self._local.db = sqlite3.connect(self._filename, timeout = self._timeout_secs, check_same_thread = False)
+			with contextlib.suppress(sqlite3.OperationalError):
+				self._local.db.execute("PRAGMA journal_mode = WAL;")
+			with self._lock:
+				self._connections.append((os.getpid(), self._local.db))
+		return self._local.db
+
+	def close(self):
+		"""Closes the connections of all threads of this process. The backend
+		must not be used by any thread while and after it is closed."""
+		with self._lock:
+			(connections, self._connections) = (self._connections, [ ])
+		for (pid, db) in connections:
+			if pid == os.getpid():
+				db.close()
+
+	@contextlib.contextmanager
+	def _cursor(self):
+		db = self._connection()
+		with db:
+			yield db.cursor()
+
+	def get(self, namespace, key):
+		with self._cursor() as cursor:
+			row = cursor.execute("SELECT stored_timestamp, result FROM cached_results WHERE key = ? AND namespace = ?;", (key, namespace)).fetchone()
+		if row is None:
+			return None
+		(timestamp, pickled_result) = row
+		return (timestamp, pickle.loads(pickled_result))
+
+	def put(self, namespace, key, timestamp, result):
+		with self._cursor() as cursor:
+			cursor.execute("INSERT OR REPLACE INTO cached_results (key, namespace, stored_timestamp, result) VALUES (?, ?, ?, ?);", (key, namespace, timestamp, pickle.dumps(result)))
+
+	def delete(self, namespace, key):
+		with self._cursor() as cursor:
+			cursor.execute("DELETE FROM cached_results WHERE key = ? AND namespace = ?;", (key, namespace))
+
+	def purge(self, namespace, expired_before):
+		with self._cursor() as cursor:
+			cursor.execute("DELETE FROM cached_results WHERE namespace = ? AND stored_timestamp < ?;", (namespace, expired_before))
+
+	def clear(self, namespace):
+		with self._cursor() as cursor:
+			cursor.execute("DELETE FROM cached_results WHERE namespace = ?;", (namespace, ))
+
+	def count(self, namespace):
+		with self._cursor() as cursor:
+			(count, ) = cursor.execute("SELECT COUNT(*) FROM cached_results WHERE namespace = ?;", (namespace, )).fetchone()
+		return count
+
+class PickleDirectoryCacheBackend():
+	"""Keeps every result as a pickle file in a directory which may be shared
+	among processes. Every namespace gets its own subdirectory, named after a
+	hash of the namespace. Files are replaced atomically, so readers never see
+	partially written results."""
+	persistent = True
+	maxsize = None
+	_SUFFIX = ".pickle"
+
+	def __init__(self, dirname):
+		self._dirname = dirname
+		os.makedirs(self._dirname, exist_ok = True)
+
+	def _namespace_dirname(self, namespace):
+		return os.path.join(self._dirname, hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:32])
+
+	def _filename(self, namespace, key):
+		return os.path.join(self._namespace_dirname(namespace), key + self._SUFFIX)
+
+	def _load(self, filename):
+		try:
+			with open(filename, "rb") as f:
+				return pickle.load(f)
+		except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def _cachefiles(self, namespace):
+		dirname = self._namespace_dirname(namespace)
+		try:
+			filenames = os.listdir(dirname)
+		except FileNotFoundError:
+			return [ ]
+		return [ os.path.join(dirname, filename) for filename in filenames if filename.endswith(self._SUFFIX) ]
+
+	def get(self, namespace, key):
+		return self._load(self._filename(namespace, key))
+
+	def put(self, namespace, key, timestamp, result):
+		dirname = self._namespace_dirname(namespace)
+		os.makedirs(dirname, exist_ok = True)
+		(fd, tmpname) = tempfile.mkstemp(dir = dirname, suffix = ".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump((timestamp, result), f)
+			os.replace(tmpname, self._filename(namespace, key))
+		except BaseException:
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(tmpname)
+			raise
+
+	def delete(self, namespace, key):
+		with contextlib.suppress(FileNotFoundError):
+			os.unlink(self._filename(namespace, key))
+
+	def purge(self, namespace, expired_before):
+		for filename in self._cachefiles(namespace):
+			entry = self._load(filename)
+			if (entry is None) or (entry[0] < expired_before):
+				with contextlib.suppress(FileNotFoundError):
+					os.unlink(filename)
+
+	def clear(self, namespace):
+		for filename in self._cachefiles(namespace):
+			with contextlib.suppress(FileNotFoundError):
+				os.unlink(filename)
+
+	def close(self):
+		pass
+
+	def count(self, namespace):
+		return len(self._cachefiles(namespace))
+
+class _ResultCache():
+	"""Cache of function results which optionally expire after 'timeout'
+	seconds, stored in a backend (in memory by default). Expired entries are
+	dropped when they are looked up and, lazily, by a sweep over the whole
+	cache which runs after as many stores as there were entries left after the
+	previous sweep. All methods are thread-safe; get_or_compute() makes sure
+	that concurrent callers missing the same key wait for a single
+	computation. The lock only guards the counters and the in-flight
+	computations, backends synchronize themselves. Backends keep the entries
+	of every namespace apart, so that clearing, purging and counting only
+	affect this cache. Persistent backends get keys which are a stable hash
+	of the namespace and the pickled key, so they can be shared between
+	processes."""
+	_MIN_PURGE_INTERVAL = 128
+
+	def __init__(self, timeout = None, backend = None, namespace = None):
+		if backend is None:
+			backend = MemoryCacheBackend()
+		assert((not backend.persistent) or (namespace is not None))
+		self._timeout = timeout
+		self._backend = backend
+		self._namespace = namespace
+		self._hits = 0
+		self._misses = 0
+		self._stores_since_purge = 0
+		self._purge_interval = self._MIN_PURGE_INTERVAL
+		self._lock = threading.Lock()
+		self._inflight = { }
+		self._inflight_tasks = { }
+
+	def _backend_key(self, key):
+		if not self._backend.persistent:
+			return key
+		return hashlib.sha256(pickle.dumps((self._namespace, key), protocol = 4)).hexdigest()
+
+	def _expired(self, timestamp, now):
+		return (self._timeout is not None) and ((now - timestamp) > self._timeout)
+
+	def _lookup(self, key):
+		"""Returns a tuple (hit, result). Backend I/O is never done with the
+		lock held, so that threads working on unrelated keys do not queue up
+		behind each other."""
+		entry = self._backend.get(self._namespace, key)
+		if entry is not None:
+			(timestamp, result) = entry
+			if not self._expired(timestamp, time.time()):
+				return (True, result)
+			self._backend.delete(self._namespace, key)
+		return (False, None)
+
+	def _count(self, hit):
+		with self._lock:
+			if hit:
+				self._hits += 1
+			else:
+				self._misses += 1
+
+	def _store(self, key, result):
+		now = time.time()
+		self._backend.put(self._namespace, key, now, result)
+		if self._timeout is not None:
+			with self._lock:
+				self._stores_since_purge += 1
+				purge = self._stores_since_purge >= self._purge_interval
+				if purge:
+					self._stores_since_purge = 0
+			if purge:
+				self._purge(now)
+
+	def _purge(self, now):
+		self._backend.purge(self._namespace, now - self._timeout)
+		purge_interval = max(self._MIN_PURGE_INTERVAL, self._backend.count(self._namespace))
+		with self._lock:
+			self._purge_interval = purge_interval
+
+	def purge(self):
+		"""Removes all expired entries from the cache."""
+		if self._timeout is None:
+			return
+		with self._lock:
+			self._stores_since_purge = 0
+		self._purge(time.time())
+
+	def get_or_compute(self, key, compute):
+		key = self._backend_key(key)
+		(hit, result) = self._lookup(key)
+		if hit:
+			self._count(True)
 			return result
+
+		with self._lock:
+			self._misses += 1
+			inflight = self._inflight.get(key)
+			if inflight is None:
+				inflight = _InFlightComputation()
+				self._inflight[key] = inflight
+				computing_thread = True
+			else:
+				computing_thread = False
+
+		if not computing_thread:
+			# Some other thread is already computing this result, wait for it
+			return inflight.wait()
+
+		try:
+			# Another thread may have stored the result after our lookup, but
+			# before we registered the computation
+			(hit, result) = self._lookup(key)
+			if not hit:
+				result = compute()
+				self._store(key, result)
+		except BaseException as e:
+			with self._lock:
+				del self._inflight[key]
+			inflight.set_exception(e)
+			raise
+		with self._lock:
+			del self._inflight[key]
+		inflight.set_result(result)
+		return result
+
+	async def _compute_and_store(self, key, compute, task_key):
+		try:
+			result = await compute()
+			self._store(key, result)
+			return result
+		finally:
+			with self._lock:
+				del self._inflight_tasks[task_key]
+
+	async def get_or_compute_async(self, key, compute):
+		"""Like get_or_compute(), but compute() returns an awaitable. All
+		coroutines of an event loop that miss the same key share a single task
+		computing the result."""
+		key = self._backend_key(key)
+		loop = asyncio.get_running_loop()
+		task_key = (id(loop), key)
+		(hit, result) = self._lookup(key)
+		self._count(hit)
+		if hit:
+			return result
+		with self._lock:
+			task = self._inflight_tasks.get(task_key)
+			if task is None:
+				task = loop.create_task(self._compute_and_store(key, compute, task_key))
+				self._inflight_tasks[task_key] = task
+		if task is asyncio.current_task():
+			# The task would wait for itself forever
+			raise Exception("Recursive call of a cached function with the same arguments.")
+		# Shield the shared task so that a cancelled waiter does not cancel the
+		# computation for all others
+		return await asyncio.shield(task)
+
+	def clear(self):
+		self._backend.clear(self._namespace)
+		with self._lock:
+			self._hits = 0
+			self._misses = 0
+			self._stores_since_purge = 0
+
+	def info(self):
+		currsize = self._backend.count(self._namespace)
+		with self._lock:
+			return CacheInfo(hits = self._hits, misses = self._misses, maxsize = self._backend.maxsize, currsize = currsize)
+
+class _PerInstanceCaches():
+	"""Holds one _ResultCache per instance of a class without keeping the
+	instances alive. Caches are keyed by the identity of the instance (and not
+	by its __hash__/__eq__, so that equal instances never share results) and
+	dropped by a weakref.finalize() when the instance is collected. Instances
+	which cannot be weakly referenced get the cache stored as an attribute of
+	the instance instead."""
+	def __init__(self, decoree, timeout, maxsize):
+		self._timeout = timeout
+		self._maxsize = maxsize
+		self._attrname = "_cacheresult_" + decoree.__qualname__
+		self._caches = { }
+		self._lock = threading.Lock()
+
+	def _newcache(self):
+		return _ResultCache(timeout = self._timeout, backend = MemoryCacheBackend(maxsize = self._maxsize))
+
+	def get(self, instance):
+		with self._lock:
+			cache = self._caches.get(id(instance))
+			if cache is not None:
+				return cache
+			try:
+				# The finalizer runs when the instance is deallocated, i.e.,
+				# before its id() can be reused. It may run while the lock is
+				# held by this very thread (during garbage collection), so it
+				# must not take the lock; dict.pop() is atomic.
+				weakref.finalize(instance, self._caches.pop, id(instance), None)
+			except TypeError:
+				instancedict = getattr(instance, "__dict__", None)
+				if instancedict is None:
+					raise TypeError("Cannot cache results per instance of %s: it neither supports weak references nor has a __dict__." % (type(instance).__name__))
+				cache = instancedict.get(self._attrname)
+				if cache is None:
+					cache = self._newcache()
+					instancedict[self._attrname] = cache
+				return cache
+			cache = self._newcache()
+			self._caches[id(instance)] = cache
+			return cache
+
+def cacheresult(timeout = None, maxsize = None, method = False, backend = None):
+	"""Caches the results of the decorated function for 'timeout' seconds (or
+	forever if timeout is None). If 'maxsize' is given, at most that many
+	results are kept and the least recently used one is evicted first. The
+	decorated function offers cache_info() and cache_clear() like
+	functools.lru_cache does. Results are keyed by both positional and keyword
+	arguments. The decorated function is thread-safe and when multiple threads
+	request a result which is not cached, only one of them computes it while
+	the others wait.
+
+	When decorating a method, 'method' should be set to True. Then each
+	instance gets a cache of its own which is not keyed on 'self' and which is
+	freed together with the instance. In that case, cache_info() and
+	cache_clear() take the instance as argument.
+
+	By default, results are kept in memory. A different 'backend' (e.g., a
+	SQLiteCacheBackend or PickleDirectoryCacheBackend) can be given to share
+	results between processes and across restarts. Arguments and results then
+	need to be picklable and results are keyed by a hash of the function's
+	qualified name and the pickled arguments. Several functions may share one
+	backend; clearing, purging and cache_info() only concern the function's
+	own results.
+
+	Coroutine functions are supported as well: their awaited result is cached
+	and concurrent callers share a single task computing it."""
+	assert((backend is None) or (maxsize is None))
+	assert((backend is None) or (not method))
+	def decorator(decoree):
+		if method:
+			caches = _PerInstanceCaches(decoree, timeout = timeout, maxsize = maxsize)
+			def lookup(args, kwargs):
+				return (caches.get(args[0]), _make_key(args[1:], kwargs))
+		else:
+			if backend is None:
+				cache = _ResultCache(timeout = timeout, backend = MemoryCacheBackend(maxsize = maxsize))
+			else:
+				cache = _ResultCache(timeout = timeout, backend = backend, namespace = decoree.__module__ + "." + decoree.__qualname__)
+			def lookup(args, kwargs):
+				return (cache, _make_key(args, kwargs))
+
+		if inspect.iscoroutinefunction(decoree):
+			@functools.wraps(decoree)
+			async def decorated_function(*args, **kwargs):
+				(cache, key) = lookup(args, kwargs)
+				return await cache.get_or_compute_async(key, lambda: decoree(*args, **kwargs))
+		else:
+			@functools.wraps(decoree)
+			def decorated_function(*args, **kwargs):
+				(cache, key) = lookup(args, kwargs)
+				return cache.get_or_compute(key, lambda: decoree(*args, **kwargs))
+
+		if method:
+			decorated_function.cache_info = lambda instance: caches.get(instance).info()
+			decorated_function.cache_clear = lambda instance: caches.get(instance).clear()
+		else:
+			decorated_function.cache_info = cache.info
+			decorated_function.cache_clear = cache.clear
 		return decorated_function
 
 	return decorator
@@ -55,7 +570,7 @@ if __name__ == "__main__":
 		def __init__(self):
 			self._x = 0
 
-		@cacheresult(timeout = 2)
+		@cacheresult(timeout = 2, method = True)
 		def foo(self):
 			self._x += 1
 			return self._x
@@ -31,20 +31,107 @@ import contextlib
 import urllib.parse
 import hashlib
 import json
+import sys
+import enum
+import lzma
+import base64
+
+class CacheMissException(Exception): pass
+
+class CachedRequestsMode(enum.Enum):
+	Normal = "normal"
+	Record = "record"
+	Replay = "replay"
+
+class _LatencyHistogram():
+	"""Histogram of durations with logarithmic bins, where bin n holds all
+	durations below 2^n microseconds."""
+	def __init__(self):
+		self._bins = collections.Counter()
+		self._count = 0
+		self._total_secs = 0
+		self._max_secs = 0
+
+	def add(self, duration_secs):
+		usecs = round(duration_secs * 1e6)
+		self._bins[usecs.bit_length()] += 1
+		self._count += 1
+		self._total_secs += duration_secs
+		self._max_secs = max(self._max_secs, duration_secs)
+
+	def to_dict(self):
+		return {
+			"count":		self._count,
+			"total_secs":	self._total_secs,
+			"avg_secs":		(self._total_secs / self._count) if (self._count > 0) else None,
+			"max_secs":		self._max_secs,
+			"bins":			[ ((1 << binno) / 1e6, self._bins[binno]) for binno in sorted(self._bins) ],
+		}
+
+class CachedRequestsStatistics():
+	_COUNTERS = ( "hits", "misses", "stale", "refreshed", "uncached", "bytes_from_cache", "bytes_from_network" )
+	_HISTOGRAMS = ( "lookup", "store", "fetch" )
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self._start_time = time.time()
+		for counter in self._COUNTERS:
+			setattr(self, counter, 0)
+		self._histograms = { name: _LatencyHistogram() for name in self._HISTOGRAMS }
+
+	def record_latency(self, histogram_name, duration_secs):
+		self._histograms[histogram_name].add(duration_secs)
+
+	@property
+	def hit_ratio(self):
+		lookups = self.hits + self.misses + self.stale
+		if lookups == 0:
+			return None
+		return self.hits / lookups
+
+	def to_dict(self):
+		result = { counter: getattr(self, counter) for counter in self._COUNTERS }
+		result["hit_ratio"] = self.hit_ratio
+		result["duration_secs"] = time.time() - self._start_time
+		result["latency"] = { name: histogram.to_dict() for (name, histogram) in self._histograms.items() }
+		return result
+
+	def dump(self, f = None):
+		if f is None:
+			f = sys.stderr
+		stats = self.to_dict()
+		hit_ratio = "n/a" if (stats["hit_ratio"] is None) else ("%.1f%%" % (100 * stats["hit_ratio"]))
+		print("CachedRequests statistics over %.0f secs: %d hits, %d misses, %d stale, %d refreshed, %d uncached, hit ratio %s" % (stats["duration_secs"], self.hits, self.misses, self.stale, self.refreshed, self.uncached, hit_ratio), file = f)
+		print("    %d bytes served from cache, %d bytes from network" % (self.bytes_from_cache, self.bytes_from_network), file = f)
+		for name in self._HISTOGRAMS:
+			latency = stats["latency"][name]
+			if latency["count"] == 0:
+				continue
+			print("    %-6s n = %-6d avg %.3f ms, max %.3f ms" % (name, latency["count"], 1000 * latency["avg_secs"], 1000 * latency["max_secs"]), file = f)
 
 class CachedRequests():
 	_GenericRequest = collections.namedtuple("GenericRequest", [ "verb", "url", "postdata", "headers", "return_json", "max_age_secs" ])
 	_Response = collections.namedtuple("Response", [ "status_code", "headers", "content", "cached", "age" ])
 
-	def __init__(self, cache_filename = ".requests_cache.sqlite3", cache_duration_secs = 3600, cache_post = False, fixed_headers = None, minimum_gracetime_secs = None, cache_failed_requests = True):
+	def __init__(self, cache_filename = ".requests_cache.sqlite3", cache_duration_secs = 3600, cache_post = False, fixed_headers = None, minimum_gracetime_secs = None, cache_failed_requests = True, stats_dump_interval_secs = None, stats_dump_file = None, mode = CachedRequestsMode.Normal, key_headers = None):
 		self._session = requests.Session()
 		self._db = sqlite3.connect(cache_filename)
 		self._cursor = self._db.cursor()
 		self._cache_duration_secs = cache_duration_secs
 		self._cache_post = cache_post
-		self._fixed_headers = fixed_headers
+		self._fixed_headers = { } if (fixed_headers is None) else dict(fixed_headers)
+		self._key_headers = None if (key_headers is None) else frozenset(header.lower() for header in key_headers)
+		self._fixed_headers_key = self._canonical_headers(self._fixed_headers)
 		self._minimum_gracetime_secs = minimum_gracetime_secs
 		self._cache_failed_requests = cache_failed_requests
+		self._stats = CachedRequestsStatistics()
+		self._stats_dump_interval_secs = stats_dump_interval_secs
+		self._stats_dump_file = stats_dump_file
+		self._stats_last_dump = time.time()
+		self._mode = CachedRequestsMode(mode)
+		self._recorded_keys = { }
 		with contextlib.suppress(sqlite3.OperationalError):
 			self._cursor.execute("""
 			CREATE TABLE cached_requests (
@@ -60,6 +147,11 @@ class CachedRequests():
 			);
 			""")
 
+		if self._mode == CachedRequestsMode.Replay:
+			# Never purge anything that we might need to replay later
+			self._db.commit()
+			return
+
 		expiration_time = time.time() - cache_duration_secs
 		(expired_cache_size, ) = self._cursor.execute("SELECT SUM(LENGTH(content)) FROM cached_requests WHERE stored_timestamp < ?;", (expiration_time, )).fetchone()
 		if (expired_cache_size is not None) and (expired_cache_size > 10 * 1024 * 1024):
@@ -67,18 +159,31 @@ class CachedRequests():
 			self._cursor.execute("DELETE FROM cached_requests WHERE stored_timestamp < ?;", (expiration_time, ))
 		self._db.commit()
 
-	@staticmethod
-	def _hash_request(request):
-		request_data = [ request.verb, request.url ]
-		if request.postdata is None:
-			request_data.append("")
+	def _canonical_headers(self, headers):
+		"""Returns the canonical byte representation of all headers that
+		participate in the request key (all of them unless key_headers was
+		specified)."""
+		if self._key_headers is None:
+			items = [ (key.lower(), value) for (key, value) in headers.items() ]
 		else:
-			request_data.append(request.postdata.hex())
-		if (request.headers is None) or (len(request.headers) == 0):
-			request_data.append("")
+			items = [ (key.lower(), value) for (key, value) in headers.items() if (key.lower() in self._key_headers) ]
+		items.sort()
+		return "".join("%s\0%s\0" % (key, value) for (key, value) in items).encode("utf-8")
+
+	def _hash_request(self, request):
+		hashvalue = hashlib.sha256((request.verb + "\0" + request.url + "\0").encode("utf-8"))
+		if request.postdata is not None:
+			postdata = request.postdata
+			if isinstance(postdata, str):
+				postdata = postdata.encode("utf-8")
+			hashvalue.update(len(postdata).to_bytes(8, byteorder = "little"))
+			hashvalue.update(postdata)
+		hashvalue.update(b"\0")
+		if request.headers is self._fixed_headers:
+			# Canonical representation of the fixed headers is precomputed
+			hashvalue.update(self._fixed_headers_key)
 		else:
-			request_data.append(json.dumps(request.headers, sort_keys = True))
-		hashvalue = hashlib.sha256(("\n".join(request_data)).encode("utf-8"))
+			hashvalue.update(self._canonical_headers(request.headers))
 		return hashvalue.hexdigest()
 
 	@staticmethod
@@ -95,25 +200,91 @@ class CachedRequests():
 			return base_url + "?" + urllib.parse.urlencode(query_params)
 
 	def _determine_headers(self, request_headers):
-		if self._fixed_headers is None:
-			headers = { }
-		else:
-			headers = dict(self._fixed_headers)
-		if request_headers is not None:
-			headers.update(request_headers)
+		if not request_headers:
+			# The fixed headers are never modified, they can be shared
+			return self._fixed_headers
+		headers = dict(self._fixed_headers)
+		headers.update(request_headers)
 		return headers
 
+	def close(self):
+		self._session.close()
+		self._db.close()
+
+	@property
+	def statistics(self):
+		return self._stats
+
+	@property
+	def mode(self):
+		return self._mode
+
+	_ARCHIVE_VERSION = 2
+
+	def write_archive(self, filename):
+		"""Writes all cache entries which were touched during this session in
+		record mode to a LZMA-compressed JSON archive. It can be imported into
+		any other cache using load_archive(). Returns the number of entries
+		written."""
+		entries = [ ]
+		for request_hash in self._recorded_keys:
+			row = self._cursor.execute("SELECT stored_timestamp, verb, uri, request_headers_json, response_headers_json, status_code, content FROM cached_requests WHERE request_key = ?;", (request_hash, )).fetchone()
+			if row is None:
+				continue
+			(stored_timestamp, verb, uri, request_headers_json, response_headers_json, status_code, content) = row
+			entries.append({
+				"request_key":		request_hash,
+				"stored_timestamp":	stored_timestamp,
+				"verb":				verb,
+				"uri":				uri,
+				"request_headers":	json.loads(request_headers_json),
+				"response_headers":	json.loads(response_headers_json),
+				"status_code":		status_code,
+				"content":			base64.b64encode(content).decode("ascii"),
+			})
+		archive = {
+			"version":	self._ARCHIVE_VERSION,
+			"entries":	entries,
+		}
+		with lzma.open(filename, "wt", encoding = "utf-8") as f:
+			json.dump(archive, f, separators = (",", ":"))
+		return len(entries)
+
+	def load_archive(self, filename):
+		"""Imports all entries of an archive written by write_archive() into
+		the cache, replacing any existing entries with the same request key.
+		Returns the number of entries imported."""
+		with lzma.open(filename, "rt", encoding = "utf-8") as f:
+			archive = json.load(f)
+		if archive.get("version") != self._ARCHIVE_VERSION:
+			raise Exception("Unsupported CachedRequests archive version: %s" % (str(archive.get("version"))))
+		for entry in archive["entries"]:
+			self._cursor.execute("DELETE FROM cached_requests WHERE request_key = ?;", (entry["request_key"], ))
+			self._cursor.execute("INSERT INTO cached_requests (request_key, stored_timestamp, verb, uri, request_headers_json, response_headers_json, status_code, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+				(entry["request_key"], entry["stored_timestamp"], entry["verb"], entry["uri"], json.dumps(entry["request_headers"]), json.dumps(entry["response_headers"]), entry["status_code"], base64.b64decode(entry["content"])))
+		self._db.commit()
+		return len(archive["entries"])
+
 	def _cache_lookup(self, max_age_secs, request_hash):
+		"""Returns a tuple (response, stale). The response is None if no
+		sufficiently recent entry is present in the cache; stale is True if an
+		entry exists, but is older than max_age_secs."""
+		t0 = time.perf_counter()
 		now = time.time()
-		max_age = now - max_age_secs
-		result = self._cursor.execute("SELECT stored_timestamp, response_headers_json, status_code, content FROM cached_requests WHERE (stored_timestamp > ?) AND (request_key = ?);", (max_age, request_hash)).fetchone()
+		result = self._cursor.execute("SELECT stored_timestamp, response_headers_json, status_code, content FROM cached_requests WHERE request_key = ?;", (request_hash, )).fetchone()
 		if result is None:
-			return None
+			(response, stale) = (None, False)
+		elif result[0] <= now - max_age_secs:
+			(response, stale) = (None, True)
 		else:
 			(stored_timestamp, response_headers_json, status_code, content) = result
-			return self._Response(status_code = status_code, headers = json.loads(response_headers_json), content = content, cached = True, age = now - stored_timestamp)
+			stale = False
+			response = self._Response(status_code = status_code, headers = json.loads(response_headers_json), content = content, cached = True, age = now - stored_timestamp)
+		self._stats.record_latency("lookup", time.perf_counter() - t0)
+		return (response, stale)
 
 	def _cache_store(self, request, request_hash, response):
+		t0 = time.perf_counter()
 		try:
 			self._cursor.execute("INSERT INTO cached_requests (request_key, stored_timestamp, verb, uri, request_headers_json, response_headers_json, status_code, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
 				(request_hash, time.time(), request.verb, request.url, json.dumps(request.headers), json.dumps(response.headers), response.status_code, response.content))
@@ -121,26 +292,55 @@ class CachedRequests():
 			self._cursor.execute("UPDATE cached_requests SET stored_timestamp = ?, response_headers_json = ?, status_code = ?, content = ? WHERE request_key = ?;",
 				(time.time(), json.dumps(response.headers), response.status_code, response.content, request_hash))
 		self._db.commit()
+		self._stats.record_latency("store", time.perf_counter() - t0)
 
 	def _execute_uncached(self, request):
+		if self._mode == CachedRequestsMode.Replay:
+			raise CacheMissException("No cached response to replay for %s %s" % (request.verb, request.url))
 		if self._minimum_gracetime_secs is not None:
 			time.sleep(self._minimum_gracetime_secs)
+		t0 = time.perf_counter()
 		response = requests.request(method = request.verb, url = request.url, data = request.postdata, headers = request.headers)
+		self._stats.record_latency("fetch", time.perf_counter() - t0)
+		self._stats.bytes_from_network += len(response.content)
 		return self._Response(status_code = response.status_code, headers = dict(response.headers), content = response.content, cached = False, age = 0)
 
+	def _periodic_stats_dump(self):
+		if self._stats_dump_interval_secs is None:
+			return
+		now = time.time()
+		if now - self._stats_last_dump >= self._stats_dump_interval_secs:
+			self._stats_last_dump = now
+			self._stats.dump(self._stats_dump_file)
+
 	def _execute(self, request):
-		if (request.verb == "POST") and (not self._cache_post):
+		if self._mode == CachedRequestsMode.Replay:
+			# Entries never expire while replaying
+			request = request._replace(max_age_secs = float("inf"))
+		if (request.verb == "POST") and (not self._cache_post) and (self._mode == CachedRequestsMode.Normal):
 			# Never cache POST requests
+			self._stats.uncached += 1
 			response = self._execute_uncached(request)
 		else:
 			request_hash = self._hash_request(request)
-			cached_response = self._cache_lookup(max_age_secs = request.max_age_secs, request_hash = request_hash)
+			(cached_response, stale) = self._cache_lookup(max_age_secs = request.max_age_secs, request_hash = request_hash)
 			if cached_response is None:
+				if stale:
+					self._stats.stale += 1
+				else:
+					self._stats.misses += 1
 				response = self._execute_uncached(request)
-				if (self._cache_failed_requests) or (response.status_code == 200):
+				if (self._cache_failed_requests) or (response.status_code == 200) or (self._mode == CachedRequestsMode.Record):
 					self._cache_store(request, request_hash, response)
+					if stale:
+						self._stats.refreshed += 1
 			else:
+				self._stats.hits += 1
+				self._stats.bytes_from_cache += len(cached_response.content)
 				response = cached_response
+			if self._mode == CachedRequestsMode.Record:
+				self._recorded_keys[request_hash] = True
+		self._periodic_stats_dump()
 		if request.return_json:
 			response = json.loads(response.content)
 		return response
@@ -160,3 +360,4 @@ if __name__ == "__main__":
 	cr.get("https://google.de", query_params = { "foo": "bar", "a": "b" })
 	rsp = cr.get("https://beatsaver.com/api/maps/downloads", return_json = True)
 	print(rsp)
+	cr.statistics.dump()
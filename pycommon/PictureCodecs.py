@@ -0,0 +1,679 @@
+#!/usr/bin/python3
+#
+#	PictureCodecs - Streaming PNG, PAM and QOI encoders and decoders
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import zlib
+import struct
+import collections
+from .NamedStruct import NamedStruct
+from .PnmPicture import PnmPicture, PnmStreamWriter
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# A band of rows: the picture itself (one or three channels) and an optional
+# single channel alpha picture of the same size and maxval
+PictureBand = collections.namedtuple("PictureBand", [ "picture", "alpha" ])
+
+def _interleave(data, alpha, channels, samplesize):
+	"""Appends the alpha sample to every pixel."""
+	(pixelsize, samplecnt) = (channels * samplesize, len(alpha) // samplesize)
+	result = bytearray(samplecnt * (pixelsize + samplesize))
+	for offset in range(pixelsize):
+		result[offset :: pixelsize + samplesize] = data[offset :: pixelsize]
+	for offset in range(samplesize):
+		result[pixelsize + offset :: pixelsize + samplesize] = alpha[offset :: samplesize]
+	return result
+
+def _deinterleave(data, channels, samplesize):
+	"""Splits pixels with a trailing alpha sample into (data, alpha)."""
+	(pixelsize, samplecnt) = (channels * samplesize, len(data) // ((channels + 1) * samplesize))
+	(result, alpha) = (bytearray(samplecnt * pixelsize), bytearray(samplecnt * samplesize))
+	for offset in range(pixelsize):
+		result[offset :: pixelsize] = data[offset :: pixelsize + samplesize]
+	for offset in range(samplesize):
+		alpha[offset :: samplesize] = data[pixelsize + offset :: pixelsize + samplesize]
+	return (result, alpha)
+
+class _BandWriter():
+	"""Base for all writers, which receive the picture band by band."""
+	def __init__(self, filename, width, height, channels, maxval, alpha):
+		assert(channels in [ 1, 3 ])
+		(self._width, self._height, self._channels, self._maxval, self._alpha) = (width, height, channels, maxval, alpha)
+		self._samplesize = 1 if (maxval < 256) else 2
+		self._rows = 0
+		self._f = open(filename, "wb")
+
+	def _rowdata(self, band, alphaband):
+		"""Returns the raw (alpha interleaved) data of the band."""
+		assert((band.width, band.channels, band.maxval) == (self._width, self._channels, self._maxval))
+		assert(self._rows + band.height <= self._height)
+		assert((alphaband is not None) == self._alpha)
+		self._rows += band.height
+		if alphaband is None:
+			return band.data
+		assert((alphaband.width, alphaband.height, alphaband.channels, alphaband.maxval) == (band.width, band.height, 1, band.maxval))
+		return _interleave(band.data, alphaband.data, self._channels, self._samplesize)
+
+	def write(self, band, alphaband = None):
+		raise NotImplementedError(self.__class__.__name__)
+
+	def _finish(self):
+		pass
+
+	def close(self):
+		try:
+			if self._rows != self._height:
+				raise Exception("Incomplete picture written: %d of %d rows." % (self._rows, self._height))
+			self._finish()
+		finally:
+			self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.close()
+		else:
+			self._f.close()
+
+class _BandReader():
+	"""Base for all readers, which return the picture band by band."""
+	def __init__(self, filename):
+		self._f = open(filename, "rb")
+		self._nextrow = 0
+
+	@property
+	def width(self):
+		return self._width
+
+	@property
+	def height(self):
+		return self._height
+
+	@property
+	def channels(self):
+		return self._channels
+
+	@property
+	def maxval(self):
+		return self._maxval
+
+	@property
+	def alpha(self):
+		return self._alpha
+
+	def _readrowdata(self, count):
+		raise NotImplementedError(self.__class__.__name__)
+
+	def readrows(self, count):
+		"""Returns a PictureBand of the next 'count' rows (fewer at the end of
+		the picture) or None if all rows have been read."""
+		count = min(count, self._height - self._nextrow)
+		if count <= 0:
+			return None
+		data = self._readrowdata(count)
+		self._nextrow += count
+		samplesize = 1 if (self._maxval < 256) else 2
+		if self._alpha:
+			(data, alpha) = _deinterleave(data, self._channels, samplesize)
+			alpha = PnmPicture().fromdata(self._width, count, alpha, channels = 1, maxval = self._maxval)
+		else:
+			alpha = None
+		picture = PnmPicture().fromdata(self._width, count, data, channels = self._channels, maxval = self._maxval)
+		return PictureBand(picture = picture, alpha = alpha)
+
+	def bands(self, band_height):
+		while True:
+			band = self.readrows(band_height)
+			if band is None:
+				break
+			yield band
+
+	def readall(self):
+		return self.readrows(self._height - self._nextrow)
+
+	def close(self):
+		self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+class PamWriter(_BandWriter):
+	"""Writes a PAM (P7) file, which unlike PNM can carry an alpha channel."""
+	def __init__(self, filename, width, height, channels = 3, maxval = 255, alpha = False):
+		_BandWriter.__init__(self, filename, width, height, channels, maxval, alpha)
+		tupltype = ("GRAYSCALE" if (channels == 1) else "RGB") + ("_ALPHA" if alpha else "")
+		header = "P7\nWIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL %d\nTUPLTYPE %s\nENDHDR\n" % (width, height, channels + (1 if alpha else 0), maxval, tupltype)
+		self._f.write(header.encode("ascii"))
+
+	def write(self, band, alphaband = None):
+		self._f.write(self._rowdata(band, alphaband))
+		return self
+
+class PamReader(_BandReader):
+	def __init__(self, filename):
+		_BandReader.__init__(self, filename)
+		if self._f.readline().rstrip(b"\r\n") != b"P7":
+			raise Exception("Not a PAM file.")
+		header = { }
+		while True:
+			line = self._f.readline()
+			if len(line) == 0:
+				raise Exception("Truncated PAM header.")
+			line = line.strip().decode("ascii")
+			if line == "ENDHDR":
+				break
+			if (line == "") or line.startswith("#"):
+				continue
+			(key, value) = (line.split(maxsplit = 1) + [ "" ])[:2]
+			header[key] = value
+		(self._width, self._height, depth, self._maxval) = (int(header["WIDTH"]), int(header["HEIGHT"]), int(header["DEPTH"]), int(header["MAXVAL"]))
+		if depth not in [ 1, 2, 3, 4 ]:
+			raise Exception("Unsupported PAM depth %d." % (depth))
+		self._alpha = header.get("TUPLTYPE", "").endswith("_ALPHA") or (depth in [ 2, 4 ])
+		self._channels = depth - (1 if self._alpha else 0)
+		self._rowsize = self._width * depth * (1 if (self._maxval < 256) else 2)
+
+	def _readrowdata(self, count):
+		data = self._f.read(count * self._rowsize)
+		if len(data) != count * self._rowsize:
+			raise Exception("Truncated PAM file.")
+		return data
+
+class PngWriter(_BandWriter):
+	"""Writes a PNG file with 8 bit (maxval 255) or 16 bit (maxval 65535)
+	samples. The scanline filter is either fixed ("none", "sub", "up",
+	"average" or "paeth") or chosen per row by the minimum sum of absolute
+	differences heuristic ("auto"). Without NumPy, "auto" always uses the
+	"up" filter."""
+	_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+	_IHDR = NamedStruct((
+		("L", "width"),
+		("L", "height"),
+		("B", "bitdepth"),
+		("B", "colortype"),
+		("B", "compression"),
+		("B", "filter"),
+		("B", "interlace"),
+	), struct_extra = ">")
+	_FILTERS = [ "none", "sub", "up", "average", "paeth" ]
+	_IDAT_SIZE = 256 * 1024
+
+	def __init__(self, filename, width, height, channels = 3, maxval = 255, alpha = False, compresslevel = 6, filter = "auto"):
+		if maxval not in [ 255, 65535 ]:
+			raise Exception("PNG requires a maxval of 255 or 65535, not %d." % (maxval))
+		if (filter != "auto") and (filter not in self._FILTERS):
+			raise Exception("Unknown PNG filter '%s'." % (filter))
+		_BandWriter.__init__(self, filename, width, height, channels, maxval, alpha)
+		self._filter = filter
+		self._bpp = (channels + (1 if alpha else 0)) * self._samplesize
+		self._prior = bytes(width * self._bpp)
+		self._compressor = zlib.compressobj(compresslevel)
+		self._pending = bytearray()
+		colortype = { (1, False): 0, (3, False): 2, (1, True): 4, (3, True): 6 }[(channels, alpha)]
+		self._f.write(self._SIGNATURE)
+		self._writechunk(b"IHDR", self._IHDR.pack({ "width": width, "height": height, "bitdepth": 8 * self._samplesize, "colortype": colortype, "compression": 0, "filter": 0, "interlace": 0 }))
+
+	def _writechunk(self, chunktype, data):
+		self._f.write(struct.pack(">L", len(data)))
+		self._f.write(chunktype)
+		self._f.write(data)
+		self._f.write(struct.pack(">L", zlib.crc32(data, zlib.crc32(chunktype))))
+
+	@staticmethod
+	def _filterrow_python(ftype, row, prior, bpp):
+		if ftype == 0:
+			return row
+		elif ftype == 1:
+			return bytes((row[i] - (row[i - bpp] if (i >= bpp) else 0)) & 0xff for i in range(len(row)))
+		elif ftype == 2:
+			return bytes((value - above) & 0xff for (value, above) in zip(row, prior))
+		elif ftype == 3:
+			return bytes((row[i] - (((row[i - bpp] if (i >= bpp) else 0) + prior[i]) >> 1)) & 0xff for i in range(len(row)))
+		else:
+			return bytes((row[i] - PngReader._paeth(row[i - bpp] if (i >= bpp) else 0, prior[i], prior[i - bpp] if (i >= bpp) else 0)) & 0xff for i in range(len(row)))
+
+	def _filterrows_python(self, data):
+		ftype = 2 if (self._filter == "auto") else self._FILTERS.index(self._filter)
+		rowsize = len(self._prior)
+		filtered = bytearray()
+		for y in range(len(data) // rowsize):
+			row = data[y * rowsize : (y + 1) * rowsize]
+			filtered.append(ftype)
+			filtered += self._filterrow_python(ftype, row, self._prior, self._bpp)
+			self._prior = row
+		return filtered
+
+	def _filterrows_numpy(self, data):
+		rowsize = len(self._prior)
+		rows = numpy.frombuffer(data, dtype = numpy.uint8).reshape(-1, rowsize)
+		above = numpy.vstack((numpy.frombuffer(self._prior, dtype = numpy.uint8)[numpy.newaxis], rows[:-1]))
+		left = numpy.zeros_like(rows)
+		left[:, self._bpp:] = rows[:, :-self._bpp]
+		upperleft = numpy.zeros_like(rows)
+		upperleft[:, self._bpp:] = above[:, :-self._bpp]
+
+		candidates = [ ]
+		for (ftype, name) in enumerate(self._FILTERS):
+			if (self._filter != "auto") and (self._filter != name):
+				candidates.append(None)
+			elif ftype == 0:
+				candidates.append(rows)
+			elif ftype == 1:
+				candidates.append(rows - left)
+			elif ftype == 2:
+				candidates.append(rows - above)
+			elif ftype == 3:
+				candidates.append(rows - ((left.astype(numpy.uint16) + above) >> 1).astype(numpy.uint8))
+			else:
+				(a, b, c) = (left.astype(numpy.int16), above.astype(numpy.int16), upperleft.astype(numpy.int16))
+				estimate = a + b - c
+				(pa, pb, pc) = (numpy.abs(estimate - a), numpy.abs(estimate - b), numpy.abs(estimate - c))
+				predictor = numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c)).astype(numpy.uint8)
+				candidates.append(rows - predictor)
+
+		if self._filter == "auto":
+			costs = numpy.stack([ numpy.abs(candidate.view(numpy.int8).astype(numpy.int32)).sum(axis = 1) for candidate in candidates ])
+			choice = numpy.argmin(costs, axis = 0)
+		else:
+			choice = numpy.full(rows.shape[0], self._FILTERS.index(self._filter))
+
+		filtered = numpy.empty((rows.shape[0], rowsize + 1), dtype = numpy.uint8)
+		filtered[:, 0] = choice
+		for (ftype, candidate) in enumerate(candidates):
+			if candidate is not None:
+				selection = (choice == ftype)
+				filtered[selection, 1:] = candidate[selection]
+		self._prior = bytes(rows[-1])
+		return filtered.tobytes()
+
+	def write(self, band, alphaband = None):
+		data = self._rowdata(band, alphaband)
+		if len(data) == 0:
+			return self
+		if numpy is not None:
+			filtered = self._filterrows_numpy(data)
+		else:
+			filtered = self._filterrows_python(data)
+		self._pending += self._compressor.compress(filtered)
+		if len(self._pending) >= self._IDAT_SIZE:
+			self._writechunk(b"IDAT", self._pending)
+			self._pending = bytearray()
+		return self
+
+	def _finish(self):
+		self._pending += self._compressor.flush()
+		self._writechunk(b"IDAT", self._pending)
+		self._writechunk(b"IEND", b"")
+
+class PngReader(_BandReader):
+	"""Reads non-interlaced PNG files with 8 or 16 bit grayscale or RGB
+	samples, optionally with alpha, as well as 8 bit palette pictures. The
+	compressed data is read in pieces of at most _READ_SIZE bytes (even from
+	a single large IDAT chunk) and inflated incrementally, so only the
+	requested rows are held in memory."""
+	_READ_SIZE = 64 * 1024
+
+	def __init__(self, filename):
+		_BandReader.__init__(self, filename)
+		if self._f.read(len(PngWriter._SIGNATURE)) != PngWriter._SIGNATURE:
+			raise Exception("Not a PNG file.")
+		(chunktype, data) = self._readchunk()
+		if chunktype != b"IHDR":
+			raise Exception("PNG file does not start with IHDR chunk.")
+		ihdr = PngWriter._IHDR.unpack(data)
+		if ihdr.interlace != 0:
+			raise Exception("Interlaced PNG files are not supported.")
+		if (ihdr.bitdepth not in [ 8, 16 ]) or (ihdr.colortype not in [ 0, 2, 3, 4, 6 ]) or ((ihdr.colortype == 3) and (ihdr.bitdepth != 8)):
+			raise Exception("Unsupported PNG bit depth %d with color type %d." % (ihdr.bitdepth, ihdr.colortype))
+		(self._width, self._height) = (ihdr.width, ihdr.height)
+		self._colortype = ihdr.colortype
+		self._channels = 1 if (ihdr.colortype in [ 0, 4 ]) else 3
+		self._alpha = ihdr.colortype in [ 4, 6 ]
+		self._maxval = 255 if (ihdr.bitdepth == 8) else 65535
+		filechannels = 1 if (ihdr.colortype == 3) else (self._channels + (1 if self._alpha else 0))
+		self._bpp = filechannels * (ihdr.bitdepth // 8)
+		self._prior = bytes(self._width * self._bpp)
+		self._palette = None
+		self._decompressor = zlib.decompressobj()
+		self._inflated = bytearray()
+		self._idat_done = False
+		self._idat_remaining = 0
+		self._idat_crc = 0
+
+	def _readchunkheader(self):
+		header = self._f.read(8)
+		if len(header) != 8:
+			raise Exception("Truncated PNG file.")
+		return struct.unpack(">L4s", header)
+
+	def _checkcrc(self, chunktype, crc):
+		filecrc = self._f.read(4)
+		if (len(filecrc) != 4) or (struct.unpack(">L", filecrc)[0] != crc):
+			raise Exception("Corrupt PNG chunk %s." % (chunktype))
+
+	def _readchunkdata(self, length, chunktype):
+		data = self._f.read(length)
+		if len(data) != length:
+			raise Exception("Corrupt PNG chunk %s." % (chunktype))
+		self._checkcrc(chunktype, zlib.crc32(data, zlib.crc32(chunktype)))
+		return data
+
+	def _readchunk(self):
+		(length, chunktype) = self._readchunkheader()
+		return (chunktype, self._readchunkdata(length, chunktype))
+
+	def _inflateidatpiece(self):
+		"""Reads and inflates the next piece of the current IDAT chunk."""
+		data = self._f.read(min(self._READ_SIZE, self._idat_remaining))
+		if len(data) == 0:
+			raise Exception("Truncated PNG file.")
+		self._idat_remaining -= len(data)
+		self._idat_crc = zlib.crc32(data, self._idat_crc)
+		self._inflated += self._decompressor.decompress(data)
+		if self._idat_remaining == 0:
+			self._checkcrc(b"IDAT", self._idat_crc)
+
+	def _inflate(self, length):
+		"""Inflates IDAT data until at least 'length' bytes are available."""
+		while len(self._inflated) < length:
+			if self._idat_remaining > 0:
+				self._inflateidatpiece()
+				continue
+			if self._idat_done:
+				raise Exception("Truncated PNG image data.")
+			(chunklength, chunktype) = self._readchunkheader()
+			if chunktype == b"IDAT":
+				# Image data is read piecewise by the branch above
+				(self._idat_remaining, self._idat_crc) = (chunklength, zlib.crc32(chunktype))
+				if chunklength == 0:
+					self._checkcrc(chunktype, self._idat_crc)
+				continue
+			data = self._readchunkdata(chunklength, chunktype)
+			if chunktype == b"PLTE":
+				self._palette = data
+			elif chunktype == b"IEND":
+				self._idat_done = True
+				self._inflated += self._decompressor.flush()
+
+	@staticmethod
+	def _paeth(a, b, c):
+		estimate = a + b - c
+		(pa, pb, pc) = (abs(estimate - a), abs(estimate - b), abs(estimate - c))
+		if (pa <= pb) and (pa <= pc):
+			return a
+		elif pb <= pc:
+			return b
+		else:
+			return c
+
+	@classmethod
+	def _unfilterrow(cls, ftype, row, prior, bpp):
+		if ftype == 0:
+			return row
+		elif ftype == 1:
+			if numpy is not None:
+				return bytearray(numpy.cumsum(numpy.frombuffer(row, dtype = numpy.uint8).reshape(-1, bpp), axis = 0, dtype = numpy.uint8).tobytes())
+			for i in range(bpp, len(row)):
+				row[i] = (row[i] + row[i - bpp]) & 0xff
+		elif ftype == 2:
+			if numpy is not None:
+				return bytearray((numpy.frombuffer(row, dtype = numpy.uint8) + numpy.frombuffer(prior, dtype = numpy.uint8)).tobytes())
+			return bytearray((value + above) & 0xff for (value, above) in zip(row, prior))
+		elif ftype == 3:
+			for i in range(len(row)):
+				row[i] = (row[i] + (((row[i - bpp] if (i >= bpp) else 0) + prior[i]) >> 1)) & 0xff
+		elif ftype == 4:
+			for i in range(bpp):
+				row[i] = (row[i] + prior[i]) & 0xff
+			for i in range(bpp, len(row)):
+				# Inlined _paeth(), this is the hottest loop when decoding
+				(a, b, c) = (row[i - bpp], prior[i], prior[i - bpp])
+				(pa, pb, pc) = (abs(b - c), abs(a - c), abs(a + b - c - c))
+				row[i] = (row[i] + (a if ((pa <= pb) and (pa <= pc)) else b if (pb <= pc) else c)) & 0xff
+		else:
+			raise Exception("Invalid PNG filter type %d." % (ftype))
+		return row
+
+	def _readrowdata(self, count):
+		rowsize = len(self._prior)
+		self._inflate(count * (rowsize + 1))
+		if self._nextrow + count == self._height:
+			# Read the rest of the current chunk, so that its CRC is checked
+			while self._idat_remaining > 0:
+				self._inflateidatpiece()
+		data = bytearray()
+		for y in range(count):
+			row = self._inflated[y * (rowsize + 1) + 1 : (y + 1) * (rowsize + 1)]
+			row = self._unfilterrow(self._inflated[y * (rowsize + 1)], row, self._prior, self._bpp)
+			data += row
+			self._prior = row
+		del self._inflated[ : count * (rowsize + 1)]
+		if self._colortype == 3:
+			if self._palette is None:
+				raise Exception("PNG palette picture without PLTE chunk.")
+			palette = bytearray(self._palette) + bytearray(768 - len(self._palette))
+			rgbdata = bytearray(3 * len(data))
+			for channel in range(3):
+				rgbdata[channel :: 3] = data.translate(palette[channel :: 3])
+			data = rgbdata
+		return data
+
+class QoiWriter(_BandWriter):
+	"""Writes a QOI ("Quite OK Image") file. QOI only knows 8 bit RGB(A), so
+	grayscale pictures are stored as RGB."""
+	_END_MARKER = bytes(7) + b"\x01"
+
+	def __init__(self, filename, width, height, channels = 3, maxval = 255, alpha = False):
+		if maxval != 255:
+			raise Exception("QOI requires a maxval of 255, not %d." % (maxval))
+		_BandWriter.__init__(self, filename, width, height, channels, maxval, alpha)
+		self._f.write(b"qoif" + struct.pack(">LLBB", width, height, 4 if alpha else 3, 0))
+		# Same initial state as the reference encoder, so that the output is
+		# byte-identical to it
+		self._index = [ (0, 0, 0, 0) ] * 64
+		self._previous = (0, 0, 0, 255)
+		self._run = 0
+
+	def _rgbapixels(self, data):
+		if (self._channels == 3) and self._alpha:
+			return (tuple(data[offset : offset + 4]) for offset in range(0, len(data), 4))
+		elif self._channels == 3:
+			return ((data[offset], data[offset + 1], data[offset + 2], 255) for offset in range(0, len(data), 3))
+		elif self._alpha:
+			return ((data[offset], data[offset], data[offset], data[offset + 1]) for offset in range(0, len(data), 2))
+		else:
+			return ((value, value, value, 255) for value in data)
+
+	def write(self, band, alphaband = None):
+		data = self._rowdata(band, alphaband)
+		(index, previous, run) = (self._index, self._previous, self._run)
+		encoded = bytearray()
+		for pixel in self._rgbapixels(data):
+			if pixel == previous:
+				run += 1
+				if run == 62:
+					encoded.append(0xc0 | (run - 1))
+					run = 0
+				continue
+			if run > 0:
+				encoded.append(0xc0 | (run - 1))
+				run = 0
+			(r, g, b, a) = pixel
+			position = (r * 3 + g * 5 + b * 7 + a * 11) % 64
+			if index[position] == pixel:
+				encoded.append(position)
+			else:
+				index[position] = pixel
+				if a == previous[3]:
+					dr = ((r - previous[0] + 128) & 0xff) - 128
+					dg = ((g - previous[1] + 128) & 0xff) - 128
+					db = ((b - previous[2] + 128) & 0xff) - 128
+					(dr_dg, db_dg) = (dr - dg, db - dg)
+					if (-3 < dr < 2) and (-3 < dg < 2) and (-3 < db < 2):
+						encoded.append(0x40 | ((dr + 2) << 4) | ((dg + 2) << 2) | (db + 2))
+					elif (-33 < dg < 32) and (-9 < dr_dg < 8) and (-9 < db_dg < 8):
+						encoded += bytes((0x80 | (dg + 32), ((dr_dg + 8) << 4) | (db_dg + 8)))
+					else:
+						encoded += bytes((0xfe, r, g, b))
+				else:
+					encoded += bytes((0xff, r, g, b, a))
+			previous = pixel
+		(self._previous, self._run) = (previous, run)
+		self._f.write(encoded)
+		return self
+
+	def _finish(self):
+		if self._run > 0:
+			self._f.write(bytes([ 0xc0 | (self._run - 1) ]))
+		self._f.write(self._END_MARKER)
+
+class QoiReader(_BandReader):
+	_READ_SIZE = 64 * 1024
+
+	def __init__(self, filename):
+		_BandReader.__init__(self, filename)
+		header = self._f.read(14)
+		if (len(header) != 14) or (header[:4] != b"qoif"):
+			raise Exception("Not a QOI file.")
+		(self._width, self._height, filechannels, colorspace) = struct.unpack(">LLBB", header[4:])
+		(self._channels, self._maxval, self._alpha) = (3, 255, filechannels == 4)
+		self._buffer = b""
+		self._index = [ (0, 0, 0, 0) ] * 64
+		self._previous = (0, 0, 0, 255)
+		self._run = 0
+
+	def _readrowdata(self, count):
+		(buf, pos) = (self._buffer, 0)
+		(index, previous, run) = (self._index, self._previous, self._run)
+		pixelcnt = count * self._width
+		data = bytearray()
+		while pixelcnt > 0:
+			if run > 0:
+				length = min(run, pixelcnt)
+				data += bytes(previous) * length
+				(run, pixelcnt) = (run - length, pixelcnt - length)
+				continue
+			if len(buf) - pos < 5:
+				buf = buf[pos:] + self._f.read(self._READ_SIZE)
+				pos = 0
+				if len(buf) == 0:
+					raise Exception("Truncated QOI file.")
+			opcode = buf[pos]
+			if opcode == 0xfe:
+				pixel = (buf[pos + 1], buf[pos + 2], buf[pos + 3], previous[3])
+				pos += 4
+			elif opcode == 0xff:
+				pixel = tuple(buf[pos + 1 : pos + 5])
+				pos += 5
+			elif (opcode & 0xc0) == 0x00:
+				pixel = index[opcode]
+				pos += 1
+			elif (opcode & 0xc0) == 0x40:
+				pixel = ((previous[0] + ((opcode >> 4) & 3) - 2) & 0xff, (previous[1] + ((opcode >> 2) & 3) - 2) & 0xff, (previous[2] + (opcode & 3) - 2) & 0xff, previous[3])
+				pos += 1
+			elif (opcode & 0xc0) == 0x80:
+				dg = (opcode & 0x3f) - 32
+				second = buf[pos + 1]
+				pixel = ((previous[0] + dg + (second >> 4) - 8) & 0xff, (previous[1] + dg) & 0xff, (previous[2] + dg + (second & 0x0f) - 8) & 0xff, previous[3])
+				pos += 2
+			else:
+				run = (opcode & 0x3f) + 1
+				pos += 1
+				continue
+			index[(pixel[0] * 3 + pixel[1] * 5 + pixel[2] * 7 + pixel[3] * 11) % 64] = pixel
+			previous = pixel
+			data += bytes(pixel)
+			pixelcnt -= 1
+		(self._buffer, self._previous, self._run) = (buf[pos:], previous, run)
+		if not self._alpha:
+			data = _deinterleave(data, 3, 1)[0]
+		return data
+
+_WRITERS = {
+	".pam":	PamWriter,
+	".png":	PngWriter,
+	".qoi":	QoiWriter,
+}
+
+def supportsalpha(filename):
+	"""Tells if the format chosen by openwriter() can carry an alpha channel."""
+	return os.path.splitext(filename)[1].lower() in _WRITERS
+
+def openwriter(filename, width, height, channels = 3, maxval = 255, alpha = False, **kwargs):
+	"""Opens a streaming writer, the format is chosen by the file extension.
+	Files that are neither PAM, PNG nor QOI are written as binary PNM."""
+	extension = os.path.splitext(filename)[1].lower()
+	if extension in _WRITERS:
+		return _WRITERS[extension](filename, width, height, channels = channels, maxval = maxval, alpha = alpha, **kwargs)
+	if alpha:
+		raise Exception("PNM files cannot carry an alpha channel.")
+	return PnmStreamWriter(filename, width, height, channels = channels, maxval = maxval)
+
+def _readerclass(filename):
+	with open(filename, "rb") as f:
+		magic = f.read(8)
+	if magic == PngWriter._SIGNATURE:
+		return PngReader
+	elif magic.startswith(b"qoif"):
+		return QoiReader
+	elif magic.startswith(b"P7"):
+		return PamReader
+	return None
+
+def openreader(filename):
+	"""Opens a streaming reader for a PNG, QOI or PAM file, the format is
+	recognized by the file's magic bytes."""
+	readerclass = _readerclass(filename)
+	if readerclass is None:
+		raise Exception("Unknown picture format of %s." % (filename))
+	return readerclass(filename)
+
+def readpicture(filename):
+	"""Reads an entire PNG, QOI, PAM or PNM file and returns a PictureBand."""
+	readerclass = _readerclass(filename)
+	if readerclass is None:
+		return PictureBand(picture = PnmPicture().readfile(filename, native = True), alpha = None)
+	with readerclass(filename) as reader:
+		return reader.readall()
+
+def writepicture(filename, picture, alpha = None, **kwargs):
+	"""Writes an entire picture, the format is chosen by the file extension."""
+	with openwriter(filename, picture.width, picture.height, channels = picture.channels, maxval = picture.maxval, alpha = alpha is not None, **kwargs) as writer:
+		if isinstance(writer, PnmStreamWriter):
+			writer.write(picture)
+		else:
+			writer.write(picture, alpha)
+
+if __name__ == "__main__":
+	import sys
+	picture = PnmPicture().readfile(sys.argv[1], native = True)
+	writepicture(sys.argv[2], picture)
+	print("%s: %d bytes" % (sys.argv[2], os.stat(sys.argv[2]).st_size))
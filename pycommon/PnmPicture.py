@@ -23,25 +23,78 @@
 #
 #	File UUID 1942070a-e148-43ba-ab07-1ff75d53fe01
 
+import sys
+import re
 import math
+import functools
+import hashlib
+import collections
+import mmap
+import array
+import os
+import contextlib
+import concurrent.futures
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import multiprocessing.shared_memory
+except ImportError:
+	# Python < 3.8, tiles can only be processed by threads
+	pass
 
 # Coordinates: 0, 0 is upper left corner
 class PnmPicture():
+	"""Picture with either one (grayscale) or three (RGB) channels per pixel.
+	Samples are 8 bit wide if maxval is below 256 and 16 bit wide (big endian,
+	just like in a PNM file) otherwise. Pixels are always handled as tuples
+	with one entry per channel."""
+	ChannelStatistics = collections.namedtuple("ChannelStatistics", [ "mean", "variance", "minimum", "maximum" ])
+	_HEADER_TOKEN = re.compile(rb"(?:\s|#[^\r\n]*[\r\n])*([^\s#]+)")
+	_COMMENT = re.compile(rb"#[^\r\n]*")
+
 	def __init__(self):
-		self._data = None
 		self._width = None
 		self._height = None
+		self._channels = 3
+		self._maxval = 255
+		self._data = None
+		self._exported = False
+
+	@property
+	def _data(self):
+		return self._rawdata
+
+	@_data.setter
+	def _data(self, value):
+		self._rawdata = value
+		self._digest = None
 
-	def new(self, width, height):
+	def _modified(self):
+		"""Must be called after the picture data was changed in place."""
+		self._digest = None
+
+	def new(self, width, height, channels = 3, maxval = 255):
 		assert(isinstance(width, int))
 		assert(isinstance(height, int))
+		assert(channels in [ 1, 3 ])
+		assert(0 < maxval < 65536)
 		self._width = width
 		self._height = height
-		self._data = bytearray(self.pixelcnt * 3)
+		self._channels = channels
+		self._maxval = maxval
+		self._data = bytearray(self.pixelcnt * self.pixelsize)
 		return self
 
+	def _newlike(self, width, height):
+		"""Creates a new, black picture of the same pixel format."""
+		return PnmPicture().new(width, height, channels = self.channels, maxval = self.maxval)
+
 	def clone(self):
-		clone = PnmPicture().new(self.width, self.height)
+		clone = self._newlike(self.width, self.height)
 		clone._data = bytearray(self._data)
 		return clone
 
@@ -51,6 +104,37 @@ class PnmPicture():
 			raise Exception("No image loaded.")
 		return bytes(self._data)
 
+	@property
+	def buffer(self):
+		"""Returns a writable memoryview of the picture data without copying
+		it."""
+		if self._data is None:
+			raise Exception("No image loaded.")
+		# Changes cannot be tracked from now on, so digest() is not cached
+		self._exported = True
+		return memoryview(self._data)
+
+	@property
+	def dtype(self):
+		"""NumPy data type of a single sample. Requires NumPy."""
+		return numpy.dtype(numpy.uint8) if (self.samplesize == 1) else numpy.dtype(">u2")
+
+	@property
+	def pixels(self):
+		"""Returns a writable NumPy array of shape (height, width, channels)
+		which is a view onto the picture data (i.e., no copy is made). The
+		dtype is uint8 for 8 bit pictures and big endian uint16 for 16 bit
+		pictures. Requires NumPy."""
+		if numpy is None:
+			raise Exception("NumPy is required for pixel array access.")
+		if self._data is None:
+			raise Exception("No image loaded.")
+		self._exported = True
+		return self._pixelarray()
+
+	def _pixelarray(self):
+		return numpy.frombuffer(self._data, dtype = self.dtype).reshape(self.height, self.width, self.channels)
+
 	@property
 	def width(self):
 		if self._width is None:
@@ -63,90 +147,356 @@ class PnmPicture():
 			raise Exception("No image loaded.")
 		return self._height
 
+	@property
+	def channels(self):
+		return self._channels
+
+	@property
+	def maxval(self):
+		return self._maxval
+
+	@property
+	def samplesize(self):
+		"""Size of a single sample in bytes."""
+		return 1 if (self._maxval < 256) else 2
+
+	@property
+	def pixelsize(self):
+		"""Size of a single pixel in bytes."""
+		return self._channels * self.samplesize
+
 	@property
 	def pixelcnt(self):
 		return self.width * self.height
 
-	def fromdata(self, width, height, data):
-		assert(width * height * 3 == len(data))
-		self._width = width
-		self._height = height
+	def fromdata(self, width, height, data, channels = 3, maxval = 255):
+		self.new(width, height, channels = channels, maxval = maxval)
+		assert(len(self._data) == len(data))
 		self._data = bytearray(data)
 		return self
 
-	def readfile(self, filename):
-		f = open(filename, "rb")
-		metadata = { }
-		lines = [ ]
-		while True:
-			line = f.readline().decode("utf-8")[:-1]
-			if line.startswith("#"):
-				continue
-			lines.append(line)
-			if len(lines) == 3:
-				break
+	@staticmethod
+	def _unpacksamples(data, samplesize):
+		if samplesize == 1:
+			return array.array("B", data)
+		samples = array.array("H", data)
+		if sys.byteorder == "little":
+			samples.byteswap()
+		return samples
+
+	def _getsamples(self):
+		"""Returns all samples as an array of native integers."""
+		return self._unpacksamples(self._data, self.samplesize)
+
+	def _packsamples(self, samples):
+		"""Converts a sequence of sample values into picture data."""
+		if self.samplesize == 1:
+			return bytearray(samples)
+		samples = array.array("H", samples)
+		if sys.byteorder == "little":
+			samples.byteswap()
+		return bytearray(samples.tobytes())
+
+	@staticmethod
+	def _expandgray(graydata, samplesize = 1):
+		"""Expands grayscale samples (any buffer) into RGB data."""
+		rgbdata = bytearray(3 * len(graydata))
+		if samplesize == 1:
+			rgbdata[0 :: 3] = graydata
+			rgbdata[1 :: 3] = graydata
+			rgbdata[2 :: 3] = graydata
+		else:
+			(high, low) = (graydata[0 :: 2], graydata[1 :: 2])
+			for channel in range(3):
+				rgbdata[2 * channel + 0 :: 6] = high
+				rgbdata[2 * channel + 1 :: 6] = low
+		return rgbdata
+
+	def _extractchannel(self, channel):
+		"""Returns the data of a single channel."""
+		if self.samplesize == 1:
+			return self._data[channel :: self.channels]
+		channeldata = bytearray(2 * self.pixelcnt)
+		channeldata[0 :: 2] = self._data[2 * channel + 0 :: self.pixelsize]
+		channeldata[1 :: 2] = self._data[2 * channel + 1 :: self.pixelsize]
+		return channeldata
+
+	def getchannel(self, channel):
+		"""Returns a new single channel picture of the given channel."""
+		picture = PnmPicture().new(self.width, self.height, channels = 1, maxval = self.maxval)
+		picture._data = bytearray(self._extractchannel(channel))
+		return picture
+
+	@staticmethod
+	def _parseheader(buf):
+		"""Parses the PNM header at the beginning of the given buffer (bytes or
+		mmap). The four header fields may be separated by any whitespace and
+		comments may appear anywhere in between. Returns the metadata and the
+		offset of the pixel data, which starts after the single whitespace
+		character that follows the maxval."""
+		tokens = [ ]
+		offset = 0
+		while len(tokens) < 4:
+			match = PnmPicture._HEADER_TOKEN.match(buf, offset)
+			if match is None:
+				raise Exception("Truncated PNM header.")
+			tokens.append(match.group(1).decode("ascii"))
+			offset = match.end()
+		if (offset >= len(buf)) or (not buf[offset : offset + 1].isspace()):
+			raise Exception("Truncated PNM header.")
+
+		metadata = {
+			"format":	tokens[0],
+			"geometry":	"%s %s" % (tokens[1], tokens[2]),
+			"bpp":		int(tokens[3]),
+		}
+		return (metadata, offset + 1)
 
-		metadata["format"] = lines[0]
-		metadata["geometry"] = lines[1]
-		metadata["bpp"] = int(lines[2])
+	@staticmethod
+	def _parseascii(body, count, maxval):
+		"""Converts the whitespace separated decimal samples of a plain (P2 or
+		P3) PNM file body into a list (or NumPy array) of 'count' values. The
+		body is tokenized at once instead of line by line, so any number of
+		samples per line and comments are accepted."""
+		if b"#" in body:
+			body = PnmPicture._COMMENT.sub(b" ", body)
+		# Both paths convert every token with int() semantics, so they accept
+		# and reject exactly the same input
+		tokens = body.split()
+		try:
+			if numpy is not None:
+				samples = numpy.array(tokens, dtype = numpy.int64)
+			else:
+				samples = list(map(int, tokens))
+		except ValueError:
+			raise Exception("Invalid sample in plain PNM data.")
+		if len(samples) < count:
+			raise Exception("Truncated plain PNM data: expected %d samples, got %d." % (count, len(samples)))
+		samples = samples[:count]
+		if count == 0:
+			return samples
+		(minimum, maximum) = (min(samples), max(samples)) if isinstance(samples, list) else (samples.min(), samples.max())
+		if (minimum < 0) or (maximum > maxval):
+			raise Exception("Plain PNM sample out of range 0..%d." % (maxval))
+		return samples
+
+	def readfile(self, filename, native = False):
+		"""Reads a PNM file. By default, the picture is always converted to 8 bit
+		RGB and only files with a maxval of 255 are supported. If 'native' is
+		set, grayscale pictures are kept as single channel pictures and any
+		maxval up to 65535 is supported."""
+		with open(filename, "rb") as f:
+			try:
+				mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			except (ValueError, OSError):
+				# Pipes, FIFOs, character devices and empty files cannot be
+				# mapped, read them into memory instead
+				return self._readbuffer(f.read(), native)
+			with mapped:
+				return self._readbuffer(mapped, native)
+
+	def _readbuffer(self, buf, native):
+		"""Reads a PNM file from a buffer (bytes or mmap), see readfile()."""
+		(metadata, offset) = self._parseheader(buf)
 
-		(self._width, self._height) = [ int(s) for s in metadata["geometry"].split()]
+		(width, height) = [ int(s) for s in metadata["geometry"].split()]
 		# P2 = Grayscale ASCII
 		# P3 = RGB ASCII
 		# P5 = Grayscale binary
 		# P6 = RGB binary
 		assert(metadata["format"] in [ "P2", "P3", "P5", "P6" ])
-		assert(metadata["bpp"] == 255)
+		if not native:
+			assert(metadata["bpp"] == 255)
 
 		fmt_binary = metadata["format"] in [ "P5", "P6" ]
 		rgb = metadata["format"] in [ "P3", "P6" ]
-		if rgb:
-			# RGB
-			if fmt_binary:
-				self._data = bytearray(f.read())
-			else:
-				self._data = bytearray(self.pixelcnt * 3)
-				for i in range(self.pixelcnt * 3):
-					self._data[i] = int(f.readline())
+		self.new(width, height, channels = 3 if rgb else 1, maxval = metadata["bpp"])
+		if fmt_binary:
+			# Copy straight out of the (mapped) file, without intermediate
+			# bytes objects
+			with memoryview(buf) as view:
+				body = view[offset : offset + len(self._data)]
+				self._data[:] = body
+				body.release()
 		else:
-			# Grayscale
-			if fmt_binary:
-				self._data = bytearray().join(bytes([c, c, c]) for c in f.read())
+			samples = self._parseascii(buf[offset : ], self.pixelcnt * self.channels, self.maxval)
+			if numpy is not None:
+				self._data = bytearray(samples.astype(">u2" if (self.samplesize == 2) else numpy.uint8).tobytes())
 			else:
-				self._data = bytearray()
-				for i in range(self.pixelcnt):
-					c = int(f.readline())
-					self._data += bytes([ c, c, c ])
-		f.close()
-		assert(self.pixelcnt * 3 == len(self._data))
+				self._data = self._packsamples(samples)
+		assert(self.pixelcnt * self.pixelsize == len(self._data))
+
+		if (not native) and (not rgb):
+			self._data = self._expandgray(self._data)
+			self._channels = 3
 		return self
 
 	def _getoffset(self, x, y):
 		assert(0 <= x < self.width)
 		assert(0 <= y < self.height)
-		offset = 3 * ((y * self.width) + x)
+		offset = self.pixelsize * ((y * self.width) + x)
 		return offset
 
-	def multiply(self, pixel):
-		(mr, mg, mb) = pixel
-		for y in range(self.height):
-			for x in range(self.width):
-				(r, g, b) = self.getpixel(x, y)
-				r = round((r * mr) / 255)
-				g = round((g * mg) / 255)
-				b = round((b * mb) / 255)
-				self.setpixel(x, y, (r, g, b))
+	def _applyluts(self, luts):
+		"""Maps every channel through its own lookup table which has maxval + 1
+		entries. For 8 bit pictures, this is done by bytes.translate() on the
+		interleaved channel slices, which is considerably faster than NumPy
+		fancy indexing."""
+		assert(len(luts) == self.channels)
+		if self.samplesize == 1:
+			luts = [ bytes(lut) + bytes(range(len(lut), 256)) for lut in luts ]
+			if len(set(luts)) == 1:
+				self._data[:] = self._data.translate(luts[0])
+			else:
+				for (channel, lut) in enumerate(luts):
+					self._data[channel :: self.channels] = self._data[channel :: self.channels].translate(lut)
+		elif numpy is not None:
+			pixels = self._pixelarray()
+			for (channel, lut) in enumerate(luts):
+				pixels[:, :, channel] = numpy.asarray(lut, dtype = numpy.uint16)[pixels[:, :, channel]]
+		else:
+			samples = self._getsamples()
+			for (channel, lut) in enumerate(luts):
+				samples[channel :: self.channels] = array.array("H", [ lut[value] for value in samples[channel :: self.channels] ])
+			self._data = self._packsamples(samples)
+		self._modified()
 		return self
 
+	def _luts_multiply(self, pixel):
+		return [ [ round((value * multiplier) / self.maxval) for value in range(self.maxval + 1) ] for multiplier in pixel ]
+
+	def multiply(self, pixel):
+		return self._applyluts(self._luts_multiply(pixel))
+
 	def downscale(self):
 		assert((self.width % 2) == 0)
 		assert((self.height % 2) == 0)
-		clone = PnmPicture().new(self.width // 2, self.height // 2)
-		for y in range(clone.height):
-			for x in range(clone.width):
-				pixel = self.getsubpicture(2 * x, 2 * y, 2, 2).avgcolor()
-				clone.setpixel(x, y, pixel)
-		return clone
+		return self.resize(self.width // 2, self.height // 2, method = "box")
+
+	_LANCZOS_LOBES = 3
+
+	@classmethod
+	def _resamplingtaps(cls, insize, outsize, method):
+		"""Returns a list of (first input index, weights) tuples, one for every
+		output sample along one axis. Weights are normalized to sum up to one,
+		taps outside the picture are dropped."""
+		scale = insize / outsize
+		taps = [ ]
+		for i in range(outsize):
+			if method == "box":
+				# Area coverage of the input samples by [x0, x1)
+				(x0, x1) = (i * scale, (i + 1) * scale)
+				(first, last) = (int(x0), min(insize - 1, math.ceil(x1) - 1))
+				weights = [ min(x1, j + 1) - max(x0, j) for j in range(first, last + 1) ]
+			else:
+				center = (i + 0.5) * scale - 0.5
+				stretch = max(1, scale)
+				if method == "bilinear":
+					support = stretch
+					kernel = lambda t: max(0, 1 - abs(t))
+				elif method == "lanczos":
+					support = cls._LANCZOS_LOBES * stretch
+					kernel = lambda t: 1 if (t == 0) else (math.sin(math.pi * t) * math.sin(math.pi * t / cls._LANCZOS_LOBES) * cls._LANCZOS_LOBES / (math.pi * math.pi * t * t)) if (abs(t) < cls._LANCZOS_LOBES) else 0
+				else:
+					raise Exception("Unknown resampling method '%s'." % (method))
+				first = max(0, math.floor(center - support) + 1)
+				last = min(insize - 1, math.ceil(center + support) - 1)
+				weights = [ kernel((j - center) / stretch) for j in range(first, last + 1) ]
+			weightsum = sum(weights)
+			taps.append((first, [ weight / weightsum for weight in weights ]))
+		return taps
+
+	@staticmethod
+	def _integrate_numpy(values, axis, insize, outsize):
+		"""Averages [i * scale, (i + 1) * scale) areas along the axis. The
+		summed-area table is only evaluated at the area boundaries: whole rows
+		in between are added up by reduceat(), the fractional rest is linearly
+		interpolated."""
+		values = numpy.moveaxis(values, axis, 0)
+		scale = insize / outsize
+		positions = numpy.arange(outsize + 1) * scale
+		index = numpy.minimum(numpy.floor(positions).astype(numpy.intp), insize - 1)
+		fraction = (positions - index).reshape((-1, ) + (1, ) * (values.ndim - 1))
+		blocksums = numpy.add.reduceat(values, index, axis = 0, dtype = numpy.float64)[:-1]
+		blocksums[index[:-1] == index[1:]] = 0
+		cumulative = numpy.zeros((outsize + 1, ) + values.shape[1:], dtype = numpy.float64)
+		numpy.cumsum(blocksums, axis = 0, out = cumulative[1:])
+		integral = cumulative + fraction * values[index]
+		return numpy.moveaxis((integral[1:] - integral[:-1]) / scale, 0, axis)
+
+	@staticmethod
+	def _gather_numpy(values, axis, taps):
+		"""Applies resampling taps along the given axis of a NumPy array."""
+		tapcount = max(len(weights) for (first, weights) in taps)
+		insize = values.shape[axis]
+		result = None
+		for k in range(tapcount):
+			index = numpy.array([ min(first + k, insize - 1) for (first, weights) in taps ], dtype = numpy.intp)
+			weight = numpy.array([ weights[k] if (k < len(weights)) else 0 for (first, weights) in taps ], dtype = numpy.float64)
+			weight = weight.reshape((-1, 1, 1) if (axis == 0) else (1, -1, 1))
+			contribution = weight * values.take(index, axis = axis)
+			result = contribution if (result is None) else (result + contribution)
+		return result
+
+	def _resize_numpy(self, width, height, method):
+		values = self._pixelarray()
+		if method == "box":
+			values = self._integrate_numpy(values, 0, self.height, height)
+			values = self._integrate_numpy(values, 1, self.width, width)
+		else:
+			values = values.astype(numpy.float64)
+			values = self._gather_numpy(values, 0, self._resamplingtaps(self.height, height, method))
+			values = self._gather_numpy(values, 1, self._resamplingtaps(self.width, width, method))
+		resized = self._newlike(width, height)
+		resized._pixelarray()[...] = numpy.clip(numpy.rint(values), 0, self.maxval)
+		return resized
+
+	def _resize_python(self, width, height, method):
+		samples = self._getsamples()
+		rowsize = self.width * self.channels
+		rows = [ samples[y * rowsize : (y + 1) * rowsize ] for y in range(self.height) ]
+
+		# Vertical pass, combines entire rows
+		vrows = [ ]
+		for (first, weights) in self._resamplingtaps(self.height, height, method):
+			row = [ 0 ] * rowsize
+			for (y, weight) in enumerate(weights, first):
+				row = [ value + weight * sample for (value, sample) in zip(row, rows[y]) ]
+			vrows.append(row)
+
+		# Horizontal pass
+		htaps = self._resamplingtaps(self.width, width, method)
+		channels = self.channels
+		values = [ ]
+		for row in vrows:
+			for (first, weights) in htaps:
+				for channel in range(channels):
+					values.append(round(sum(weight * row[x * channels + channel] for (x, weight) in enumerate(weights, first))))
+		resized = self._newlike(width, height)
+		resized._data = self._packsamples(0 if (value < 0) else self.maxval if (value > self.maxval) else value for value in values)
+		return resized
+
+	def resize(self, width, height, method = "box"):
+		"""Returns a new picture resampled to an arbitrary size. The method can
+		be "box" (area averaging, best for reduction), "bilinear" or "lanczos"
+		(three lobes). When reducing, the bilinear and Lanczos kernels are
+		stretched so that all input pixels contribute."""
+		assert(isinstance(width, int) and (width >= 1))
+		assert(isinstance(height, int) and (height >= 1))
+		if method not in [ "box", "bilinear", "lanczos" ]:
+			raise Exception("Unknown resampling method '%s'." % (method))
+		if numpy is not None:
+			return self._resize_numpy(width, height, method)
+		else:
+			return self._resize_python(width, height, method)
+
+	def thumbnail(self, maxwidth, maxheight, method = "box"):
+		"""Returns a reduced copy which fits into maxwidth x maxheight while
+		keeping the aspect ratio. Pictures that already fit are cloned."""
+		scale = min(maxwidth / self.width, maxheight / self.height)
+		if scale >= 1:
+			return self.clone()
+		return self.resize(max(1, round(self.width * scale)), max(1, round(self.height * scale)), method = method)
 
 	def upscale(self, xmultiplicity = None, ymultiplicity = None):
 		assert((xmultiplicity is not None) or (ymultiplicity is not None))
@@ -160,148 +510,358 @@ class PnmPicture():
 		assert(ymultiplicity >= 1)
 		if (xmultiplicity == 1) and (ymultiplicity == 1):
 			return self
-		upscaled = PnmPicture().new(self.width * xmultiplicity, self.height * ymultiplicity)
-		for y in range(self.height):
-			for x in range(self.width):
-				pixel = self.getpixel(x, y)
+		upscaled = self._newlike(self.width * xmultiplicity, self.height * ymultiplicity)
+		(pixelsize, rowsize) = (self.pixelsize, upscaled.width * self.pixelsize)
+
+		# Replicate every pixel horizontally, the rows stay aligned
+		widened = bytearray(len(self._data) * xmultiplicity) if (xmultiplicity > 1) else self._data
+		if xmultiplicity > 1:
+			for offset in range(pixelsize):
+				column = self._data[offset :: pixelsize]
 				for xoff in range(xmultiplicity):
-					for yoff in range(ymultiplicity):
-						upscaled.setpixel(xmultiplicity * x + xoff, ymultiplicity * y + yoff, pixel)
+					widened[xoff * pixelsize + offset :: xmultiplicity * pixelsize] = column
+
+		# Replicate every row vertically
+		data = upscaled._data
+		for y in range(self.height):
+			data[y * ymultiplicity * rowsize : (y + 1) * ymultiplicity * rowsize] = widened[y * rowsize : (y + 1) * rowsize] * ymultiplicity
 		return upscaled
 
 	def getpixel(self, x, y):
 		offset = self._getoffset(x, y)
-		(r, g, b) = (self._data[offset + 0], self._data[offset + 1], self._data[offset + 2])
-		return (r, g, b)
+		if self.samplesize == 1:
+			return tuple(self._data[offset : offset + self.channels])
+		return tuple(int.from_bytes(self._data[offset + 2 * channel : offset + 2 * channel + 2], byteorder = "big") for channel in range(self.channels))
+
+	def _packpixel(self, pixel):
+		assert(len(pixel) == self.channels)
+		if self.samplesize == 1:
+			return bytes(pixel)
+		return b"".join(value.to_bytes(2, byteorder = "big") for value in pixel)
 
 	def setpixel(self, x, y, pixel):
 		offset = self._getoffset(x, y)
-		(r, g, b) = pixel
-		self._data[offset + 0] = r
-		self._data[offset + 1] = g
-		self._data[offset + 2] = b
+		self._data[offset : offset + self.pixelsize] = self._packpixel(pixel)
+		self._modified()
 		return self
 
-	def writefile(self, filename, channel = None):
-		if channel is not None:
-			# grayscale picture
-			stride = 3
-			offset = channel % 3
-		else:
-			stride = 1
-			offset = 0
-		f = open(filename, "wb")
-		if channel is None:
-			f.write("P6\n".encode("utf-8"))
+	@staticmethod
+	def _writeheader(fmt, width, height, maxval):
+		header = "%s\n# CREATOR: PnmPicture.py\n%d %d\n%d\n" % (fmt, width, height, maxval)
+		return header.encode("utf-8")
+
+	def writefile(self, filename, channel = None, ascii = False):
+		"""Writes a binary (P5/P6) or, if 'ascii' is set, plain (P2/P3) PNM
+		file. If 'channel' is given, only that channel is written as a
+		grayscale picture."""
+		if (self.channels == 3) and (channel is None):
+			(fmt, data) = ("P6", self._data)
+		elif self.channels == 1:
+			(fmt, data) = ("P5", self._data)
 		else:
-			f.write("P5\n".encode("utf-8"))
-		f.write("# CREATOR: PnmPicture.py\n".encode("utf-8"))
-		f.write(("%d %d\n" % (self._width, self._height)).encode("utf-8"))
-		f.write("255\n".encode("utf-8"))
-		f.write(self._data[offset :: stride])
-		f.close()
+			# grayscale picture of a single channel
+			(fmt, data) = ("P5", self._extractchannel(channel % 3))
+		if ascii:
+			fmt = { "P5": "P2", "P6": "P3" }[fmt]
+			decimal = [ str(value) for value in range(self.maxval + 1) ]
+			data = ("\n".join(map(decimal.__getitem__, self._unpacksamples(data, self.samplesize))) + "\n").encode("ascii")
+		with open(filename, "wb") as f:
+			f.write(self._writeheader(fmt, self._width, self._height, self._maxval))
+			# Picture data is written straight from the buffer without copying
+			f.write(data)
 		return self
-	
+
 	def getsubpicture(self, offsetx, offsety, width, height):
 		assert(offsetx + width <= self.width)
 		assert(offsety + height <= self.height)
-		subpic = PnmPicture().new(width, height)
+		subpic = self._newlike(width, height)
 		subpic.blitsubpicture(-offsetx, -offsety, self)
 		return subpic
 
-	def blitsubpicture(self, offsetx, offsety, subpic):
-		#print("Blitting %s onto %s @ %d, %d" % (subpic, self, offsetx, offsety))
-		subdata = subpic._data
-
+	def _clip(self, offsetx, offsety, subpic):
+		"""Returns the (x start, x end, y start, y end) region of subpic that
+		lies within the picture when placed at offsetx, offsety or None if it
+		is clipped completely."""
 		src_y_start = max(0, -offsety)
 		src_y_end = min(subpic.height, self.height - offsety)
-		
+
 		src_x_start = max(0, -offsetx)
 		src_x_end = min(subpic.width, self.width - offsetx)
-		if src_x_start >= src_x_end:
-			# Complete X clipping, no blitting necessary
+		if (src_x_start >= src_x_end) or (src_y_start >= src_y_end):
+			return None
+		return (src_x_start, src_x_end, src_y_start, src_y_end)
+
+	def blitsubpicture(self, offsetx, offsety, subpic):
+		#print("Blitting %s onto %s @ %d, %d" % (subpic, self, offsetx, offsety))
+		assert((subpic.channels == self.channels) and (subpic.samplesize == self.samplesize))
+		clipped = self._clip(offsetx, offsety, subpic)
+		if clipped is None:
+			# Complete clipping, no blitting necessary
 			return
+		(src_x_start, src_x_end, src_y_start, src_y_end) = clipped
 
 		for yline in range(src_y_start, src_y_end):
 			src_o_start = subpic._getoffset(src_x_start, yline)
-			src_o_end = subpic._getoffset(src_x_end - 1, yline) + 3
+			src_o_end = subpic._getoffset(src_x_end - 1, yline) + subpic.pixelsize
 
 			dst_o_start = self._getoffset(src_x_start + offsetx, yline + offsety)
-			dst_o_end = self._getoffset(src_x_end + offsetx - 1, yline + offsety) + 3
+			dst_o_end = self._getoffset(src_x_end + offsetx - 1, yline + offsety) + self.pixelsize
 			self._data[dst_o_start : dst_o_end] = subpic._data[src_o_start : src_o_end]
+		self._modified()
+
+	def _rowsamples(self, x0, x1, y):
+		"""Returns the samples of pixels x0 to x1 (exclusive) of a row."""
+		data = self._data[self.pixelsize * (y * self.width + x0) : self.pixelsize * (y * self.width + x1)]
+		if self.samplesize == 1:
+			return data
+		samples = array.array("H", data)
+		if sys.byteorder == "little":
+			samples.byteswap()
+		return samples
+
+	def _composite_numpy(self, offsetx, offsety, subpic, clipped, alpha, opacity, premultiplied):
+		(x0, x1, y0, y1) = clipped
+		destination = self._pixelarray()[y0 + offsety : y1 + offsety, x0 + offsetx : x1 + offsetx]
+		source = subpic._pixelarray()[y0 : y1, x0 : x1]
+		if alpha is not None:
+			factor = (alpha._pixelarray()[y0 : y1, x0 : x1] / alpha.maxval) * opacity
+		else:
+			factor = opacity
+		if premultiplied:
+			result = (source * opacity) + (destination * (1 - factor))
+		else:
+			result = (destination * (1 - factor)) + (source * factor)
+		destination[...] = numpy.clip(numpy.rint(result), 0, self.maxval)
+
+	def _composite_python(self, offsetx, offsety, subpic, clipped, alpha, opacity, premultiplied):
+		(x0, x1, y0, y1) = clipped
+		maxval = self.maxval
+		for y in range(y0, y1):
+			destination = self._rowsamples(x0 + offsetx, x1 + offsetx, y + offsety)
+			source = subpic._rowsamples(x0, x1, y)
+			if alpha is not None:
+				factors = [ (value / alpha.maxval) * opacity for value in alpha._rowsamples(x0, x1, y) for channel in range(self.channels) ]
+			else:
+				factors = [ opacity ] * len(source)
+			if premultiplied:
+				values = [ round((src * opacity) + (dst * (1 - factor))) for (dst, src, factor) in zip(destination, source, factors) ]
+			else:
+				values = [ round((dst * (1 - factor)) + (src * factor)) for (dst, src, factor) in zip(destination, source, factors) ]
+			offset = self._getoffset(x0 + offsetx, y + offsety)
+			self._data[offset : offset + len(values) * self.samplesize] = self._packsamples(maxval if (value > maxval) else value for value in values)
+
+	def composite(self, subpic, offsetx, offsety, alpha = None, opacity = 1, premultiplied = False):
+		"""Draws subpic over the picture at offsetx, offsety with the same
+		clipping as blitsubpicture(). The coverage of each pixel is given by
+		the optional single channel 'alpha' picture (of the size of subpic,
+		relative to its own maxval) multiplied by 'opacity'. If 'premultiplied'
+		is set, subpic has already been multiplied by its alpha (but not by
+		'opacity'). Uniform coverage gives the same result as blend()."""
+		assert((subpic.channels == self.channels) and (subpic.samplesize == self.samplesize))
+		assert(0 <= opacity <= 1)
+		if alpha is not None:
+			assert((alpha.width, alpha.height, alpha.channels) == (subpic.width, subpic.height, 1))
+		elif (opacity == 1) and (not premultiplied):
+			self.blitsubpicture(offsetx, offsety, subpic)
+			return self
+		clipped = self._clip(offsetx, offsety, subpic)
+		if clipped is not None:
+			if numpy is not None:
+				self._composite_numpy(offsetx, offsety, subpic, clipped, alpha, opacity, premultiplied)
+			else:
+				self._composite_python(offsetx, offsety, subpic, clipped, alpha, opacity, premultiplied)
+			self._modified()
+		return self
 
 	def avgcolor(self):
-		(rsum, gsum, bsum) = (0, 0, 0)
-		for (r, g, b) in self:
-			rsum += r
-			gsum += g
-			bsum += b
-		r = round(rsum / self.pixelcnt)
-		g = round(gsum / self.pixelcnt)
-		b = round(bsum / self.pixelcnt)
-		return (r, g, b)
+		samples = self._data if (self.samplesize == 1) else self._getsamples()
+		return tuple(round(sum(samples[channel :: self.channels]) / self.pixelcnt) for channel in range(self.channels))
+
+	def histogram(self, channel):
+		"""Returns a list of maxval + 1 counts, one for every sample value of
+		the given channel."""
+		assert(0 <= channel < self.channels)
+		if numpy is not None:
+			samples = numpy.frombuffer(self._data, dtype = self.dtype)[channel :: self.channels]
+			counts = numpy.bincount(samples.astype(numpy.intp) if (self.samplesize == 2) else samples, minlength = self.maxval + 1)
+			return counts.tolist()
+		elif self.samplesize == 1:
+			counter = collections.Counter(self._data[channel :: self.channels])
+		else:
+			counter = collections.Counter(self._getsamples()[channel :: self.channels])
+		return [ counter[value] for value in range(self.maxval + 1) ]
+
+	def histograms(self):
+		return [ self.histogram(channel) for channel in range(self.channels) ]
+
+	def statistics(self):
+		"""Returns exact mean, (population) variance, minimum and maximum of
+		every channel, all derived from the channel histograms. Returns None
+		for pictures without pixels."""
+		if self.pixelcnt == 0:
+			return None
+		result = [ ]
+		for histogram in self.histograms():
+			count = sum(histogram)
+			mean = sum(value * frequency for (value, frequency) in enumerate(histogram)) / count
+			variance = sum(frequency * (value - mean) ** 2 for (value, frequency) in enumerate(histogram) if frequency) / count
+			occurring = [ value for (value, frequency) in enumerate(histogram) if frequency ]
+			result.append(self.ChannelStatistics(mean = mean, variance = variance, minimum = occurring[0], maximum = occurring[-1]))
+		return result
+
+	def digest(self):
+		"""Returns a 16 byte BLAKE2b digest over pixel format and data. It is
+		cached until the picture is modified; once the raw data was handed out
+		through 'buffer' or 'pixels', it is computed anew every time."""
+		if (self._digest is None) or self._exported:
+			hashfnc = hashlib.blake2b(digest_size = 16)
+			hashfnc.update(("%d %d %d %d\n" % (self.width, self.height, self.channels, self.maxval)).encode("ascii"))
+			hashfnc.update(self._data)
+			self._digest = hashfnc.digest()
+		return self._digest
+
+	def _graythumbnail(self, width, height):
+		"""Luma values of the picture reduced to width x height."""
+		small = self.resize(width, height, method = "box")
+		if small.channels == 1:
+			return list(small._getsamples())
+		samples = small._getsamples()
+		return [ (0.299 * r) + (0.587 * g) + (0.114 * b) for (r, g, b) in zip(samples[0 :: 3], samples[1 :: 3], samples[2 :: 3]) ]
+
+	def ahash(self, size = 8):
+		"""Average hash: one bit per pixel of a size x size gray thumbnail,
+		set if the pixel is brighter than the thumbnail's mean."""
+		values = self._graythumbnail(size, size)
+		mean = sum(values) / len(values)
+		return sum(1 << i for (i, value) in enumerate(values) if value > mean)
+
+	def dhash(self, size = 8):
+		"""Difference hash: one bit per horizontally adjacent pixel pair of a
+		(size + 1) x size gray thumbnail, set if brightness increases."""
+		values = self._graythumbnail(size + 1, size)
+		bits = [ values[y * (size + 1) + x + 1] > values[y * (size + 1) + x] for y in range(size) for x in range(size) ]
+		return sum(1 << i for (i, bit) in enumerate(bits) if bit)
+
+	@staticmethod
+	def hashdistance(hash1, hash2):
+		"""Hamming distance of two perceptual hashes."""
+		return bin(hash1 ^ hash2).count("1")
 
 	@staticmethod
 	def _blendpixel(pixel1, pixel2, opacity):
-		(r1, g1, b1) = pixel1
-		(r2, g2, b2) = pixel2
-		return (round((r1 * (1 - opacity)) + (r2 * opacity)),
-					round((g1 * (1 - opacity)) + (g2 * opacity)),
-					round((b1 * (1 - opacity)) + (b2 * opacity)))
+		return tuple(round((value1 * (1 - opacity)) + (value2 * opacity)) for (value1, value2) in zip(pixel1, pixel2))
 
+	def _luts_blend(self, pixel, opacity):
+		return [ [ round((value * (1 - opacity)) + (color * opacity)) for value in range(self.maxval + 1) ] for color in pixel ]
 
 	def blend(self, pixel, opacity):
-		for y in range(self.height):
-			for x in range(self.width):
-				self.setpixel(x, y, self._blendpixel(self.getpixel(x, y), pixel, opacity))
-		return self
+		return self._applyluts(self._luts_blend(pixel, opacity))
 
-	def lighten(self, opacity, maxopacity = 1):
+	def _luts_lighten(self, opacity, maxopacity = 1):
 		if opacity > maxopacity:
 			opacity = maxopacity
 		assert(0 <= opacity <= 1)
-		return self.blend((255, 255, 255), opacity)
+		return self._luts_blend((self.maxval, ) * self.channels, opacity)
 
-	def darken(self, opacity, maxopacity = 1):
+	def lighten(self, opacity, maxopacity = 1):
+		return self._applyluts(self._luts_lighten(opacity, maxopacity))
+
+	def _luts_darken(self, opacity, maxopacity = 1):
 		if opacity > maxopacity:
 			opacity = maxopacity
 		assert(0 <= opacity <= 1)
-		return self.blend((0, 0, 0), opacity)
+		return self._luts_blend((0, ) * self.channels, opacity)
+
+	def darken(self, opacity, maxopacity = 1):
+		return self._applyluts(self._luts_darken(opacity, maxopacity))
+
+	def _luts_invert(self):
+		return [ list(range(self.maxval, -1, -1)) ] * self.channels
 
 	def invert(self):
-		for i in range(len(self._data)):
-			self._data[i] = 255 - self._data[i]
+		if numpy is not None:
+			pixels = self._pixelarray()
+			numpy.subtract(self.maxval, pixels, out = pixels)
+		elif self.maxval == 255:
+			self._data[:] = self._data.translate(bytes(range(255, -1, -1)))
+		else:
+			self._applyluts(self._luts_invert())
+		self._modified()
 		return self
 
 	def setto(self, pixel):
-		self._data = bytearray([ pixel[0], pixel[1], pixel[2] ]) * self.pixelcnt
+		self._data = bytearray(self._packpixel(pixel)) * self.pixelcnt
+
+	def _setfromarray(self, pixels):
+		"""Replaces the picture by a (height, width, channels) NumPy array (of
+		the same pixel format), which may be a non-contiguous view."""
+		data = bytearray(len(self._data))
+		numpy.frombuffer(data, dtype = self.dtype).reshape(pixels.shape)[...] = pixels
+		(self._width, self._height) = (pixels.shape[1], pixels.shape[0])
+		self._data = data
+		return self
+
+	_TRANSPOSE_BAND_HEIGHT = 1024
+
+	def _transpose_python(self, reversecolumns, reverserows):
+		"""Turns every column into a row, one extended slice per byte of each
+		column. The picture is processed in bands of rows so that the strided
+		reads stay in the cache. Optionally, the columns are taken right to
+		left and/or read bottom to top."""
+		(pixelsize, rowsize) = (self.pixelsize, self.width * self.pixelsize)
+		newrowsize = self.height * pixelsize
+		data = bytearray(len(self._data))
+		for y0 in range(0, self.height, self._TRANSPOSE_BAND_HEIGHT):
+			y1 = min(self.height, y0 + self._TRANSPOSE_BAND_HEIGHT)
+			band = self._data[y0 * rowsize : y1 * rowsize]
+			if reverserows:
+				(start, step) = ((y1 - y0 - 1) * rowsize, -rowsize)
+				(dststart, dstend) = ((self.height - y1) * pixelsize, (self.height - y0) * pixelsize)
+			else:
+				(start, step) = (0, rowsize)
+				(dststart, dstend) = (y0 * pixelsize, y1 * pixelsize)
+			for newy in range(self.width):
+				x = (self.width - 1 - newy) if reversecolumns else newy
+				for offset in range(pixelsize):
+					data[newy * newrowsize + dststart + offset : newy * newrowsize + dstend : pixelsize] = band[start + x * pixelsize + offset :: step]
+		(self._width, self._height) = (self._height, self._width)
+		self._data = data
+		return self
+
+	def transpose(self):
+		"""Mirrors the picture along its main diagonal."""
+		return self._transpose_python(reversecolumns = False, reverserows = False)
+
+	def flipvertical(self):
+		"""Mirrors the picture upside down."""
+		rowsize = self.width * self.pixelsize
+		self._data = bytearray().join(self._data[y * rowsize : (y + 1) * rowsize] for y in reversed(range(self.height)))
+		return self
+
+	def _reversepixels(self):
+		pixelsize = self.pixelsize
+		data = bytearray(len(self._data))
+		for offset in range(pixelsize):
+			data[offset :: pixelsize] = self._data[len(self._data) - pixelsize + offset :: -pixelsize]
+		self._data = data
+		return self
+
+	def fliphorizontal(self):
+		"""Mirrors the picture left to right."""
+		if numpy is not None:
+			return self._setfromarray(self._pixelarray()[:, ::-1])
+		return self._reversepixels().flipvertical()
 
 	def rotate(self, degrees):
+		"""Rotates the picture clockwise by a multiple of 90°."""
 		assert(isinstance(degrees, int))
 		degrees %= 360
 		if degrees == 90:
-			copy = PnmPicture().new(self.height, self.width)
-			for y in range(self.height):
-				for x in range(self.width):
-					pix = self.getpixel(x, y)
-					copy.setpixel(self.height - y - 1, x, pix)
-			(self._width, self._height) = (self._height, self._width)
-			self._data = copy._data
+			self._transpose_python(reversecolumns = False, reverserows = True)
 		elif degrees == 270:
-			copy = PnmPicture().new(self.height, self.width)
-			for y in range(self.height):
-				for x in range(self.width):
-					pix = self.getpixel(x, y)
-					copy.setpixel(y, self._width - 1 - x, pix)
-			(self._width, self._height) = (self._height, self._width)
-			self._data = copy._data
+			self._transpose_python(reversecolumns = True, reverserows = False)
 		elif degrees == 180:
-			copy = PnmPicture().new(self.height, self.width)
-			for y in range(self.height):
-				for x in range(self.width):
-					pix = self.getpixel(x, y)
-					copy.setpixel(self._width - 1 - x, self._height - 1 - y, pix)
-			self._data = copy._data
+			self._reversepixels()
 		elif degrees == 0:
 			pass
 		else:
@@ -309,7 +869,7 @@ class PnmPicture():
 		return self
 
 	def applystencilpixel(self, x, y, stencil, source):
-		sumpx = [0, 0, 0]
+		sumpx = [ 0 ] * self.channels
 		for xoffset in range(stencil.width):
 			for yoffset in range(stencil.height):
 				picx = x + xoffset - stencil.xoffset
@@ -317,32 +877,184 @@ class PnmPicture():
 				if (0 <= picx < source.width) and (0 <= picy < source.height):
 					srcpix = source.getpixel(picx, picy)
 					weight = stencil[(xoffset, yoffset)]
-					sumpx[0] += weight * srcpix[0]
-					sumpx[1] += weight * srcpix[1]
-					sumpx[2] += weight * srcpix[2]
+					for channel in range(self.channels):
+						sumpx[channel] += weight * srcpix[channel]
 		sumpx = [ round(element / stencil.weightsum) for element in sumpx ]
 		sumpx = [ 0 if (element < 0) else element for element in sumpx ]
-		sumpx = [ 255 if (element > 255) else element for element in sumpx ]
+		sumpx = [ self.maxval if (element > self.maxval) else element for element in sumpx ]
 		pixel = tuple(sumpx)
 		self.setpixel(x, y, pixel)
 		return self
-	
-	def applystencil(self, stencil, source):
-		copy = self.clone()
-		for x in range(self.width):
-			for y in range(self.height):
-				self.applystencilpixel(x, y, stencil, copy)
+
+	@staticmethod
+	def _correlate_python(plane, width, height, taps, xoffset, yoffset):
+		"""Correlates a plane (list of rows) with the given (x, y, weight) taps.
+		Picture borders are zero padded, i.e., taps outside of the picture are
+		skipped. Taps are accumulated in the given order."""
+		result = [ [ 0 ] * width for y in range(height) ]
+		for (x, y, weight) in taps:
+			(dx, dy) = (x - xoffset, y - yoffset)
+			(x0, x1) = (max(0, -dx), min(width, width - dx))
+			if x0 >= x1:
+				continue
+			for row in range(max(0, -dy), min(height, height - dy)):
+				(srcrow, dstrow) = (plane[row + dy], result[row])
+				dstrow[x0 : x1] = [ acc + (weight * value) for (acc, value) in zip(dstrow[x0 : x1], srcrow[x0 + dx : x1 + dx]) ]
+		return result
+
+	@staticmethod
+	def _correlate_numpy(plane, taps, xoffset, yoffset):
+		"""Same as _correlate_python(), but operates on a 2D NumPy array."""
+		(height, width) = plane.shape
+		result = numpy.zeros(plane.shape, dtype = plane.dtype)
+		for (x, y, weight) in taps:
+			(dx, dy) = (x - xoffset, y - yoffset)
+			(x0, x1) = (max(0, -dx), min(width, width - dx))
+			(y0, y1) = (max(0, -dy), min(height, height - dy))
+			if (x0 < x1) and (y0 < y1):
+				result[y0 : y1, x0 : x1] += weight * plane[y0 + dy : y1 + dy, x0 + dx : x1 + dx]
+		return result
+
+	@staticmethod
+	def _correlate_fft(plane, stencil):
+		"""Zero padded correlation of a 2D NumPy array with the stencil through
+		FFT, which is fastest for large kernels."""
+		(height, width) = plane.shape
+		kernel = numpy.asarray(stencil.coeffs, dtype = numpy.float64).reshape(stencil.height, stencil.width)[::-1, ::-1]
+		shape = (height + stencil.height - 1, width + stencil.width - 1)
+		spectrum = numpy.fft.rfft2(plane, shape) * numpy.fft.rfft2(kernel, shape)
+		result = numpy.fft.irfft2(spectrum, shape)
+		return result[stencil.yoffset : stencil.yoffset + height, stencil.xoffset : stencil.xoffset + width]
+
+	@staticmethod
+	def _integerseparable(stencil):
+		"""Returns True if the stencil separates into integer 1D kernels, in
+		which case the "separable" engine is exact."""
+		separated = stencil.separate()
+		return (separated is not None) and all(isinstance(coeff, int) for coeffs in separated for coeff in coeffs)
+
+	def _selectengine(self, stencil, engine):
+		if engine == "auto":
+			# Only ever choose the engines that exactly match the reference.
+			# Two 1D passes need fewer operations than the direct engine for
+			# every kernel size, so there is no size limit.
+			if self._integerseparable(stencil):
+				engine = "separable"
+			else:
+				engine = "direct"
+		if (engine == "fft") and (numpy is None):
+			raise Exception("NumPy is required for FFT convolution.")
+		if (engine == "separable") and (stencil.separate() is None):
+			raise Exception("Stencil is not separable.")
+		return engine
+
+	@staticmethod
+	def _shiftround(value, shift):
+		"""Divides an integer (or integer NumPy array) by 2 ** shift and rounds
+		half to even, just like round() does after a true division."""
+		if shift == 0:
+			return value
+		(quotient, remainder, half) = (value >> shift, value & ((1 << shift) - 1), 1 << (shift - 1))
+		if numpy is not None and isinstance(value, numpy.ndarray):
+			return quotient + ((remainder > half) | ((remainder == half) & ((quotient & 1) == 1)))
+		return quotient + 1 if ((remainder > half) or ((remainder == half) and (quotient & 1))) else quotient
+
+	@staticmethod
+	def _fixedpointshift(stencil, engine):
+		"""Returns the shift if the engine can compute the stencil exactly in
+		integers (see FilterStencil.tofixedpoint()), None otherwise."""
+		if (engine == "direct") or ((engine == "separable") and PnmPicture._integerseparable(stencil)):
+			return stencil.fixedpointshift
+		return None
+
+	def _applystencil_numpy(self, stencil, engine):
+		pixels = self._pixelarray()
+		# Integer stencils with a power of two weightsum are computed exactly,
+		# without any floating point arithmetic
+		shift = self._fixedpointshift(stencil, engine)
+		for channel in range(self.channels):
+			plane = pixels[:, :, channel].astype(numpy.float64 if (shift is None) else numpy.int64)
+			if engine == "direct":
+				result = self._correlate_numpy(plane, stencil.taps, stencil.xoffset, stencil.yoffset)
+			elif engine == "separable":
+				(hcoeffs, vcoeffs) = stencil.separate()
+				result = self._correlate_numpy(plane, [ (x, 0, weight) for (x, weight) in enumerate(hcoeffs) ], stencil.xoffset, 0)
+				result = self._correlate_numpy(result, [ (0, y, weight) for (y, weight) in enumerate(vcoeffs) ], 0, stencil.yoffset)
+			else:
+				result = self._correlate_fft(plane, stencil)
+			if shift is None:
+				result = numpy.rint(result / stencil.weightsum)
+			else:
+				result = self._shiftround(result, shift)
+			pixels[:, :, channel] = numpy.clip(result, 0, self.maxval)
+		self._modified()
+
+	def _applystencil_python(self, stencil, engine):
+		samples = self._getsamples()
+		shift = self._fixedpointshift(stencil, engine)
+		for channel in range(self.channels):
+			channelsamples = samples[channel :: self.channels]
+			plane = [ channelsamples[y * self.width : (y + 1) * self.width] for y in range(self.height) ]
+			if engine == "direct":
+				result = self._correlate_python(plane, self.width, self.height, stencil.taps, stencil.xoffset, stencil.yoffset)
+			else:
+				(hcoeffs, vcoeffs) = stencil.separate()
+				result = self._correlate_python(plane, self.width, self.height, [ (x, 0, weight) for (x, weight) in enumerate(hcoeffs) ], stencil.xoffset, 0)
+				result = self._correlate_python(result, self.width, self.height, [ (0, y, weight) for (y, weight) in enumerate(vcoeffs) ], 0, stencil.yoffset)
+			if shift is None:
+				values = [ round(value / stencil.weightsum) for row in result for value in row ]
+			else:
+				values = [ self._shiftround(value, shift) for row in result for value in row ]
+			samples[channel :: self.channels] = array.array(samples.typecode, [ 0 if (value < 0) else self.maxval if (value > self.maxval) else value for value in values ])
+		self._data = self._packsamples(samples)
+
+	def applystencil(self, stencil, source, engine = "auto"):
+		"""Applies the stencil to the picture. Taps outside the picture are
+		skipped, the sum is divided by the stencil's weightsum, rounded and
+		clamped. The 'engine' can be "reference" (per pixel, just like
+		applystencilpixel()), "direct" (vectorized over the whole picture,
+		identical to the reference), "separable" (two 1D passes, only for
+		separable stencils), "fft" (requires NumPy) or "auto". "auto" only
+		ever chooses an engine that is identical to the reference: "separable"
+		for stencils which separate into integer kernels, "direct" for all
+		others. With non-integer coefficients, "separable" and "fft" may rarely
+		differ from the reference by one, due to floating point rounding, so
+		"auto" never uses them for float stencils such as
+		FilterStencil.getgaussian(). To get the two pass speedup for those,
+		either ask for engine "separable" explicitly or apply the integer
+		approximation from FilterStencil.tofixedpoint()."""
+		engine = self._selectengine(stencil, engine)
+		if engine == "reference":
+			copy = self.clone()
+			for x in range(self.width):
+				for y in range(self.height):
+					self.applystencilpixel(x, y, stencil, copy)
+		elif numpy is not None:
+			self._applystencil_numpy(stencil, engine)
+		else:
+			self._applystencil_python(stencil, engine)
 		return self
 
 	def __eq__(self, other):
-		return (self.width == other.width) and (self.height == other.height) and (self._data == other._data)
+		if not isinstance(other, PnmPicture):
+			return NotImplemented
+		if (self.width, self.height, self.channels, self.maxval) != (other.width, other.height, other.channels, other.maxval):
+			return False
+		if (self._digest is not None) and (other._digest is not None) and (not self._exported) and (not other._exported) and (self._digest != other._digest):
+			return False
+		return self._data == other._data
 
 	def __hash__(self):
-		return hash(self.data)
+		return int.from_bytes(self.digest()[:8], byteorder = "little")
 
 	def __iter__(self):
-		for i in range(0, len(self._data), 3):
-			yield (self._data[i + 0], self._data[i + 1], self._data[i + 2])
+		if self.samplesize == 1:
+			for i in range(0, len(self._data), self.channels):
+				yield tuple(self._data[i : i + self.channels])
+		else:
+			samples = self._getsamples()
+			for i in range(0, len(samples), self.channels):
+				yield tuple(samples[i : i + self.channels])
 
 	def __str__(self):
 		if self._data is None:
@@ -352,6 +1064,10 @@ class PnmPicture():
 
 
 class FilterStencil():
+	"""Convolution kernel. Stencils are treated as immutable, which is why the
+	ones returned by getgaussian() can be shared through a cache."""
+	_KERNEL_CACHE = { }
+
 	def __init__(self, width, height, coeffs):
 		assert((width % 2) == 1)
 		assert((height % 2) == 1)
@@ -359,6 +1075,12 @@ class FilterStencil():
 		self._height = height
 		self._coeffs = coeffs
 		self._sum = sum(coeff for coeff in coeffs if (coeff > 0))
+		self._separated = None
+		self._fixedpoint = { }
+		if all(isinstance(coeff, int) for coeff in coeffs) and (self._sum > 0) and ((self._sum & (self._sum - 1)) == 0):
+			self._shift = self._sum.bit_length() - 1
+		else:
+			self._shift = None
 	
 	@property
 	def width(self):
@@ -380,24 +1102,371 @@ class FilterStencil():
 	def weightsum(self):
 		return self._sum
 
+	@property
+	def coeffs(self):
+		return self._coeffs
+
+	@property
+	def fixedpointshift(self):
+		"""If all coefficients are integers and the weightsum is a power of
+		two, the division by the weightsum is a right shift by this many bits.
+		None otherwise."""
+		return self._shift
+
+	@property
+	def taps(self):
+		"""Returns all (x, y, weight) tuples in the order that
+		PnmPicture.applystencilpixel() accumulates them."""
+		return [ (x, y, self[(x, y)]) for x in range(self.width) for y in range(self.height) ]
+
+	def separate(self, rel_tolerance = 1e-9):
+		"""If the stencil is separable (i.e., it is the outer product of a
+		horizontal and a vertical 1D kernel), returns a tuple (hcoeffs,
+		vcoeffs) of these kernels. Returns None otherwise."""
+		if self._separated is None:
+			(pivotx, pivoty) = max(((x, y) for x in range(self.width) for y in range(self.height)), key = lambda pos: abs(self[pos]))
+			pivot = self[(pivotx, pivoty)]
+			if pivot == 0:
+				self._separated = False
+			else:
+				hcoeffs = [ self[(x, pivoty)] for x in range(self.width) ]
+				if all(isinstance(coeff, int) for coeff in self._coeffs):
+					# Dividing the row by its GCD makes both kernels integer
+					# for every separable integer stencil
+					divisor = functools.reduce(math.gcd, hcoeffs)
+					hcoeffs = [ coeff // divisor for coeff in hcoeffs ]
+					vcoeffs = [ self[(pivotx, y)] // hcoeffs[pivotx] for y in range(self.height) ]
+				else:
+					vcoeffs = [ self[(pivotx, y)] / pivot for y in range(self.height) ]
+				tolerance = rel_tolerance * abs(pivot)
+				separable = all(abs((hcoeffs[x] * vcoeffs[y]) - self[(x, y)]) <= tolerance for x in range(self.width) for y in range(self.height))
+				self._separated = (hcoeffs, vcoeffs) if separable else False
+		return self._separated or None
+
+	@staticmethod
+	def _quantize(coeffs, bits):
+		"""Scales coefficients to integers whose positive ones sum up to
+		exactly 2 ** bits. The rounding error is put on the largest one."""
+		total = sum(coeff for coeff in coeffs if (coeff > 0))
+		quantized = [ round(coeff * (1 << bits) / total) for coeff in coeffs ]
+		largest = max(range(len(coeffs)), key = lambda i: coeffs[i])
+		quantized[largest] += (1 << bits) - sum(coeff for coeff in quantized if (coeff > 0))
+		return quantized
+
+	def tofixedpoint(self, bits = 14):
+		"""Returns an integer approximation of the stencil whose weightsum is
+		2 ** bits, so that PnmPicture.applystencil() accumulates exactly in
+		integers and divides by a shift. Separable stencils without negative
+		coefficients stay separable: both 1D kernels are quantized on their
+		own and the result is their outer product."""
+		if bits not in self._fixedpoint:
+			separated = self.separate()
+			if (separated is not None) and all(coeff >= 0 for coeff in self._coeffs):
+				hcoeffs = self._quantize(separated[0], bits // 2)
+				vcoeffs = self._quantize(separated[1], bits - (bits // 2))
+				stencil = FilterStencil(self.width, self.height, [ hcoeffs[x] * vcoeffs[y] for y in range(self.height) for x in range(self.width) ])
+				stencil._separated = (hcoeffs, vcoeffs)
+			else:
+				stencil = FilterStencil(self.width, self.height, self._quantize(self._coeffs, bits))
+			self._fixedpoint[bits] = stencil
+		return self._fixedpoint[bits]
+
+	@staticmethod
 	def _gauss(x, sigma):
 		return (1 / (math.sqrt(2 * math.pi) * sigma)) * math.exp(-(x ** 2) / (2 * sigma ** 2))
 
-	def getgaussian(width):
+	@classmethod
+	def getgaussian(cls, width, sigma = None):
+		"""Returns a (2 * width + 1) square Gaussian kernel, by default with a
+		standard deviation of 'width'. Kernels are cached by shape and sigma,
+		every distinct distance is only evaluated once."""
 		assert(width > 0)
-		stencilwidth = (2 * width) + 1
-		coeffs = [ ]
-		for y in range(stencilwidth):
-			for x in range(stencilwidth):
-				dist = math.sqrt(((width - x) ** 2) + ((width - y) ** 2))
-				gauss = FilterStencil._gauss(dist, width)
-				coeffs.append(gauss)
-		return FilterStencil(stencilwidth, stencilwidth, coeffs)
+		if sigma is None:
+			sigma = width
+		key = ("gaussian", width, sigma)
+		if key not in cls._KERNEL_CACHE:
+			stencilwidth = (2 * width) + 1
+			values = { }
+			coeffs = [ ]
+			for y in range(stencilwidth):
+				for x in range(stencilwidth):
+					distance = tuple(sorted((abs(width - x), abs(width - y))))
+					if distance not in values:
+						values[distance] = cls._gauss(math.sqrt((distance[0] ** 2) + (distance[1] ** 2)), sigma)
+					coeffs.append(values[distance])
+			cls._KERNEL_CACHE[key] = FilterStencil(stencilwidth, stencilwidth, coeffs)
+		return cls._KERNEL_CACHE[key]
 
 	def __getitem__(self, pos):
 		(x, y) = pos
 		return self._coeffs[x + (y * self.width)]
 
+def _processband(source, destination, pixelformat, y0, y1, halo, operation, args, kwargs):
+	"""Copies rows y0 to y1 of the source buffer plus 'halo' rows above and
+	below into a band picture, applies the operation to it and writes the
+	resulting rows y0 to y1 into the destination buffer."""
+	(width, height, channels, maxval) = pixelformat
+	(h0, h1) = (max(0, y0 - halo), min(height, y1 + halo))
+	band = PnmPicture().new(width, h1 - h0, channels = channels, maxval = maxval)
+	rowsize = width * band.pixelsize
+	band._data[:] = source[h0 * rowsize : h1 * rowsize]
+	getattr(band, operation)(*args, **kwargs)
+	assert((band.width, band.height) == (width, h1 - h0))
+	with memoryview(band._data) as banddata:
+		destination[y0 * rowsize : y1 * rowsize] = banddata[(y0 - h0) * rowsize : (y1 - h0) * rowsize]
+
+def _processband_shm(source_name, destination_name, pixelformat, y0, y1, halo, operation, args, kwargs):
+	"""Process pool worker: like _processband(), but on shared memory."""
+	source = multiprocessing.shared_memory.SharedMemory(name = source_name)
+	destination = multiprocessing.shared_memory.SharedMemory(name = destination_name)
+	try:
+		_processband(source.buf, destination.buf, pixelformat, y0, y1, halo, operation, args, kwargs)
+	finally:
+		source.close()
+		destination.close()
+
+class PnmTileScheduler():
+	"""Applies PnmPicture operations which do not change the picture size to
+	row bands of a picture in parallel and stitches the results back together.
+	Operations which access neighboring pixels (stencils) need 'halo'
+	additional rows above and below every band. Threads work well with the
+	NumPy code paths, which release the GIL; processes (which use shared
+	memory and require Python 3.8) also parallelize pure Python code."""
+	def __init__(self, workers = None, processes = False, min_band_height = 16):
+		self._workers = workers or os.cpu_count() or 1
+		self._processes = processes
+		self._min_band_height = min_band_height
+
+	def _bands(self, height, halo):
+		band_height = max(self._min_band_height, 2 * halo, -(-height // (2 * self._workers)))
+		return [ (y0, min(height, y0 + band_height)) for y0 in range(0, height, band_height) ]
+
+	def apply(self, picture, operation, *args, halo = 0, **kwargs):
+		"""Applies the method called 'operation' of PnmPicture with the given
+		arguments to the picture, which is modified in place."""
+		pixelformat = (picture.width, picture.height, picture.channels, picture.maxval)
+		bands = self._bands(picture.height, halo)
+		if self._processes:
+			self._apply_processes(picture, pixelformat, bands, halo, operation, args, kwargs)
+		else:
+			self._apply_threads(picture, pixelformat, bands, halo, operation, args, kwargs)
+		return picture
+
+	def _apply_threads(self, picture, pixelformat, bands, halo, operation, args, kwargs):
+		# Without halo, every band only reads its own rows and can be written
+		# back in place
+		destination = picture._data if (halo == 0) else bytearray(len(picture._data))
+		with memoryview(picture._data) as source, memoryview(destination) as destination_view, concurrent.futures.ThreadPoolExecutor(max_workers = self._workers) as executor:
+			futures = [ executor.submit(_processband, source, destination_view, pixelformat, y0, y1, halo, operation, args, kwargs) for (y0, y1) in bands ]
+			for future in futures:
+				future.result()
+		picture._data = destination
+		picture._modified()
+
+	def _apply_processes(self, picture, pixelformat, bands, halo, operation, args, kwargs):
+		source = multiprocessing.shared_memory.SharedMemory(create = True, size = len(picture._data))
+		destination = source if (halo == 0) else multiprocessing.shared_memory.SharedMemory(create = True, size = len(picture._data))
+		try:
+			source.buf[:len(picture._data)] = picture._data
+			with concurrent.futures.ProcessPoolExecutor(max_workers = self._workers) as executor:
+				futures = [ executor.submit(_processband_shm, source.name, destination.name, pixelformat, y0, y1, halo, operation, args, kwargs) for (y0, y1) in bands ]
+				for future in futures:
+					future.result()
+			picture._data[:] = destination.buf[:len(picture._data)]
+			picture._modified()
+		finally:
+			for shm in set([ source, destination ]):
+				shm.close()
+				shm.unlink()
+
+	def applystencil(self, picture, stencil, engine = "auto"):
+		return self.apply(picture, "applystencil", stencil, None, halo = stencil.yoffset, engine = engine)
+
+	def multiply(self, picture, pixel):
+		return self.apply(picture, "multiply", pixel)
+
+	def blend(self, picture, pixel, opacity):
+		return self.apply(picture, "blend", pixel, opacity)
+
+	def invert(self, picture):
+		return self.apply(picture, "invert")
+
+class PnmStreamReader():
+	"""Reads a binary (P5 or P6) PNM file in bands of rows, so that pictures of
+	any size can be processed in bounded memory. Like PnmPicture.readfile(),
+	converts to 8 bit RGB unless 'native' is set."""
+	_MAX_HEADER_SIZE = 64 * 1024
+
+	def __init__(self, filename, native = False):
+		self._f = open(filename, "rb")
+		header = b""
+		while True:
+			chunk = self._f.read(4096)
+			header += chunk
+			try:
+				(metadata, offset) = PnmPicture._parseheader(header)
+				break
+			except Exception:
+				if (len(chunk) == 0) or (len(header) > self._MAX_HEADER_SIZE):
+					raise
+		assert(metadata["format"] in [ "P5", "P6" ])
+		if not native:
+			assert(metadata["bpp"] == 255)
+		(self._width, self._height) = [ int(s) for s in metadata["geometry"].split() ]
+		self._filechannels = 3 if (metadata["format"] == "P6") else 1
+		self._channels = 3 if (not native) else self._filechannels
+		self._maxval = metadata["bpp"]
+		self._rowsize = self._width * self._filechannels * (1 if (self._maxval < 256) else 2)
+		self._nextrow = 0
+		self._f.seek(offset)
+
+	@property
+	def width(self):
+		return self._width
+
+	@property
+	def height(self):
+		return self._height
+
+	@property
+	def channels(self):
+		return self._channels
+
+	@property
+	def maxval(self):
+		return self._maxval
+
+	@property
+	def nextrow(self):
+		return self._nextrow
+
+	def readrows(self, count):
+		"""Returns a picture of the next 'count' rows (fewer at the end of the
+		file) or None if all rows have been read."""
+		count = min(count, self._height - self._nextrow)
+		if count <= 0:
+			return None
+		band = PnmPicture().new(self._width, count, channels = self._filechannels, maxval = self._maxval)
+		if self._f.readinto(band._data) != len(band._data):
+			raise Exception("Truncated PNM file.")
+		self._nextrow += count
+		if self._channels != self._filechannels:
+			band._data = PnmPicture._expandgray(band._data)
+			band._channels = 3
+		return band
+
+	def bands(self, band_height):
+		while True:
+			band = self.readrows(band_height)
+			if band is None:
+				break
+			yield band
+
+	def close(self):
+		self._f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+class PnmStreamWriter():
+	"""Writes a binary PNM file band by band."""
+	def __init__(self, filename, width, height, channels = 3, maxval = 255):
+		self._f = open(filename, "wb")
+		(self._width, self._height, self._channels, self._maxval) = (width, height, channels, maxval)
+		self._rows = 0
+		self._f.write(PnmPicture._writeheader("P6" if (channels == 3) else "P5", width, height, maxval))
+
+	def write(self, band):
+		assert((band.width, band.channels, band.maxval) == (self._width, self._channels, self._maxval))
+		assert(self._rows + band.height <= self._height)
+		self._f.write(band._data)
+		self._rows += band.height
+		return self
+
+	def close(self):
+		self._f.close()
+		if self._rows != self._height:
+			raise Exception("Incomplete PNM file written: %d of %d rows." % (self._rows, self._height))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		if type is None:
+			self.close()
+		else:
+			self._f.close()
+
+class PnmStreamProcessor():
+	"""Processes a binary PNM file into another in bands of rows, holding at
+	most 'band_height' plus twice the halo rows in memory at any time. The
+	function applied to every band must not change its size, but may change
+	its pixel format (e.g., extract a channel)."""
+	def __init__(self, infilename, outfilename, band_height = 64, native = False):
+		self._infilename = infilename
+		self._outfilename = outfilename
+		self._band_height = band_height
+		self._native = native
+
+	def map(self, function, halo = 0):
+		"""Calls function(band) for every band, which has 'halo' additional
+		rows (where available) above and below. function may modify the band in
+		place or return a new picture."""
+		with PnmStreamReader(self._infilename, native = self._native) as reader:
+			writer = None
+			# Rolling window of input rows, starting at row window_start
+			window = bytearray()
+			window_start = 0
+			try:
+				for y0 in range(0, reader.height, self._band_height):
+					y1 = min(reader.height, y0 + self._band_height)
+					while reader.nextrow < min(reader.height, y1 + halo):
+						window += reader.readrows(min(reader.height, y1 + halo) - reader.nextrow)._data
+
+					band_start = max(0, y0 - halo)
+					rowsize = len(window) // (reader.nextrow - window_start)
+					del window[ : (band_start - window_start) * rowsize]
+					window_start = band_start
+
+					band = PnmPicture().new(reader.width, reader.nextrow - band_start, channels = reader.channels, maxval = reader.maxval)
+					band._data[:] = window
+					result = function(band)
+					if result is None:
+						result = band
+					assert((result.width, result.height) == (band.width, band.height))
+
+					if writer is None:
+						writer = PnmStreamWriter(self._outfilename, reader.width, reader.height, channels = result.channels, maxval = result.maxval)
+					writer.write(result.getsubpicture(0, y0 - band_start, result.width, y1 - y0))
+			except BaseException:
+				# Do not leave a truncated output file behind
+				if writer is not None:
+					writer._f.close()
+					with contextlib.suppress(FileNotFoundError):
+						os.unlink(self._outfilename)
+				raise
+		if writer is not None:
+			writer.close()
+		return self
+
+	def invert(self):
+		return self.map(lambda band: band.invert())
+
+	def multiply(self, pixel):
+		return self.map(lambda band: band.multiply(pixel))
+
+	def blend(self, pixel, opacity):
+		return self.map(lambda band: band.blend(pixel, opacity))
+
+	def getchannel(self, channel):
+		return self.map(lambda band: band.getchannel(channel))
+
+	def applystencil(self, stencil, engine = "auto"):
+		return self.map(lambda band: band.applystencil(stencil, None, engine = engine), halo = stencil.yoffset)
+
 if __name__ == "__main__":
 #	pic = PnmPicture()
 #	pic.readfile("test_rgb_bin.pnm")
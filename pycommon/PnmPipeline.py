@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#
+#	PnmPipeline - Lazy, fusing pipeline of PnmPicture operations
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import fnmatch
+import collections
+import concurrent.futures
+from .PnmPicture import PnmPicture
+from .PictureCodecs import readpicture, writepicture, supportsalpha
+
+# Module level so that pipelines can be pickled for worker processes
+_PipelineStep = collections.namedtuple("_PipelineStep", [ "operation", "args", "kwargs" ])
+
+class PnmPipeline():
+	"""Records PnmPicture operations and applies them later on. Consecutive
+	point operations (multiply, blend, lighten, darken, invert) are fused into
+	a single lookup table per channel, so that the picture data is only passed
+	over once for all of them; the result is identical to applying them one
+	after another. Other operations are called as they are. Every recording
+	method returns a new pipeline, so pipelines can be shared and extended."""
+	_POINT_OPERATIONS = set([ "multiply", "blend", "lighten", "darken", "invert" ])
+
+	def __init__(self, steps = None):
+		self._steps = tuple(steps) if (steps is not None) else tuple()
+
+	@property
+	def steps(self):
+		return self._steps
+
+	def then(self, operation, *args, **kwargs):
+		"""Records a call of the PnmPicture method called 'operation'."""
+		if not hasattr(PnmPicture, operation):
+			raise Exception("PnmPicture has no operation '%s'." % (operation))
+		return PnmPipeline(self._steps + (_PipelineStep(operation = operation, args = args, kwargs = kwargs), ))
+
+	def multiply(self, pixel):
+		return self.then("multiply", pixel)
+
+	def blend(self, pixel, opacity):
+		return self.then("blend", pixel, opacity)
+
+	def lighten(self, opacity, maxopacity = 1):
+		return self.then("lighten", opacity, maxopacity)
+
+	def darken(self, opacity, maxopacity = 1):
+		return self.then("darken", opacity, maxopacity)
+
+	def invert(self):
+		return self.then("invert")
+
+	def rotate(self, degrees):
+		return self.then("rotate", degrees)
+
+	def resize(self, width, height, method = "box"):
+		return self.then("resize", width, height, method = method)
+
+	def applystencil(self, stencil, engine = "auto"):
+		return self.then("applystencil", stencil, None, engine = engine)
+
+	def _segments(self):
+		"""Yields lists of consecutive point operations and single other
+		steps."""
+		points = [ ]
+		for step in self._steps:
+			if step.operation in self._POINT_OPERATIONS:
+				points.append(step)
+			else:
+				if len(points) > 0:
+					yield points
+					points = [ ]
+				yield step
+		if len(points) > 0:
+			yield points
+
+	@staticmethod
+	def _fuseluts(picture, steps):
+		"""Composes the lookup tables of all point operations into one per
+		channel."""
+		luts = [ list(range(picture.maxval + 1)) for channel in range(picture.channels) ]
+		for step in steps:
+			steplut = getattr(picture, "_luts_" + step.operation)(*step.args, **step.kwargs)
+			luts = [ [ channellut[value] for value in lut ] for (lut, channellut) in zip(luts, steplut) ]
+		return luts
+
+	def apply(self, picture, scheduler = None):
+		"""Applies the pipeline to the picture and returns the result. Where
+		operations work in place (all point operations do), the picture itself
+		is modified. If a PnmTileScheduler is given, the fused point operations
+		are processed in parallel bands."""
+		for segment in self._segments():
+			if isinstance(segment, list):
+				luts = self._fuseluts(picture, segment)
+				if scheduler is not None:
+					scheduler.apply(picture, "_applyluts", luts)
+				else:
+					picture._applyluts(luts)
+			else:
+				result = getattr(picture, segment.operation)(*segment.args, **segment.kwargs)
+				if isinstance(result, PnmPicture):
+					picture = result
+		return picture
+
+	def _applyalpha(self, alpha):
+		"""Applies only the steps that are not point operations to an alpha
+		channel, so that it keeps matching the picture geometry."""
+		return PnmPipeline(step for step in self._steps if step.operation not in self._POINT_OPERATIONS).apply(alpha)
+
+	def processfile(self, infilename, outfilename):
+		"""Reads a picture (PNM, PAM, PNG or QOI), applies the pipeline and
+		writes it in the format given by the output file extension. An alpha
+		channel is carried along where the output format supports it."""
+		(picture, alpha) = readpicture(infilename)
+		picture = self.apply(picture)
+		if (alpha is not None) and supportsalpha(outfilename):
+			alpha = self._applyalpha(alpha)
+		else:
+			alpha = None
+		writepicture(outfilename, picture, alpha)
+		return outfilename
+
+	def processdirectory(self, indir, outdir, pattern = "*", extension = None, workers = None, processes = True):
+		"""Runs all files in 'indir' that match the pattern through the
+		pipeline in parallel and writes them to 'outdir', optionally changing
+		the file extension (e.g., to ".png"). Returns the list of written
+		files."""
+		jobs = [ ]
+		for filename in sorted(os.listdir(indir)):
+			infilename = os.path.join(indir, filename)
+			if fnmatch.fnmatch(filename, pattern) and os.path.isfile(infilename):
+				if extension is not None:
+					filename = os.path.splitext(filename)[0] + extension
+				jobs.append((infilename, os.path.join(outdir, filename)))
+		os.makedirs(outdir, exist_ok = True)
+
+		executor_class = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+		with executor_class(max_workers = workers or os.cpu_count() or 1) as executor:
+			futures = [ executor.submit(self.processfile, infilename, outfilename) for (infilename, outfilename) in jobs ]
+			return [ future.result() for future in futures ]
+
+	def __str__(self):
+		return "PnmPipeline<%s>" % (" -> ".join(step.operation for step in self._steps))
+
+if __name__ == "__main__":
+	import sys
+	pipeline = PnmPipeline().multiply((255, 128, 64)).blend((0, 0, 255), 0.25).invert()
+	print(pipeline)
+	for filename in pipeline.processdirectory(sys.argv[1], sys.argv[2], extension = ".png"):
+		print(filename)
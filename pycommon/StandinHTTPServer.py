@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+#	StandinHTTPServer - Local HTTP server serving canned responses
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+class StandinHTTPServer():
+	"""Serves canned responses on localhost from a background thread. Useful
+	as a stand-in for a remote server in tests and benchmarks. Routes map a
+	(verb, path) tuple or just a path to either a Response or a callable which
+	receives the Request and returns a Response. Use as a context manager."""
+	Request = collections.namedtuple("Request", [ "verb", "path", "query", "headers", "body" ])
+	Response = collections.namedtuple("Response", [ "status_code", "headers", "content" ])
+
+	def __init__(self, routes = None, host = "127.0.0.1", port = 0):
+		self._routes = { } if (routes is None) else dict(routes)
+		self._lock = threading.Lock()
+		self._request_count = 0
+		self._server = _ThreadingHTTPServer((host, port), self._create_handler_class())
+		self._thread = None
+
+	@property
+	def url(self):
+		(host, port) = self._server.server_address[:2]
+		return "http://%s:%d" % (host, port)
+
+	@property
+	def request_count(self):
+		with self._lock:
+			return self._request_count
+
+	def add_route(self, path, response, verb = None):
+		key = path if (verb is None) else (verb, path)
+		with self._lock:
+			self._routes[key] = response
+		return self
+
+	def _lookup(self, request):
+		with self._lock:
+			self._request_count += 1
+			response = self._routes.get((request.verb, request.path))
+			if response is None:
+				response = self._routes.get(request.path)
+		if response is None:
+			return self.Response(status_code = 404, headers = { }, content = b"Not found")
+		if callable(response):
+			response = response(request)
+		if isinstance(response, bytes):
+			response = self.Response(status_code = 200, headers = { }, content = response)
+		return response
+
+	def _create_handler_class(self):
+		server = self
+		class _Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def _handle(self):
+				url = urllib.parse.urlsplit(self.path)
+				content_length = int(self.headers.get("Content-Length", 0))
+				body = self.rfile.read(content_length) if (content_length > 0) else None
+				request = server.Request(verb = self.command, path = url.path, query = urllib.parse.parse_qsl(url.query), headers = dict(self.headers), body = body)
+				response = server._lookup(request)
+				self.send_response(response.status_code)
+				for (key, value) in response.headers.items():
+					self.send_header(key, value)
+				self.send_header("Content-Length", str(len(response.content)))
+				self.end_headers()
+				self.wfile.write(response.content)
+
+			do_GET = _handle
+			do_POST = _handle
+			do_PUT = _handle
+			do_DELETE = _handle
+
+			def log_message(self, format, *args):
+				pass
+		return _Handler
+
+	def start(self):
+		self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+		self._thread.join()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, type, value, traceback):
+		self.stop()
+
+if __name__ == "__main__":
+	import urllib.request
+	with StandinHTTPServer({ "/hello": b"Hello world" }) as server:
+		print(urllib.request.urlopen(server.url + "/hello").read())
+		print("%d requests served" % (server.request_count))
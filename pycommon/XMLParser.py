@@ -117,6 +117,13 @@ class XMLNode():
 		self._children.append(node)
 		return node
 	
+	def clear(self):
+		"""Removes all children, attributes and cdata of the node, e.g. to
+		release a processed subtree that is still referenced elsewhere."""
+		self._attrs = { }
+		self._children = [ ]
+		return self
+
 	def getallchildren(self):
 		"""Return an iterator over all children."""
 		return iter(self._children)
@@ -395,16 +402,36 @@ class XMLNode():
 
 class XMLParser():
 	"""Parses an XML document using expat and returns a DOM representation with
-	a XMLNode root node."""
+	a XMLNode root node. Alternatively, iterparse() yields matching subtrees
+	while the document is parsed, so that huge documents can be processed in
+	constant memory. Documents may also be passed in arbitrary chunks through
+	feed() and close(). A parser can be reused for any number of documents
+	one after another."""
 	def __init__(self):
+		self._match = (None, False, { })
+		self._reset()
+
+	def _reset(self):
+		"""Prepares a new expat parser for the next document. The match
+		conditions are those of setmatch(), iterparse() only sets its own for
+		the document it parses."""
 		self._rootnode = None
 		self._curnode = None
+		self._usematch(*self._match)
+		self._used = False
+		self._feeding = False
 
-		self._parser = xml.parsers.expat.ParserCreate()			
+		self._parser = xml.parsers.expat.ParserCreate()
 		self._parser.StartElementHandler = self._startElementHandler
 		self._parser.EndElementHandler = self._endElementHandler
 		self._parser.CharacterDataHandler = self._cDataHandler
 
+	def _begin(self):
+		"""Starts a new document, resetting the parser if it was used before."""
+		if self._used:
+			self._reset()
+		self._used = True
+
 	def _startElementHandler(self, nodename, nodeattrs):
 		newNode = XMLNode(nodename, nodeattrs, self._curnode, self._parser.CurrentLineNumber)
 		if self._curnode is None:
@@ -418,26 +445,167 @@ class XMLParser():
 	def _endElementHandler(self, nodename):
 		if nodename != self._curnode.getname():
 			raise XMLException("Invalid XML, expected </%s>, but encountered </%s>." % (self._curnode.getname(), nodename))
+		if (self._matcher is not None) and self._pathmatch(self._curnode):
+			self._matches.append(self._curnode)
 		self._curnode = self._curnode.getparent()
 
+	def _pathmatch(self, node):
+		"""Returns True if the node matches the nodename or path and attribute
+		conditions given to iterparse()."""
+		(names, anchored, attrs) = self._matcher
+		if not node._nodematch(names[-1], **attrs):
+			return False
+		for name in reversed(names[:-1]):
+			node = node.getparent()
+			if (node is None) or (node.getname() != name):
+				return False
+		return (not anchored) or (node.getparent() is None)
+
+	@staticmethod
+	def _discard(node):
+		"""Removes the node from the tree together with everything before it
+		in document order that is completely parsed by now, i.e., the
+		preceding siblings of the node and of all of its ancestors."""
+		(child, inclusive) = (node, True)
+		while child.getparent() is not None:
+			parent = child.getparent()
+			for (index, sibling) in enumerate(parent._children):
+				if sibling is child:
+					del parent._children[ : index + (1 if inclusive else 0)]
+					break
+			else:
+				# Already removed along with a previous node
+				break
+			(child, inclusive) = (parent, False)
+
 	def _cDataHandler(self, cdata):
 		self._curnode.appendcdata(cdata)
 	
+	def _parsechunk(self, data, final):
+		"""Passes data on to expat and returns the list of nodes that match
+		the setmatch() conditions and were completed by this data. Nodes
+		returned by the previous call are discarded first if requested."""
+		if self._clear:
+			for node in self._returned:
+				self._discard(node)
+		try:
+			self._parser.Parse(data, final)
+		except Exception:
+			self._feeding = False
+			raise
+		(self._returned, self._matches) = (self._matches, [ ])
+		return self._returned
+
+	def _usematch(self, nodename, clear, attrs):
+		if nodename is None:
+			self._matcher = None
+		else:
+			self._matcher = (nodename.strip("/").split("/"), nodename.startswith("/"), attrs)
+		self._clear = clear and (nodename is not None)
+		self._matches = [ ]
+		self._returned = [ ]
+
+	def setmatch(self, nodename, clear = True, **attrs):
+		"""Sets the conditions for nodes returned by feed(), see iterparse()
+		for details. The conditions apply to the current and all following
+		documents; a nodename of None removes them."""
+		self._match = (nodename, clear, attrs)
+		self._usematch(*self._match)
+
+	def feed(self, data):
+		"""Parses the next chunk (bytes or str) of a document, which may end
+		anywhere, even within a tag or a multibyte character. The first chunk
+		after close() starts a new document. Returns the list of nodes
+		completed by this chunk that match the setmatch() conditions (an empty
+		list if none were set). With 'clear' set, these are removed from the
+		tree on the next feed() or close()."""
+		if not self._feeding:
+			self._begin()
+			self._feeding = True
+		return self._parsechunk(data, False)
+
+	def close(self):
+		"""Finishes the document passed in by feed() and returns the root
+		node. Raises an exception if the document is incomplete."""
+		if not self._feeding:
+			self._begin()
+		self._feeding = False
+		self._parsechunk(b"", True)
+		return self._rootnode
+
 	def parsehandle(self, filehdl):
 		"""Parse the given file handle, which has to be opened in binary mode
 		(e.g. sys.stdin.buffer) and return the root node."""
+		self._begin()
 		self._parser.ParseFile(filehdl)
 		return self._rootnode
 
 	def parsefile(self, filename):
 		"""Parse the given XML file and return the root node."""
-		return self.parsehandle(open(filename, "rb"))
-	
+		with open(filename, "rb") as f:
+			return self.parsehandle(f)
+
 	def parse(self, xmltext):
 		"""Parse the given XML text and return the root node."""
-		self._parser.Parse(xmltext)
+		self._begin()
+		self._parser.Parse(xmltext, True)
 		return self._rootnode
 
+	def iterparse(self, filehdl, nodename, clear = True, chunksize = 64 * 1024, **attrs):
+		"""Parses the given binary file handle chunk by chunk and yields every
+		node that has the specified nodename and satisfies all kwargs
+		conditions for attributes as soon as its end tag has been parsed.
+		Instead of a plain nodename, a slash separated path of node names may
+		be given (e.g. "records/record"), which must match the last ancestors
+		of the node; a leading slash anchors the path at the root node. The
+		yielded node is a complete subtree with all of its children and
+		cdata and its ancestors are accessible through getparent(). If
+		'clear' is set, the node and all preceding siblings of it and of its
+		ancestors are removed from the tree once the nodes of the current
+		chunk have been consumed, so memory usage does not depend on the
+		document size."""
+		self._begin()
+		self._usematch(nodename, clear, attrs)
+		while True:
+			chunk = filehdl.read(chunksize)
+			for node in self._parsechunk(chunk, len(chunk) == 0):
+				yield node
+			if len(chunk) == 0:
+				break
+
+	def iterparsefile(self, filename, nodename, clear = True, chunksize = 64 * 1024, **attrs):
+		"""Like iterparse(), but for the given XML file."""
+		with open(filename, "rb") as f:
+			for node in self.iterparse(f, nodename, clear, chunksize, **attrs):
+				yield node
+
+	async def parseasync(self, reader, chunksize = 64 * 1024):
+		"""Parses the document read from an asyncio.StreamReader (or any other
+		object with a read(n) coroutine) as it arrives and returns the root
+		node."""
+		while True:
+			chunk = await reader.read(chunksize)
+			if len(chunk) == 0:
+				return self.close()
+			self.feed(chunk)
+
+	async def iterparseasync(self, reader, nodename, clear = True, chunksize = 64 * 1024, **attrs):
+		"""Like iterparse(), but asynchronously iterates over the matching
+		nodes of a document read from an asyncio.StreamReader (or any other
+		object with a read(n) coroutine)."""
+		self._begin()
+		self._feeding = True
+		self._usematch(nodename, clear, attrs)
+		while True:
+			chunk = await reader.read(chunksize)
+			if len(chunk) == 0:
+				break
+			for node in self.feed(chunk):
+				yield node
+		self._feeding = False
+		for node in self._parsechunk(b"", True):
+			yield node
+
 	def getrootnode(self):
 		"""Returns the root node of the parsed XML tree."""
 		return self._rootnode
@@ -0,0 +1,379 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import gc
+import os
+import asyncio
+import time
+import weakref
+import tempfile
+import threading
+import unittest
+from pycommon.CacheDecorator import cacheresult, MemoryCacheBackend, SQLiteCacheBackend, PickleDirectoryCacheBackend
+
+class CacheDecoratorTests(unittest.TestCase):
+	def setUp(self):
+		self._calls = [ ]
+
+	def _square(self, x):
+		self._calls.append(x)
+		return x * x
+
+	def test_no_timeout(self):
+		square = cacheresult()(self._square)
+		self.assertEqual(square(3), 9)
+		self.assertEqual(square(3), 9)
+		self.assertEqual(square(4), 16)
+		self.assertEqual(self._calls, [ 3, 4 ])
+		self.assertEqual(square.cache_info().hits, 1)
+		self.assertEqual(square.cache_info().misses, 2)
+		self.assertEqual(square.cache_info().currsize, 2)
+
+	def test_timeout(self):
+		square = cacheresult(timeout = 0.05)(self._square)
+		square(3)
+		square(3)
+		time.sleep(0.1)
+		square(3)
+		self.assertEqual(self._calls, [ 3, 3 ])
+
+	def test_lazy_purge(self):
+		square = cacheresult(timeout = 0.05)(self._square)
+		for i in range(200):
+			square(i)
+		time.sleep(0.1)
+		for i in range(1000, 1200):
+			square(i)
+		self.assertLess(square.cache_info().currsize, 400)
+
+	def test_lru_eviction(self):
+		square = cacheresult(maxsize = 2)(self._square)
+		square(1)
+		square(2)
+		square(1)
+		square(3)
+		self.assertEqual(square.cache_info().currsize, 2)
+		square(1)
+		self.assertEqual(self._calls, [ 1, 2, 3 ])
+		square(2)
+		self.assertEqual(self._calls, [ 1, 2, 3, 2 ])
+
+	def test_clear(self):
+		square = cacheresult()(self._square)
+		square(3)
+		square.cache_clear()
+		self.assertEqual(square.cache_info().currsize, 0)
+		square(3)
+		self.assertEqual(self._calls, [ 3, 3 ])
+
+	def test_wraps(self):
+		@cacheresult(timeout = 10)
+		def foo():
+			"""Docstring"""
+			pass
+		self.assertEqual(foo.__name__, "foo")
+		self.assertEqual(foo.__doc__, "Docstring")
+
+	def test_kwargs(self):
+		@cacheresult()
+		def foo(a, x = 0, y = 0):
+			self._calls.append((a, x, y))
+			return a + x + y
+		self.assertEqual(foo(1, x = 2), 3)
+		self.assertEqual(foo(1, x = 3), 4)
+		self.assertEqual(foo(1, x = 3, y = 1), 5)
+		self.assertEqual(foo(1, y = 1, x = 3), 5)
+		self.assertEqual(self._calls, [ (1, 2, 0), (1, 3, 0), (1, 3, 1) ])
+
+	def test_no_stampede(self):
+		lock = threading.Lock()
+		@cacheresult()
+		def slow(x):
+			with lock:
+				self._calls.append(x)
+			time.sleep(0.05)
+			return x * 2
+
+		results = [ ]
+		def worker():
+			results.append(slow(21))
+		threads = [ threading.Thread(target = worker) for i in range(8) ]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results, [ 42 ] * 8)
+		self.assertEqual(self._calls, [ 21 ])
+
+	def test_exception_not_cached(self):
+		@cacheresult()
+		def fails(x):
+			self._calls.append(x)
+			raise ValueError(x)
+		with self.assertRaises(ValueError):
+			fails(1)
+		with self.assertRaises(ValueError):
+			fails(1)
+		self.assertEqual(self._calls, [ 1, 1 ])
+
+	def test_recursion(self):
+		@cacheresult()
+		def factorial(n):
+			self._calls.append(n)
+			return 1 if (n == 0) else n * factorial(n - 1)
+		self.assertEqual(factorial(5), 120)
+		self.assertEqual(factorial(6), 720)
+		self.assertEqual(self._calls, [ 5, 4, 3, 2, 1, 0, 6 ])
+
+		@cacheresult()
+		def endless(n):
+			return endless(n)
+		with self.assertRaisesRegex(Exception, "Recursive call"):
+			endless(1)
+		with self.assertRaisesRegex(Exception, "Recursive call"):
+			endless(1)
+
+	def test_method(self):
+		class Counter():
+			def __init__(self, start):
+				self._value = start
+
+			@cacheresult(method = True)
+			def next(self, increment = 1):
+				self._value += increment
+				return self._value
+
+		(a, b) = (Counter(0), Counter(100))
+		self.assertEqual(a.next(), 1)
+		self.assertEqual(a.next(), 1)
+		self.assertEqual(b.next(), 101)
+		self.assertEqual(a.next(increment = 5), 6)
+		self.assertEqual(Counter.next.cache_info(a).currsize, 2)
+		self.assertEqual(Counter.next.cache_info(b).currsize, 1)
+		Counter.next.cache_clear(a)
+		self.assertEqual(a.next(), 7)
+
+		ref = weakref.ref(a)
+		del a
+		gc.collect()
+		self.assertIsNone(ref())
+
+	def test_method_unhashable(self):
+		class Unhashable():
+			__hash__ = None
+
+			@cacheresult(method = True)
+			def value(self):
+				self.calls = getattr(self, "calls", 0) + 1
+				return self.calls
+
+		obj = Unhashable()
+		self.assertEqual(obj.value(), 1)
+		self.assertEqual(obj.value(), 1)
+
+	def test_method_equal_instances(self):
+		class Named():
+			def __init__(self, name):
+				self.name = name
+
+			def __eq__(self, other):
+				return True
+
+			def __hash__(self):
+				return hash(self.name)
+
+			@cacheresult(method = True)
+			def who(self):
+				return self.name
+
+		(a, b) = (Named("a"), Named("b"))
+		self.assertEqual((a.who(), b.who()), ("a", "b"))
+		a.name = "changed"
+		self.assertEqual(a.who(), "a")
+		self.assertEqual(Named.who.cache_info(a).currsize, 1)
+
+	def test_method_slots(self):
+		class Slotted():
+			__slots__ = [ "calls" ]
+
+			def __init__(self):
+				self.calls = 0
+
+			@cacheresult(method = True)
+			def value(self):
+				self.calls += 1
+				return self.calls
+
+		class WeakSlotted(Slotted):
+			__slots__ = [ "__weakref__" ]
+
+		obj = WeakSlotted()
+		self.assertEqual((obj.value(), obj.value()), (1, 1))
+		ref = weakref.ref(obj)
+		del obj
+		gc.collect()
+		self.assertIsNone(ref())
+
+		with self.assertRaises(TypeError):
+			Slotted().value()
+
+	def _test_persistent_backend(self, new_backend):
+		backends = [ ]
+		def create_backend():
+			backends.append(new_backend())
+			return backends[-1]
+		try:
+			self._run_persistent_backend(create_backend)
+		finally:
+			for backend in backends:
+				backend.close()
+
+	def _run_persistent_backend(self, create_backend):
+		def square(x):
+			self._calls.append(x)
+			return x * x
+		square.__qualname__ = "square"
+
+		first = cacheresult(timeout = 10, backend = create_backend())(square)
+		self.assertEqual(first(3), 9)
+		self.assertEqual(first(3), 9)
+		self.assertEqual(first(x = 3), 9)
+
+		# A fresh decorated function with a new backend instance (as in another
+		# process) sees the stored results
+		second = cacheresult(timeout = 10, backend = create_backend())(square)
+		self.assertEqual(second(3), 9)
+		self.assertEqual(second(x = 3), 9)
+		self.assertEqual(self._calls, [ 3, 3 ])
+		self.assertEqual(second.cache_info().currsize, 2)
+
+		expired = cacheresult(timeout = 0, backend = create_backend())(square)
+		time.sleep(0.01)
+		self.assertEqual(expired(3), 9)
+		self.assertEqual(self._calls, [ 3, 3, 3 ])
+
+		second.cache_clear()
+		self.assertEqual(second.cache_info().currsize, 0)
+
+		# Functions sharing a backend do not clear, purge or count each other's
+		# results
+		def cube(x):
+			self._calls.append(x)
+			return x * x * x
+		cube.__qualname__ = "cube"
+		short = cacheresult(timeout = 0, backend = create_backend())(square)
+		forever = cacheresult(backend = create_backend())(cube)
+		self._calls = [ ]
+		self.assertEqual((short(2), forever(2)), (4, 8))
+		self.assertEqual((short.cache_info().currsize, forever.cache_info().currsize), (1, 1))
+		short.cache_clear()
+		self.assertEqual(forever(2), 8)
+		self.assertEqual((short.cache_info().currsize, forever.cache_info().currsize), (0, 1))
+
+		# Enough stores of the expiring function to trigger a purge
+		time.sleep(0.01)
+		for x in range(128):
+			short(x)
+		self.assertLess(short.cache_info().currsize, 128)
+		self.assertEqual(forever(2), 8)
+		self.assertEqual(forever.cache_info().currsize, 1)
+		self.assertEqual(self._calls, [ 2, 2 ] + list(range(128)))
+
+	def test_sqlite_backend(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, "cache.sqlite3")
+			self._test_persistent_backend(lambda: SQLiteCacheBackend(filename))
+
+			backend = SQLiteCacheBackend(filename)
+			threads = [ threading.Thread(target = backend.put, args = ("namespace", "key%d" % (i), 0, i)) for i in range(4) ]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			self.assertEqual(backend.count("namespace"), 4)
+			self.assertEqual(backend.count("other"), 0)
+			backend.close()
+
+	def test_backend_io_outside_lock(self):
+		class SlowBackend(MemoryCacheBackend):
+			def __init__(self):
+				MemoryCacheBackend.__init__(self)
+				self.storing = threading.Event()
+				self.release = threading.Event()
+
+			def put(self, namespace, key, timestamp, result):
+				if key == (1000, ):
+					self.storing.set()
+					self.release.wait(5)
+				MemoryCacheBackend.put(self, namespace, key, timestamp, result)
+
+		backend = SlowBackend()
+		square = cacheresult(backend = backend)(self._square)
+		thread = threading.Thread(target = square, args = (1000, ))
+		thread.start()
+		try:
+			self.assertTrue(backend.storing.wait(5))
+			# While one thread is stuck storing its result, other keys work
+			self.assertEqual(square(3), 9)
+			self.assertEqual(square(3), 9)
+			self.assertFalse(backend.release.is_set())
+		finally:
+			backend.release.set()
+			thread.join()
+		self.assertEqual(square.cache_info().hits, 1)
+		self.assertEqual(square.cache_info().currsize, 2)
+
+	def test_pickle_directory_backend(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			self._test_persistent_backend(lambda: PickleDirectoryCacheBackend(tmpdir))
+
+	def test_coroutine(self):
+		@cacheresult()
+		async def remote_square(x):
+			self._calls.append(x)
+			await asyncio.sleep(0.01)
+			return x * x
+
+		async def main():
+			first = await asyncio.gather(*[ remote_square(5) for i in range(10) ])
+			second = await remote_square(5)
+			return (first, second)
+
+		loop = asyncio.new_event_loop()
+		try:
+			(first, second) = loop.run_until_complete(main())
+		finally:
+			loop.close()
+		self.assertEqual(first, [ 25 ] * 10)
+		self.assertEqual(second, 25)
+		self.assertEqual(self._calls, [ 5 ])
+
+	def test_coroutine_recursion(self):
+		@cacheresult()
+		async def endless(x):
+			return await endless(x)
+
+		loop = asyncio.new_event_loop()
+		try:
+			with self.assertRaisesRegex(Exception, "Recursive call"):
+				loop.run_until_complete(asyncio.wait_for(endless(1), 5))
+		finally:
+			loop.close()
@@ -0,0 +1,173 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import io
+import os
+import json
+import time
+import tempfile
+import unittest
+from pycommon.CachedRequests import CachedRequests, CachedRequestsMode, CacheMissException
+from pycommon.StandinHTTPServer import StandinHTTPServer
+
+class CachedRequestsTests(unittest.TestCase):
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._server = StandinHTTPServer({
+			"/hello":		b"Hello world",
+			"/json":		StandinHTTPServer.Response(status_code = 200, headers = { "Content-Type": "application/json" }, content = b"{\"value\": 123}"),
+			"/echo":		lambda request: StandinHTTPServer.Response(status_code = 200, headers = { }, content = json.dumps({ "query": request.query, "body": None if (request.body is None) else request.body.decode() }).encode()),
+			("POST", "/upload"):	StandinHTTPServer.Response(status_code = 201, headers = { }, content = b"created"),
+		}).start()
+		self._requests = [ ]
+
+	def tearDown(self):
+		for cr in self._requests:
+			cr.close()
+		self._server.stop()
+		self._tmpdir.cleanup()
+
+	def _cached_requests(self, **kwargs):
+		cr = CachedRequests(cache_filename = ":memory:", **kwargs)
+		self._requests.append(cr)
+		return cr
+
+	def _url(self, path):
+		return self._server.url + path
+
+	def test_standin_server(self):
+		cr = self._cached_requests(cache_post = True)
+		self.assertEqual(cr.get(self._url("/hello")).content, b"Hello world")
+		self.assertEqual(cr.get(self._url("/json"), return_json = True), { "value": 123 })
+		self.assertEqual(cr.get(self._url("/echo"), query_params = { "a": "1" }, return_json = True), { "query": [ [ "a", "1" ] ], "body": None })
+		self.assertEqual(cr.post(self._url("/echo"), postdata = b"data", return_json = True)["body"], "data")
+		self.assertEqual(cr.post(self._url("/upload")).status_code, 201)
+		self.assertEqual(cr.get(self._url("/upload")).status_code, 404)
+		self.assertEqual(self._server.request_count, 6)
+
+	def test_record_and_replay(self):
+		archive = os.path.join(self._tmpdir.name, "recording.json.xz")
+		recorder = self._cached_requests(mode = CachedRequestsMode.Record)
+		self.assertEqual(recorder.mode, CachedRequestsMode.Record)
+		self.assertEqual(recorder.get(self._url("/hello")).content, b"Hello world")
+		self.assertEqual(recorder.get(self._url("/json"), return_json = True), { "value": 123 })
+		self.assertEqual(recorder.get(self._url("/missing")).status_code, 404)
+		self.assertEqual(recorder.post(self._url("/upload"), postdata = "payload").status_code, 201)
+		self.assertEqual(recorder.write_archive(archive), 4)
+		request_count = self._server.request_count
+
+		player = self._cached_requests(mode = "replay")
+		self.assertEqual(player.load_archive(archive), 4)
+		response = player.get(self._url("/hello"), max_age_secs = 0)
+		self.assertEqual((response.status_code, response.content, response.cached), (200, b"Hello world", True))
+		self.assertEqual(player.get(self._url("/json"), return_json = True), { "value": 123 })
+		self.assertEqual(player.get(self._url("/missing")).status_code, 404)
+		self.assertEqual(player.post(self._url("/upload"), postdata = b"payload").content, b"created")
+		with self.assertRaises(CacheMissException):
+			player.get(self._url("/hello"), query_params = { "not": "recorded" })
+		with self.assertRaises(CacheMissException):
+			player.post(self._url("/upload"), postdata = "other payload")
+		self.assertEqual(self._server.request_count, request_count)
+
+	def test_archive_only_contains_recorded_entries(self):
+		archive = os.path.join(self._tmpdir.name, "recording.json.xz")
+		cr = self._cached_requests()
+		cr.get(self._url("/hello"))
+		self.assertEqual(cr.write_archive(archive), 0)
+		self.assertEqual(self._cached_requests(mode = CachedRequestsMode.Replay).load_archive(archive), 0)
+
+	def _request_key(self, cr, verb = "GET", url = "http://example.com/", postdata = None, headers = None):
+		request = CachedRequests._GenericRequest(verb = verb, url = url, postdata = postdata, headers = cr._determine_headers(headers), return_json = False, max_age_secs = 0)
+		return cr._hash_request(request)
+
+	def test_key_header_order_and_case(self):
+		cr = self._cached_requests()
+		key = self._request_key(cr, headers = { "Accept": "text/html", "X-Token": "abc" })
+		self.assertEqual(self._request_key(cr, headers = { "x-token": "abc", "ACCEPT": "text/html" }), key)
+		self.assertNotEqual(self._request_key(cr, headers = { "Accept": "text/html", "X-Token": "xyz" }), key)
+		self.assertNotEqual(self._request_key(cr, headers = { "Accept": "text/html" }), key)
+		self.assertNotEqual(self._request_key(cr, verb = "POST", headers = { "Accept": "text/html", "X-Token": "abc" }), key)
+
+	def test_key_headers(self):
+		cr = self._cached_requests(key_headers = [ "Accept" ])
+		key = self._request_key(cr, headers = { "Accept": "text/html", "User-Agent": "foo" })
+		self.assertEqual(self._request_key(cr, headers = { "accept": "text/html", "User-Agent": "bar", "X-Request-Id": "123" }), key)
+		self.assertEqual(self._request_key(cr, headers = { "Accept": "text/html" }), key)
+		self.assertNotEqual(self._request_key(cr, headers = { "Accept": "application/json", "User-Agent": "foo" }), key)
+		self.assertNotEqual(self._request_key(self._cached_requests(), headers = { "Accept": "text/html", "User-Agent": "bar" }), self._request_key(self._cached_requests(), headers = { "Accept": "text/html", "User-Agent": "foo" }))
+
+	def test_key_postdata(self):
+		cr = self._cached_requests()
+		key = self._request_key(cr, verb = "POST", postdata = "grüße")
+		self.assertEqual(self._request_key(cr, verb = "POST", postdata = "grüße".encode("utf-8")), key)
+		self.assertNotEqual(self._request_key(cr, verb = "POST", postdata = b"other"), key)
+		self.assertNotEqual(self._request_key(cr, verb = "POST", postdata = b""), self._request_key(cr, verb = "POST"))
+
+	def test_key_fixed_headers(self):
+		fixed_headers = { "User-Agent": "pycommon", "Accept": "*/*" }
+		cr = self._cached_requests(fixed_headers = fixed_headers)
+		request = CachedRequests._GenericRequest(verb = "GET", url = "http://example.com/", postdata = None, headers = cr._determine_headers(None), return_json = False, max_age_secs = 0)
+		self.assertIs(request.headers, cr._fixed_headers)
+		equal_request = request._replace(headers = dict(fixed_headers))
+		self.assertIsNot(equal_request.headers, cr._fixed_headers)
+		self.assertEqual(cr._hash_request(request), cr._hash_request(equal_request))
+		self.assertNotEqual(self._request_key(cr, headers = { "Accept": "text/html" }), cr._hash_request(request))
+
+	def test_statistics(self):
+		cr = self._cached_requests()
+		self.assertIsNone(cr.statistics.hit_ratio)
+		cr.get(self._url("/hello"))
+		cr.get(self._url("/hello"))
+		cr.get(self._url("/hello"))
+		cr.get(self._url("/json"))
+		time.sleep(0.01)
+		cr.get(self._url("/json"), max_age_secs = 0.005)
+		cr.post(self._url("/upload"))
+		stats = cr.statistics
+		self.assertEqual((stats.hits, stats.misses, stats.stale, stats.refreshed, stats.uncached), (2, 2, 1, 1, 1))
+		self.assertEqual(stats.bytes_from_cache, 2 * len(b"Hello world"))
+		self.assertEqual(stats.bytes_from_network, len(b"Hello world") + 2 * len(b"{\"value\": 123}") + len(b"created"))
+		self.assertAlmostEqual(stats.hit_ratio, 2 / 5)
+		self.assertEqual(self._server.request_count, 4)
+
+		result = stats.to_dict()
+		self.assertEqual(result["latency"]["lookup"]["count"], 5)
+		self.assertEqual(result["latency"]["store"]["count"], 3)
+		self.assertEqual(result["latency"]["fetch"]["count"], 4)
+		self.assertEqual(sum(count for (limit, count) in result["latency"]["fetch"]["bins"]), 4)
+
+		f = io.StringIO()
+		stats.dump(f)
+		output = f.getvalue()
+		self.assertIn("2 hits, 2 misses, 1 stale, 1 refreshed, 1 uncached, hit ratio 40.0%", output)
+		self.assertIn("22 bytes served from cache", output)
+		self.assertIn("fetch", output)
+
+		stats.reset()
+		self.assertEqual((stats.hits, stats.misses, stats.hit_ratio), (0, 0, None))
+
+	def test_periodic_statistics_dump(self):
+		f = io.StringIO()
+		cr = self._cached_requests(stats_dump_interval_secs = 0, stats_dump_file = f)
+		cr.get(self._url("/hello"))
+		cr.get(self._url("/hello"))
+		self.assertEqual(f.getvalue().count("CachedRequests statistics"), 2)
+		self.assertIn("1 hits, 1 misses", f.getvalue())
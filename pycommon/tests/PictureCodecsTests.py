@@ -0,0 +1,150 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import base64
+import random
+import tempfile
+import unittest
+import unittest.mock
+from pycommon import PictureCodecs as PictureCodecsModule
+from pycommon.PictureCodecs import openwriter, openreader, readpicture, writepicture
+from pycommon.PnmPicture import PnmPicture
+
+class PictureCodecsTests(unittest.TestCase):
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._rng = random.Random(42)
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _random_picture(self, width, height, channels = 3, maxval = 255):
+		# Mix in repeating values so that runs and small differences occur
+		samples = [ self._rng.choice([ self._rng.randint(0, maxval), 7, 8, maxval ]) for _ in range(width * height * channels) ]
+		pic = PnmPicture().new(width, height, channels = channels, maxval = maxval)
+		return pic.fromdata(width, height, pic._packsamples(samples), channels = channels, maxval = maxval)
+
+	def _roundtrip(self, extension, channels, maxval, alpha):
+		(width, height) = (17, 13)
+		filename = os.path.join(self._tmpdir.name, "picture" + extension)
+		pic = self._random_picture(width, height, channels, maxval)
+		alphapic = self._random_picture(width, height, 1, maxval) if alpha else None
+		with openwriter(filename, width, height, channels = channels, maxval = maxval, alpha = alpha) as writer:
+			for y in range(0, height, 5):
+				rows = min(5, height - y)
+				writer.write(pic.getsubpicture(0, y, width, rows), alphapic.getsubpicture(0, y, width, rows) if alpha else None)
+
+		with openreader(filename) as reader:
+			result = PnmPicture().new(width, height, channels = reader.channels, maxval = maxval)
+			resultalpha = PnmPicture().new(width, height, channels = 1, maxval = maxval)
+			y = 0
+			for band in reader.bands(4):
+				result.blitsubpicture(0, y, band.picture)
+				if alpha:
+					resultalpha.blitsubpicture(0, y, band.alpha)
+				else:
+					self.assertIsNone(band.alpha)
+				y += band.picture.height
+		if (extension == ".qoi") and (channels == 1):
+			self.assertEqual(result, PnmPicture().fromdata(width, height, PnmPicture._expandgray(pic.data)))
+		else:
+			self.assertEqual(result, pic)
+		if alpha:
+			self.assertEqual(resultalpha, alphapic)
+
+	def _test_roundtrips(self):
+		for (extension, maxvals) in [ (".png", [ 255, 65535 ]), (".pam", [ 255, 1000 ]), (".qoi", [ 255 ]) ]:
+			for maxval in maxvals:
+				for channels in [ 1, 3 ]:
+					for alpha in [ False, True ]:
+						self._roundtrip(extension, channels, maxval, alpha)
+
+	def test_roundtrips(self):
+		self._test_roundtrips()
+
+	def test_roundtrips_without_numpy(self):
+		with unittest.mock.patch.object(PictureCodecsModule, "numpy", None):
+			self._test_roundtrips()
+
+	def test_png_filters(self):
+		pic = self._random_picture(20, 10)
+		filename = os.path.join(self._tmpdir.name, "picture.png")
+		for pngfilter in [ "none", "sub", "up", "average", "paeth", "auto" ]:
+			writepicture(filename, pic, filter = pngfilter)
+			self.assertEqual(readpicture(filename).picture, pic)
+
+	def test_png_piecewise_read(self):
+		pic = self._random_picture(30, 20)
+		filename = os.path.join(self._tmpdir.name, "picture.png")
+		writepicture(filename, pic, filter = "none")
+		with unittest.mock.patch.object(PictureCodecsModule.PngReader, "_READ_SIZE", 16):
+			self.assertEqual(readpicture(filename).picture, pic)
+
+			# A corrupted IDAT chunk is detected by its CRC
+			with open(filename, "rb") as f:
+				data = bytearray(f.read())
+			idat = data.index(b"IDAT")
+			data[idat + 4 + int.from_bytes(data[idat - 4 : idat], byteorder = "big")] ^= 0xff
+			with open(filename, "wb") as f:
+				f.write(data)
+			with self.assertRaisesRegex(Exception, "Corrupt PNG chunk"):
+				readpicture(filename)
+
+	def test_external_png(self):
+		filename = os.path.join(self._tmpdir.name, "pixel.png")
+		with open(filename, "wb") as f:
+			f.write(base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg=="))
+		picture = readpicture(filename)
+		self.assertEqual(picture.picture.getpixel(0, 0), (255, 0, 0))
+		self.assertEqual(picture.alpha.getpixel(0, 0), (255, ))
+
+	def test_external_qoi(self):
+		# Assembled by hand from the QOI specification: an RGB picture using
+		# the RGB, DIFF, RUN, INDEX and LUMA operations, an RGBA picture using
+		# RGBA and RUN and an RGBA picture whose only pixel is found in the
+		# initial (all zero) index
+		files = [
+			("cW9pZgAAAAMAAAACAwD+ChQed8EJtKMAAAAAAAAAAQ==", [ (10, 20, 30), (11, 19, 31), (11, 19, 31), (11, 19, 31), (10, 20, 30), (32, 40, 45) ], None),
+			("cW9pZgAAAAIAAAABBAD/AQIDgMAAAAAAAAAAAQ==", [ (1, 2, 3), (1, 2, 3) ], [ (128, ), (128, ) ]),
+			("cW9pZgAAAAEAAAABBAAAAAAAAAAAAAE=", [ (0, 0, 0) ], [ (0, ) ]),
+		]
+		for (encoded, pixels, alphapixels) in files:
+			filename = os.path.join(self._tmpdir.name, "external.qoi")
+			with open(filename, "wb") as f:
+				f.write(base64.b64decode(encoded))
+			picture = readpicture(filename)
+			self.assertEqual(list(picture.picture), pixels)
+			self.assertEqual(None if (picture.alpha is None) else list(picture.alpha), alphapixels)
+
+			# The encoder makes the same choices as the reference encoder
+			filename = os.path.join(self._tmpdir.name, "encoded.qoi")
+			writepicture(filename, picture.picture, picture.alpha)
+			with open(filename, "rb") as f:
+				self.assertEqual(f.read(), base64.b64decode(encoded))
+
+	def test_pnm_fallback(self):
+		pic = self._random_picture(5, 4)
+		filename = os.path.join(self._tmpdir.name, "picture.pnm")
+		writepicture(filename, pic)
+		self.assertEqual(readpicture(filename).picture, pic)
+		with self.assertRaises(Exception):
+			writepicture(filename, pic, alpha = pic.getchannel(0))
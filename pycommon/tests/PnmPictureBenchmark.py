@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+import collections
+import unittest.mock
+from pycommon import PnmPicture as PnmPictureModule
+from pycommon.PnmPicture import PnmPicture, FilterStencil
+from pycommon.PnmPipeline import PnmPipeline
+
+class PnmPictureBenchmark():
+	"""Times PnmPicture operations on pictures of several sizes and checks
+	that the optimized code paths produce byte-identical output to simple per
+	pixel reference implementations (golden outputs)."""
+	Result = collections.namedtuple("Result", [ "name", "width", "height", "seconds", "megapixels_per_sec", "peak_memory" ])
+	GoldenResult = collections.namedtuple("GoldenResult", [ "name", "identical", "max_deviation" ])
+
+	_BINOMIAL_STENCIL = FilterStencil(3, 3, [
+		1, 2, 1,
+		2, 4, 2,
+		1, 2, 1,
+	])
+
+	def __init__(self, tmpdir, repeats = 3):
+		self._tmpdir = tmpdir
+		self._repeats = repeats
+
+	@staticmethod
+	def testpicture(width, height, channels = 3, maxval = 255, seed = 0):
+		"""Deterministic picture with smooth gradients and some noise."""
+		rng = random.Random(seed)
+		noise = rng.getrandbits(8 * width * height).to_bytes(width * height, "little")
+		samples = [ ]
+		for y in range(height):
+			for x in range(width):
+				n = noise[y * width + x] // 16
+				pixel = ((x * 255) // max(1, width - 1), (y * 255) // max(1, height - 1), ((x + y) * 127) // max(1, width + height - 2))
+				samples += [ min(255, value + n) * maxval // 255 for value in pixel[:channels] ]
+		picture = PnmPicture().new(width, height, channels = channels, maxval = maxval)
+		return picture.fromdata(width, height, picture._packsamples(samples), channels = channels, maxval = maxval)
+
+	def _filename(self, name):
+		return os.path.join(self._tmpdir, name)
+
+	def _benchmarks(self):
+		"""Yields (name, prepare, operation) tuples. prepare(picture) is not
+		timed and returns the argument that operation() is called with."""
+		for (fmt, ascii, channels) in [ ("P3", True, 3), ("P5", False, 1), ("P6", False, 3) ]:
+			filename = self._filename("bench.%s.pnm" % (fmt))
+			def prepare(picture, filename = filename, ascii = ascii, channels = channels):
+				source = picture if (channels == 3) else picture.getchannel(1)
+				source.writefile(filename, ascii = ascii)
+				return filename
+			yield ("read " + fmt, prepare, lambda filename: PnmPicture().readfile(filename, native = True))
+
+			def prepare(picture, channels = channels):
+				return picture.clone() if (channels == 3) else picture.getchannel(1)
+			yield ("write " + fmt, prepare, lambda picture, filename = filename, ascii = ascii: picture.writefile(filename, ascii = ascii))
+
+		yield ("multiply", PnmPicture.clone, lambda picture: picture.multiply((200, 100, 50)))
+		yield ("blend", PnmPicture.clone, lambda picture: picture.blend((0, 0, 255), 0.3))
+		yield ("invert", PnmPicture.clone, lambda picture: picture.invert())
+		pipeline = PnmPipeline().multiply((200, 100, 50)).blend((0, 0, 255), 0.3).invert()
+		yield ("fused pipeline (3 ops)", PnmPicture.clone, pipeline.apply)
+		yield ("rotate 90", PnmPicture.clone, lambda picture: picture.rotate(90))
+		yield ("rotate 180", PnmPicture.clone, lambda picture: picture.rotate(180))
+		yield ("downscale", PnmPicture.clone, lambda picture: picture.downscale())
+		yield ("upscale 2x2", PnmPicture.clone, lambda picture: picture.upscale(2, 2))
+		yield ("stencil 3x3", PnmPicture.clone, lambda picture: picture.applystencil(self._BINOMIAL_STENCIL, None))
+		gaussian = FilterStencil.getgaussian(3)
+		yield ("stencil gaussian 7x7", PnmPicture.clone, lambda picture: picture.applystencil(gaussian, None))
+		yield ("stencil gaussian 7x7 fixed point", PnmPicture.clone, lambda picture: picture.applystencil(gaussian.tofixedpoint(), None))
+
+	def run(self, width, height, only = None):
+		"""Yields a Result for every benchmark (whose name contains 'only')."""
+		picture = self.testpicture(width, height)
+		for (name, prepare, operation) in self._benchmarks():
+			if (only is not None) and (only not in name):
+				continue
+			times = [ ]
+			for i in range(self._repeats):
+				argument = prepare(picture)
+				t0 = time.perf_counter()
+				operation(argument)
+				times.append(time.perf_counter() - t0)
+
+			# Separate run for memory, tracing slows execution down
+			argument = prepare(picture)
+			tracemalloc.start()
+			try:
+				operation(argument)
+				peak_memory = tracemalloc.get_traced_memory()[1]
+			finally:
+				tracemalloc.stop()
+			seconds = min(times)
+			yield self.Result(name = name, width = width, height = height, seconds = seconds, megapixels_per_sec = (width * height / 1e6) / seconds, peak_memory = peak_memory)
+
+	@staticmethod
+	def _reference_pointop(picture, function):
+		result = picture.clone()
+		for y in range(picture.height):
+			for x in range(picture.width):
+				result.setpixel(x, y, function(picture.getpixel(x, y)))
+		return result
+
+	@staticmethod
+	def _reference_rotate(picture, degrees):
+		(width, height) = (picture.height, picture.width) if (degrees in [ 90, 270 ]) else (picture.width, picture.height)
+		result = PnmPicture().new(width, height, channels = picture.channels, maxval = picture.maxval)
+		for y in range(picture.height):
+			for x in range(picture.width):
+				if degrees == 90:
+					result.setpixel(picture.height - 1 - y, x, picture.getpixel(x, y))
+				elif degrees == 180:
+					result.setpixel(picture.width - 1 - x, picture.height - 1 - y, picture.getpixel(x, y))
+				else:
+					result.setpixel(y, picture.width - 1 - x, picture.getpixel(x, y))
+		return result
+
+	@staticmethod
+	def _reference_downscale(picture):
+		result = PnmPicture().new(picture.width // 2, picture.height // 2, channels = picture.channels, maxval = picture.maxval)
+		for y in range(result.height):
+			for x in range(result.width):
+				result.setpixel(x, y, picture.getsubpicture(2 * x, 2 * y, 2, 2).avgcolor())
+		return result
+
+	@staticmethod
+	def _reference_upscale(picture, xmultiplicity, ymultiplicity):
+		result = PnmPicture().new(picture.width * xmultiplicity, picture.height * ymultiplicity, channels = picture.channels, maxval = picture.maxval)
+		for y in range(result.height):
+			for x in range(result.width):
+				result.setpixel(x, y, picture.getpixel(x // xmultiplicity, y // ymultiplicity))
+		return result
+
+	def _goldenpairs(self, picture):
+		"""Yields (name, optimized result, reference result, tolerated
+		deviation) tuples."""
+		maxval = picture.maxval
+		multiplier = (200, 100, 50)[:picture.channels]
+		color = (0, 0, 255)[:picture.channels]
+		multiply = lambda pixel: tuple(round(value * factor / maxval) for (value, factor) in zip(pixel, multiplier))
+		blend = lambda pixel: PnmPicture._blendpixel(pixel, color, 0.3)
+		invert = lambda pixel: tuple(maxval - value for value in pixel)
+
+		yield ("multiply", picture.clone().multiply(multiplier), self._reference_pointop(picture, multiply), 0)
+		yield ("blend", picture.clone().blend(color, 0.3), self._reference_pointop(picture, blend), 0)
+		yield ("invert", picture.clone().invert(), self._reference_pointop(picture, invert), 0)
+		yield ("fused pipeline", PnmPipeline().multiply(multiplier).blend(color, 0.3).invert().apply(picture.clone()), self._reference_pointop(picture, lambda pixel: invert(blend(multiply(pixel)))), 0)
+		for degrees in [ 90, 180, 270 ]:
+			yield ("rotate %d" % (degrees), picture.clone().rotate(degrees), self._reference_rotate(picture, degrees), 0)
+		yield ("downscale", picture.downscale(), self._reference_downscale(picture), 0)
+		yield ("upscale 3x2", picture.upscale(3, 2), self._reference_upscale(picture, 3, 2), 0)
+
+		for (fmt, ascii) in [ ("binary", False), ("ascii", True) ]:
+			filename = self._filename("golden.pnm")
+			picture.writefile(filename, ascii = ascii)
+			yield ("write/read %s" % (fmt), PnmPicture().readfile(filename, native = True), picture, 0)
+
+		for (name, stencil) in [ ("3x3", self._BINOMIAL_STENCIL), ("gaussian 7x7", FilterStencil.getgaussian(3)) ]:
+			reference = picture.clone().applystencil(stencil, None, engine = "reference")
+			yield ("stencil %s direct" % (name), picture.clone().applystencil(stencil, None, engine = "direct"), reference, 0)
+			yield ("stencil %s separable" % (name), picture.clone().applystencil(stencil, None, engine = "separable"), reference, 1)
+			if PnmPictureModule.numpy is not None:
+				yield ("stencil %s fft" % (name), picture.clone().applystencil(stencil, None, engine = "fft"), reference, 1)
+
+	def golden(self, width = 24, height = 16):
+		"""Yields a GoldenResult for every optimized code path, for RGB and 16
+		bit grayscale pictures. 'identical' is True if the deviation from the
+		reference is within the tolerance of the code path (zero for all code
+		paths that promise exact results)."""
+		for picture in [ self.testpicture(width, height), self.testpicture(width, height, channels = 1, maxval = 4095) ]:
+			for (name, result, reference, tolerance) in self._goldenpairs(picture):
+				if (result.width, result.height, result.channels, result.maxval) != (reference.width, reference.height, reference.channels, reference.maxval):
+					max_deviation = None
+				else:
+					max_deviation = max(abs(value1 - value2) for (value1, value2) in zip(result._getsamples(), reference._getsamples()))
+				name = "%s (%d ch, maxval %d)" % (name, picture.channels, picture.maxval)
+				yield self.GoldenResult(name = name, identical = (max_deviation is not None) and (max_deviation <= tolerance), max_deviation = max_deviation)
+
+def main():
+	# Only needed for the command line, the golden checks also run as a test
+	from pycommon.FriendlyArgumentParser import FriendlyArgumentParser
+	from pycommon.TableFormatter import Table, CellFormatter
+
+	parser = FriendlyArgumentParser(description = "Benchmark PnmPicture operations and verify their output.")
+	parser.add_argument("-s", "--size", metavar = "WxH", action = "append", help = "Picture size to benchmark, can be given multiple times. Defaults to 640x480, 1920x1080 and 3840x2160.")
+	parser.add_argument("-r", "--repeats", metavar = "count", type = int, default = 3, help = "Number of timed runs, the best is reported. Defaults to %(default)d.")
+	parser.add_argument("-o", "--only", metavar = "name", help = "Only run benchmarks whose name contains this string.")
+	parser.add_argument("--no-numpy", action = "store_true", help = "Benchmark the pure Python code paths even if NumPy is installed.")
+	parser.add_argument("--golden-only", action = "store_true", help = "Only run the golden output checks.")
+	args = parser.parse_args(sys.argv[1:])
+
+	sizes = [ tuple(int(value) for value in size.split("x")) for size in (args.size or [ "640x480", "1920x1080", "3840x2160" ]) ]
+	with tempfile.TemporaryDirectory() as tmpdir, unittest.mock.patch.object(PnmPictureModule, "numpy", None if args.no_numpy else PnmPictureModule.numpy):
+		benchmark = PnmPictureBenchmark(tmpdir, repeats = args.repeats)
+		failures = 0
+		for result in benchmark.golden():
+			if not result.identical:
+				failures += 1
+				print("GOLDEN MISMATCH: %s deviates by %s" % (result.name, result.max_deviation))
+		print("Golden output checks: %s" % ("all passed" if (failures == 0) else "%d failed" % (failures)))
+		if args.golden_only:
+			return 1 if (failures > 0) else 0
+
+		table = Table()
+		table.format_columns({
+			"size":		CellFormatter.basic_ralign(),
+			"time":		CellFormatter.basic_ralign(),
+			"mps":		CellFormatter.basic_ralign(),
+			"memory":	CellFormatter.basic_ralign(),
+		})
+		table.add_row({ "name": "Benchmark", "size": "Size", "time": "Time", "mps": "MP/s", "memory": "Peak memory" })
+		table.add_separator_row()
+		for (width, height) in sizes:
+			for result in benchmark.run(width, height, only = args.only):
+				table.add_row({
+					"name":		result.name,
+					"size":		"%dx%d" % (result.width, result.height),
+					"time":		"%.1f ms" % (1000 * result.seconds),
+					"mps":		"%.1f" % (result.megapixels_per_sec),
+					"memory":	"%.1f MiB" % (result.peak_memory / 1024 / 1024),
+				})
+		table.print("name", "size", "time", "mps", "memory")
+		return 1 if (failures > 0) else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
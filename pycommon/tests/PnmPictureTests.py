@@ -0,0 +1,492 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import random
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from pycommon import PnmPicture as PnmPictureModule
+from pycommon.PnmPicture import PnmPicture, FilterStencil, PnmTileScheduler, PnmStreamReader, PnmStreamProcessor
+from pycommon.tests.PnmPictureBenchmark import PnmPictureBenchmark
+
+class PnmPictureTests(unittest.TestCase):
+	def setUp(self):
+		self._rnd = random.Random(12345)
+		self._tmpdir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _tmpfile(self, name, content = None):
+		filename = os.path.join(self._tmpdir.name, name)
+		if content is not None:
+			with open(filename, "wb") as f:
+				f.write(content)
+		return filename
+
+	def _random_picture(self, width, height, channels = 3, maxval = 255):
+		pic = PnmPicture().new(width, height, channels = channels, maxval = maxval)
+		for y in range(height):
+			for x in range(width):
+				pic.setpixel(x, y, tuple(self._rnd.randint(0, maxval) for i in range(channels)))
+		return pic
+
+	def _run_without_numpy(self, test):
+		with unittest.mock.patch.object(PnmPictureModule, "numpy", None):
+			test()
+
+	def _test_pointops(self):
+		pic = self._random_picture(13, 7)
+		reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: tuple(round((value * mult) / 255) for (value, mult) in zip(pixel, (10, 128, 255))))
+		self.assertEqual(pic.clone().multiply((10, 128, 255)), reference)
+
+		reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: PnmPicture._blendpixel(pixel, (200, 20, 90), 0.3))
+		self.assertEqual(pic.clone().blend((200, 20, 90), 0.3), reference)
+
+		reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: tuple(255 - value for value in pixel))
+		self.assertEqual(pic.clone().invert(), reference)
+
+	def test_pointops(self):
+		self._test_pointops()
+
+	def test_pointops_without_numpy(self):
+		self._run_without_numpy(self._test_pointops)
+
+	def _test_native_pointops(self):
+		for (channels, maxval) in [ (1, 255), (1, 65535), (3, 65535), (3, 1000) ]:
+			pic = self._random_picture(6, 5, channels = channels, maxval = maxval)
+			multiplier = tuple(maxval // (i + 2) for i in range(channels))
+			reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: tuple(round((value * mult) / maxval) for (value, mult) in zip(pixel, multiplier)))
+			self.assertEqual(pic.clone().multiply(multiplier), reference)
+
+			color = tuple(maxval // (i + 3) for i in range(channels))
+			reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: PnmPicture._blendpixel(pixel, color, 0.7))
+			self.assertEqual(pic.clone().blend(color, 0.7), reference)
+
+			reference = PnmPictureBenchmark._reference_pointop(pic, lambda pixel: tuple(maxval - value for value in pixel))
+			self.assertEqual(pic.clone().invert(), reference)
+
+			for degrees in [ 90, 180, 270 ]:
+				self.assertEqual(pic.clone().rotate(degrees), PnmPictureBenchmark._reference_rotate(pic, degrees))
+
+	def test_native_pointops(self):
+		self._test_native_pointops()
+
+	def test_native_pointops_without_numpy(self):
+		self._run_without_numpy(self._test_native_pointops)
+
+	def _test_rotate(self):
+		pic = self._random_picture(5, 3)
+		for degrees in [ 90, 180, 270 ]:
+			rotated = pic.clone().rotate(degrees)
+			self.assertEqual(rotated, PnmPictureBenchmark._reference_rotate(pic, degrees))
+		self.assertEqual(pic.clone().rotate(360), pic)
+		self.assertEqual(pic.clone().rotate(90).rotate(-90), pic)
+
+		gray = self._random_picture(4, 6, channels = 1, maxval = 1000)
+		with unittest.mock.patch.object(PnmPicture, "_TRANSPOSE_BAND_HEIGHT", 2):
+			for degrees in [ 90, 270 ]:
+				self.assertEqual(gray.clone().rotate(degrees), PnmPictureBenchmark._reference_rotate(gray, degrees))
+		for source in [ pic, gray ]:
+			transposed = source.clone().transpose()
+			hflipped = source.clone().fliphorizontal()
+			vflipped = source.clone().flipvertical()
+			for y in range(source.height):
+				for x in range(source.width):
+					self.assertEqual(transposed.getpixel(y, x), source.getpixel(x, y))
+					self.assertEqual(hflipped.getpixel(source.width - 1 - x, y), source.getpixel(x, y))
+					self.assertEqual(vflipped.getpixel(x, source.height - 1 - y), source.getpixel(x, y))
+			self.assertEqual(source.clone().rotate(270), PnmPictureBenchmark._reference_rotate(source, 270))
+
+			upscaled = source.upscale(3, 2)
+			self.assertEqual((upscaled.width, upscaled.height), (3 * source.width, 2 * source.height))
+			for y in range(upscaled.height):
+				for x in range(upscaled.width):
+					self.assertEqual(upscaled.getpixel(x, y), source.getpixel(x // 3, y // 2))
+			self.assertEqual(source.upscale(2, 2).downscale(), source)
+
+	def test_rotate(self):
+		self._test_rotate()
+
+	def test_rotate_without_numpy(self):
+		self._run_without_numpy(self._test_rotate)
+
+	@unittest.skipIf(PnmPictureModule.numpy is None, "NumPy not available")
+	def test_pixels_view(self):
+		pic = self._random_picture(4, 3)
+		pixels = pic.pixels
+		self.assertEqual(pixels.shape, (3, 4, 3))
+		self.assertEqual(tuple(pixels[2, 1]), pic.getpixel(1, 2))
+		pixels[2, 1] = (1, 2, 3)
+		self.assertEqual(pic.getpixel(1, 2), (1, 2, 3))
+
+	def test_write_read_binary(self):
+		pic = self._random_picture(7, 5)
+		filename = self._tmpfile("rgb.pnm")
+		pic.writefile(filename)
+		self.assertEqual(PnmPicture().readfile(filename), pic)
+
+		pic.writefile(filename, channel = 1)
+		gray = PnmPicture().readfile(filename)
+		self.assertEqual(gray.data[0 :: 3], pic.data[1 :: 3])
+		self.assertEqual(gray.data[1 :: 3], pic.data[1 :: 3])
+		self.assertEqual(gray.data[2 :: 3], pic.data[1 :: 3])
+
+	def _test_read_ascii(self):
+		filename = self._tmpfile("rgb.pnm", b"P3\n# Comment\n2 1\n255\n1\n2\n3\n4\n5\n6\n")
+		self.assertEqual(PnmPicture().readfile(filename).data, bytes([ 1, 2, 3, 4, 5, 6 ]))
+		filename = self._tmpfile("gray.pnm", b"P2\n2 1\n255\n7\n9\n")
+		self.assertEqual(PnmPicture().readfile(filename).data, bytes([ 7, 7, 7, 9, 9, 9 ]))
+
+		filename = self._tmpfile("rgb.pnm", b"P3 2 # width\n# height follows\n2\t255\r\n  1 2 3   4 5 6 # first row\n7 8 9\n10 11 12")
+		self.assertEqual(PnmPicture().readfile(filename).data, bytes(range(1, 13)))
+		filename = self._tmpfile("deep.pnm", b"P2 3 1 65535 65535 0 258\n")
+		self.assertEqual(PnmPicture().readfile(filename, native = True).data, bytes([ 0xff, 0xff, 0, 0, 1, 2 ]))
+
+		pic = self._random_picture(7, 5, maxval = 1000)
+		pic.writefile(self._tmpfile("ascii.pnm"), ascii = True)
+		self.assertEqual(PnmPicture().readfile(self._tmpfile("ascii.pnm"), native = True), pic)
+
+		for invalid in [ b"P2 2 1 255 1", b"P2 2 1 255 1 256", b"P2 2 1 255 1 x", b"P2 2 1 255 1 -1", b"P2 2 1 255 1 2 junk", b"P2 2 1 255 1 2.5" ]:
+			with self.assertRaises(Exception):
+				PnmPicture().readfile(self._tmpfile("invalid.pnm", invalid), native = True)
+
+	def test_read_ascii(self):
+		self._test_read_ascii()
+
+	def test_read_ascii_without_numpy(self):
+		self._run_without_numpy(self._test_read_ascii)
+
+	def test_read_unmappable(self):
+		with self.assertRaisesRegex(Exception, "Truncated"):
+			PnmPicture().readfile(self._tmpfile("empty.pnm", b""))
+
+		if not hasattr(os, "mkfifo"):
+			self.skipTest("Named pipes not supported")
+		pic = self._random_picture(5, 3)
+		for ascii in [ False, True ]:
+			source = self._tmpfile("source.pnm")
+			pic.writefile(source, ascii = ascii)
+			fifo = self._tmpfile("picture%d.fifo" % (ascii))
+			os.mkfifo(fifo)
+			def writer():
+				with open(source, "rb") as infile, open(fifo, "wb") as outfile:
+					outfile.write(infile.read())
+			thread = threading.Thread(target = writer)
+			thread.start()
+			try:
+				self.assertEqual(PnmPicture().readfile(fifo), pic)
+			finally:
+				thread.join()
+
+	def test_parse_header(self):
+		(metadata, offset) = PnmPicture._parseheader(b"P6\n#c1\n#c2\n 640   480\n#c3\n255\n\x0a\x0b")
+		self.assertEqual(metadata, { "format": "P6", "geometry": "640 480", "bpp": 255 })
+		self.assertEqual(offset, 30)
+		for truncated in [ b"P6\n640 480\n25", b"P6\n640 480\n255", b"P6 640 # comment" ]:
+			with self.assertRaises(Exception):
+				PnmPicture._parseheader(truncated)
+
+	def test_buffer(self):
+		pic = self._random_picture(2, 2)
+		pic.buffer[0] = 123
+		self.assertEqual(pic.getpixel(0, 0)[0], 123)
+
+	def test_native_gray(self):
+		filename = self._tmpfile("gray.pnm", b"P5\n3 1\n255\n\x01\x02\x03")
+		pic = PnmPicture().readfile(filename, native = True)
+		self.assertEqual((pic.channels, pic.maxval, pic.pixelsize), (1, 255, 1))
+		self.assertEqual(pic.getpixel(2, 0), (3, ))
+		self.assertEqual(list(pic), [ (1, ), (2, ), (3, ) ])
+		self.assertEqual(pic.avgcolor(), (2, ))
+
+		pic.writefile(self._tmpfile("copy.pnm"))
+		with open(self._tmpfile("copy.pnm"), "rb") as f:
+			self.assertTrue(f.read().startswith(b"P5\n"))
+		self.assertEqual(PnmPicture().readfile(self._tmpfile("copy.pnm"), native = True), pic)
+
+	def test_16bit(self):
+		filename = self._tmpfile("deep.pnm", b"P6\n2 1\n65535\n\x01\x02\x03\x04\x05\x06\xff\xff\x00\x00\x12\x34")
+		pic = PnmPicture().readfile(filename, native = True)
+		self.assertEqual((pic.channels, pic.maxval, pic.pixelsize), (3, 65535, 6))
+		self.assertEqual(pic.getpixel(0, 0), (0x0102, 0x0304, 0x0506))
+		self.assertEqual(pic.getpixel(1, 0), (0xffff, 0, 0x1234))
+
+		pic.writefile(self._tmpfile("copy.pnm"))
+		self.assertEqual(PnmPicture().readfile(self._tmpfile("copy.pnm"), native = True), pic)
+
+		pic.writefile(self._tmpfile("channel.pnm"), channel = 2)
+		channel = PnmPicture().readfile(self._tmpfile("channel.pnm"), native = True)
+		self.assertEqual(list(channel), [ (0x0506, ), (0x1234, ) ])
+
+		filename = self._tmpfile("deep.pnm", b"P2\n2 1\n4095\n4000\n17\n")
+		pic = PnmPicture().readfile(filename, native = True)
+		self.assertEqual(list(pic), [ (4000, ), (17, ) ])
+
+	def test_16bit_not_native(self):
+		filename = self._tmpfile("deep.pnm", b"P5\n1 1\n65535\n\x01\x02")
+		with self.assertRaises(AssertionError):
+			PnmPicture().readfile(filename)
+
+	def _assert_max_deviation(self, pic1, pic2, max_deviation):
+		self.assertEqual((pic1.width, pic1.height, pic1.channels), (pic2.width, pic2.height, pic2.channels))
+		deviation = max(abs(value1 - value2) for (pixel1, pixel2) in zip(pic1, pic2) for (value1, value2) in zip(pixel1, pixel2))
+		self.assertLessEqual(deviation, max_deviation)
+
+	def _test_stencil_engines(self):
+		pic = self._random_picture(11, 9)
+		gray = self._random_picture(11, 9, channels = 1, maxval = 4095)
+		stencils = [
+			FilterStencil(3, 3, [ 2, 0, 2, 0, 0, 0, 2, 0, 2 ]),
+			FilterStencil(3, 3, [ 1, 2, 1, 2, 4, 2, 1, 2, 1 ]),
+			FilterStencil(3, 5, [ 0, -1, 0, -1, 5, -1, 0, -1, 0, 1, 1, 1, 0, 2, 0 ]),
+			FilterStencil.getgaussian(2),
+		]
+		for stencil in stencils:
+			for source in [ pic, gray ]:
+				reference = source.clone().applystencil(stencil, None, engine = "reference")
+				self.assertEqual(source.clone().applystencil(stencil, None, engine = "direct"), reference)
+				if stencil.separate() is not None:
+					self._assert_max_deviation(source.clone().applystencil(stencil, None, engine = "separable"), reference, 1)
+				self.assertEqual(source.clone().applystencil(stencil, None), reference)
+
+		self.assertIsNotNone(FilterStencil.getgaussian(3).separate())
+		self.assertIsNone(stencils[2].separate())
+		self.assertEqual(pic._selectengine(stencils[1], "auto"), "separable")
+		self.assertEqual(pic._selectengine(FilterStencil.getgaussian(9), "auto"), "direct")
+		self.assertEqual(pic._selectengine(FilterStencil.getgaussian(9).tofixedpoint(), "auto"), "separable")
+		self.assertEqual(pic._selectengine(FilterStencil.getgaussian(40).tofixedpoint(), "auto"), "separable")
+
+		for stencil in [ FilterStencil.getgaussian(2).tofixedpoint(), FilterStencil.getgaussian(1, 0.8).tofixedpoint(8), stencils[2].tofixedpoint(10) ]:
+			for source in [ pic, gray ]:
+				reference = source.clone().applystencil(stencil, None, engine = "reference")
+				self.assertEqual(source.clone().applystencil(stencil, None, engine = "direct"), reference)
+				if stencil.separate() is not None:
+					self.assertEqual(source.clone().applystencil(stencil, None, engine = "separable"), reference)
+				self.assertEqual(source.clone().applystencil(stencil, None), reference)
+
+	def test_stencil_cache_and_fixedpoint(self):
+		gaussian = FilterStencil.getgaussian(3)
+		self.assertIs(FilterStencil.getgaussian(3), gaussian)
+		self.assertIsNot(FilterStencil.getgaussian(3, 1.5), gaussian)
+		self.assertIs(gaussian.tofixedpoint(), gaussian.tofixedpoint())
+		self.assertIsNone(gaussian.fixedpointshift)
+
+		fixed = gaussian.tofixedpoint(12)
+		self.assertEqual(fixed.weightsum, 4096)
+		self.assertEqual(fixed.fixedpointshift, 12)
+		self.assertTrue(all(isinstance(coeff, int) for coeff in fixed.coeffs))
+		(hcoeffs, vcoeffs) = fixed.separate()
+		self.assertEqual((sum(hcoeffs), sum(vcoeffs)), (64, 64))
+		self.assertEqual(fixed.coeffs, [ hcoeffs[x] * vcoeffs[y] for y in range(7) for x in range(7) ])
+
+		sharpen = FilterStencil(3, 3, [ 0, -1, 0, -1, 5, -1, 0, -1, 0 ]).tofixedpoint(8)
+		self.assertEqual(sharpen.weightsum, 256)
+		self.assertEqual(FilterStencil(3, 3, [ 1, 2, 1, 2, 4, 2, 1, 2, 1 ]).fixedpointshift, 4)
+
+		self.assertEqual(PnmPicture._shiftround(5, 1), 2)
+		self.assertEqual(PnmPicture._shiftround(7, 1), 4)
+		self.assertEqual([ PnmPicture._shiftround(value, 3) for value in range(64) ], [ round(value / 8) for value in range(64) ])
+
+	def test_stencil_engines(self):
+		self._test_stencil_engines()
+		pic = self._random_picture(20, 17)
+		stencil = FilterStencil.getgaussian(4)
+		reference = pic.clone().applystencil(stencil, None, engine = "reference")
+		if PnmPictureModule.numpy is not None:
+			self._assert_max_deviation(pic.clone().applystencil(stencil, None, engine = "fft"), reference, 1)
+
+	def test_stencil_engines_without_numpy(self):
+		self._run_without_numpy(self._test_stencil_engines)
+
+	def _test_tile_scheduler(self, scheduler):
+		pic = self._random_picture(13, 37)
+		stencil = FilterStencil.getgaussian(2)
+		self.assertEqual(scheduler.applystencil(pic.clone(), stencil, engine = "direct"), pic.clone().applystencil(stencil, None, engine = "direct"))
+		self.assertEqual(scheduler.blend(pic.clone(), (10, 20, 30), 0.25), pic.clone().blend((10, 20, 30), 0.25))
+		self.assertEqual(scheduler.invert(pic.clone()), pic.clone().invert())
+
+	def test_tile_scheduler_threads(self):
+		self._test_tile_scheduler(PnmTileScheduler(workers = 3, min_band_height = 4))
+
+	@unittest.skipIf(sys.version_info < (3, 8), "shared memory requires Python 3.8")
+	def test_tile_scheduler_processes(self):
+		self._test_tile_scheduler(PnmTileScheduler(workers = 2, processes = True, min_band_height = 4))
+
+	def test_stream_processor(self):
+		pic = self._random_picture(9, 23)
+		(infile, outfile) = (self._tmpfile("in.pnm"), self._tmpfile("out.pnm"))
+		pic.writefile(infile)
+
+		stencil = FilterStencil.getgaussian(2)
+		PnmStreamProcessor(infile, outfile, band_height = 4).applystencil(stencil, engine = "direct")
+		self.assertEqual(PnmPicture().readfile(outfile), pic.clone().applystencil(stencil, None, engine = "direct"))
+
+		PnmStreamProcessor(infile, outfile, band_height = 5).multiply((100, 200, 50))
+		self.assertEqual(PnmPicture().readfile(outfile), pic.clone().multiply((100, 200, 50)))
+
+		PnmStreamProcessor(infile, outfile, band_height = 5).getchannel(1)
+		self.assertEqual(PnmPicture().readfile(outfile, native = True), pic.getchannel(1))
+
+		with PnmStreamReader(infile) as reader:
+			self.assertEqual([ band.height for band in reader.bands(10) ], [ 10, 10, 3 ])
+
+	def test_stream_processor_error(self):
+		(infile, outfile) = (self._tmpfile("in.pnm"), self._tmpfile("out.pnm"))
+		self._random_picture(9, 23).writefile(infile)
+
+		bands = [ ]
+		def failing(band):
+			bands.append(band)
+			if len(bands) == 2:
+				raise ValueError("failing band")
+			return band
+		with self.assertRaisesRegex(ValueError, "failing band"):
+			PnmStreamProcessor(infile, outfile, band_height = 5).map(failing)
+		self.assertFalse(os.path.exists(outfile))
+
+	def test_resize(self):
+		pic = self._random_picture(10, 8)
+		gray = self._random_picture(7, 5, channels = 1, maxval = 1000)
+
+		downscaled = pic.downscale()
+		for (x, y) in [ (0, 0), (3, 2), (4, 3) ]:
+			self.assertEqual(downscaled.getpixel(x, y), pic.getsubpicture(2 * x, 2 * y, 2, 2).avgcolor())
+		self.assertEqual(pic.resize(1, 1).getpixel(0, 0), pic.avgcolor())
+
+		for method in [ "box", "bilinear", "lanczos" ]:
+			for source in [ pic, gray ]:
+				self.assertEqual(source.resize(source.width, source.height, method = method), source)
+				for (width, height) in [ (3, 2), (13, 11) ]:
+					resized = source.resize(width, height, method = method)
+					self.assertEqual((resized.width, resized.height, resized.maxval), (width, height, source.maxval))
+					results = [ ]
+					self._run_without_numpy(lambda: results.append(source.resize(width, height, method = method)))
+					self._assert_max_deviation(resized, results[0], 1)
+
+		thumbnail = pic.thumbnail(5, 5)
+		self.assertEqual((thumbnail.width, thumbnail.height), (5, 4))
+
+	def _test_statistics(self):
+		for pic in [ self._random_picture(7, 5), self._random_picture(6, 4, channels = 1, maxval = 1000) ]:
+			pixels = list(pic)
+			for (channel, statistics) in enumerate(pic.statistics()):
+				values = [ pixel[channel] for pixel in pixels ]
+				histogram = pic.histogram(channel)
+				self.assertEqual(len(histogram), pic.maxval + 1)
+				self.assertEqual(histogram[values[0]], values.count(values[0]))
+				self.assertEqual(sum(histogram), pic.pixelcnt)
+				mean = sum(values) / len(values)
+				self.assertAlmostEqual(statistics.mean, mean)
+				self.assertAlmostEqual(statistics.variance, sum((value - mean) ** 2 for value in values) / len(values))
+				self.assertEqual((statistics.minimum, statistics.maximum), (min(values), max(values)))
+		for (width, height) in [ (0, 0), (0, 4), (3, 0) ]:
+			self.assertIsNone(PnmPicture().new(width, height).statistics())
+
+	def test_statistics(self):
+		self._test_statistics()
+
+	def test_statistics_without_numpy(self):
+		self._run_without_numpy(self._test_statistics)
+
+	def test_perceptual_hashes(self):
+		pic = PnmPicture().new(32, 32)
+		for x in range(16):
+			for y in range(32):
+				pic.setpixel(x, y, (200, 200, 200))
+		self.assertEqual(pic.ahash(), sum(1 << (8 * y + x) for y in range(8) for x in range(4)))
+		self.assertEqual(pic.dhash(), 0)
+		brighter = pic.clone().lighten(0.1)
+		self.assertEqual(PnmPicture.hashdistance(pic.ahash(), brighter.ahash()), 0)
+		self.assertEqual(PnmPicture.hashdistance(pic.ahash(), pic.clone().rotate(180).ahash()), 64)
+
+	def test_digest_and_equality(self):
+		pic = self._random_picture(6, 5)
+		clone = pic.clone()
+		self.assertEqual(pic.digest(), clone.digest())
+		self.assertEqual(hash(pic), hash(clone))
+		self.assertEqual(pic, clone)
+
+		clone.setpixel(0, 0, tuple(255 - value for value in clone.getpixel(0, 0)))
+		self.assertNotEqual(pic.digest(), clone.digest())
+		self.assertNotEqual(pic, clone)
+		clone.invert()
+		self.assertNotEqual(pic.digest(), clone.digest())
+
+		# Changes through the buffer are not tracked, the digest must not be
+		# served from cache afterwards
+		digest = clone.digest()
+		clone.buffer[0] ^= 0xff
+		self.assertNotEqual(clone.digest(), digest)
+		self.assertNotEqual(pic, 123)
+
+	def _reference_composite(self, pic, subpic, offsetx, offsety, alpha, opacity):
+		result = pic.clone()
+		for y in range(subpic.height):
+			for x in range(subpic.width):
+				if (0 <= x + offsetx < pic.width) and (0 <= y + offsety < pic.height):
+					factor = (alpha.getpixel(x, y)[0] / alpha.maxval) * opacity
+					result.setpixel(x + offsetx, y + offsety, PnmPicture._blendpixel(pic.getpixel(x + offsetx, y + offsety), subpic.getpixel(x, y), factor))
+		return result
+
+	def _test_composite(self):
+		for (channels, maxval) in [ (3, 255), (1, 1000) ]:
+			pic = self._random_picture(9, 7, channels = channels, maxval = maxval)
+			subpic = self._random_picture(4, 5, channels = channels, maxval = maxval)
+			alpha = self._random_picture(4, 5, channels = 1)
+			for (offsetx, offsety) in [ (0, 0), (2, 1), (-2, -3), (7, 4), (9, 0), (-4, 2) ]:
+				for opacity in [ 1, 0.5 ]:
+					result = pic.clone().composite(subpic, offsetx, offsety, alpha = alpha, opacity = opacity)
+					self.assertEqual(result, self._reference_composite(pic, subpic, offsetx, offsety, alpha, opacity))
+
+				blitted = pic.clone()
+				blitted.blitsubpicture(offsetx, offsety, subpic)
+				self.assertEqual(pic.clone().composite(subpic, offsetx, offsety), blitted)
+
+			color = (100, 50, 200)[:channels]
+			uniform = PnmPicture().new(pic.width, pic.height, channels = channels, maxval = maxval)
+			uniform.setto(color)
+			self.assertEqual(pic.clone().composite(uniform, 0, 0, opacity = 0.3), pic.clone().blend(color, 0.3))
+			premultiplied = uniform.clone().multiply((round(0.6 * maxval), ) * channels)
+			coverage = PnmPicture().new(pic.width, pic.height, channels = 1, maxval = maxval)
+			coverage.setto((round(0.6 * maxval), ))
+			self._assert_max_deviation(pic.clone().composite(premultiplied, 0, 0, alpha = coverage, opacity = 0.5, premultiplied = True), pic.clone().blend(color, 0.3), 1)
+			self._assert_max_deviation(pic.clone().composite(uniform, 0, 0, opacity = 0.3, premultiplied = True), pic.clone().blend(color, 0.3), 1)
+
+		(black, white) = (PnmPicture().new(2, 2, channels = 1), PnmPicture().new(2, 2, channels = 1))
+		white.setto((255, ))
+		self.assertEqual(black.composite(white, 0, 0, opacity = 0.5, premultiplied = True).getpixel(1, 1), (128, ))
+
+	def test_composite(self):
+		self._test_composite()
+
+	def test_composite_without_numpy(self):
+		self._run_without_numpy(self._test_composite)
+
+	def test_golden_outputs(self):
+		for result in PnmPictureBenchmark(self._tmpdir.name).golden(width = 12, height = 8):
+			self.assertTrue(result.identical, result)
+
+	def test_golden_outputs_without_numpy(self):
+		self._run_without_numpy(self.test_golden_outputs)
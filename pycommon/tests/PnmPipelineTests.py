@@ -0,0 +1,70 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import random
+import tempfile
+import unittest
+from pycommon.PnmPicture import PnmPicture, FilterStencil, PnmTileScheduler
+from pycommon.PnmPipeline import PnmPipeline
+from pycommon.PictureCodecs import readpicture, writepicture
+
+class PnmPipelineTests(unittest.TestCase):
+	@staticmethod
+	def _random_picture(width, height, channels = 3, maxval = 255):
+		rng = random.Random(width * height)
+		pic = PnmPicture().new(width, height, channels = channels, maxval = maxval)
+		return pic.fromdata(width, height, pic._packsamples(rng.randint(0, maxval) for _ in range(width * height * channels)), channels = channels, maxval = maxval)
+
+	def test_fusion(self):
+		pipeline = PnmPipeline().multiply((200, 100, 50)).blend((0, 0, 255), 0.3).lighten(0.2).invert().rotate(90).darken(0.1)
+		self.assertEqual(len(list(pipeline._segments())), 3)
+		for pic in [ self._random_picture(9, 7), self._random_picture(6, 5, maxval = 1000) ]:
+			expected = pic.clone().multiply((200, 100, 50)).blend((0, 0, 255), 0.3).lighten(0.2).invert().rotate(90).darken(0.1)
+			self.assertEqual(pipeline.apply(pic.clone()), expected)
+			self.assertEqual(pipeline.apply(pic.clone(), scheduler = PnmTileScheduler(workers = 2, min_band_height = 2)), expected)
+
+	def test_non_inplace_operations(self):
+		pic = self._random_picture(8, 6)
+		stencil = FilterStencil.getgaussian(1)
+		result = PnmPipeline().resize(4, 3).applystencil(stencil).invert().apply(pic.clone())
+		self.assertEqual(result, pic.resize(4, 3).applystencil(stencil, None).invert())
+		with self.assertRaises(Exception):
+			PnmPipeline().then("nosuchoperation")
+
+	def test_processdirectory(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			(indir, outdir) = (os.path.join(tmpdir, "in"), os.path.join(tmpdir, "out"))
+			os.makedirs(indir)
+			pictures = { }
+			for i in range(3):
+				pictures["pic%d" % (i)] = self._random_picture(5 + i, 4)
+				pictures["pic%d" % (i)].writefile(os.path.join(indir, "pic%d.pnm" % (i)))
+			alpha = self._random_picture(3, 4, channels = 1)
+			writepicture(os.path.join(indir, "alpha.pam"), self._random_picture(3, 4), alpha)
+
+			pipeline = PnmPipeline().invert().rotate(90)
+			outfiles = pipeline.processdirectory(indir, outdir, extension = ".png", workers = 2, processes = False)
+			self.assertEqual([ os.path.basename(filename) for filename in outfiles ], [ "alpha.png", "pic0.png", "pic1.png", "pic2.png" ])
+			for (name, pic) in pictures.items():
+				self.assertEqual(readpicture(os.path.join(outdir, name + ".png")).picture, pic.clone().invert().rotate(90))
+			self.assertEqual(readpicture(os.path.join(outdir, "alpha.png")).alpha, alpha.clone().rotate(90))
+			self.assertEqual(pipeline.processdirectory(indir, outdir, pattern = "pic0.*", workers = 1), [ os.path.join(outdir, "pic0.pnm") ])
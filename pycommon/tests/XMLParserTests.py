@@ -0,0 +1,167 @@
+#	pycommon - Collection of various useful Python utilities.
+#	Copyright (C) 2011-2020 Johannes Bauer
+#
+#	This file is part of pycommon.
+#
+#	pycommon is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pycommon is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pycommon; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import io
+import os
+import asyncio
+import tempfile
+import unittest
+from pycommon.XMLParser import XMLParser, XMLNode
+
+class XMLParserTests(unittest.TestCase):
+	@staticmethod
+	def _document(count):
+		records = "".join("\t\t<record id=\"%d\" parity=\"%s\"><name>Record %d</name><value>%d</value></record>\n" % (i, "even" if ((i % 2) == 0) else "odd", i, i * i) for i in range(count))
+		return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<export>\n\t<records>\n%s\t</records>\n\t<summary><record id=\"total\" /></summary>\n</export>\n" % (records)).encode("utf-8")
+
+	def test_parse(self):
+		tree = XMLParser().parse(self._document(3))
+		self.assertEqual(tree.getname(), "export")
+		self.assertEqual(tree.records.record[2]["id"], "2")
+		self.assertEqual(tree.records.record[1].value.getcdata(), "1")
+		self.assertEqual(len(list(tree.search("record"))), 4)
+
+	def test_iterparse(self):
+		records = [ ]
+		for record in XMLParser().iterparse(io.BytesIO(self._document(100)), "record", chunksize = 37):
+			records.append((record["id"], record.getcdata(), record.getparent().getname()))
+		self.assertEqual(len(records), 101)
+		self.assertEqual(records[5], ("5", "Record 525", "records"))
+		self.assertEqual(records[-1], ("total", "", "summary"))
+
+	def test_iterparse_path(self):
+		parser = XMLParser()
+		ids = [ record["id"] for record in parser.iterparse(io.BytesIO(self._document(10)), "records/record", parity = "odd") ]
+		self.assertEqual(ids, [ "1", "3", "5", "7", "9" ])
+		self.assertEqual([ record["id"] for record in XMLParser().iterparse(io.BytesIO(self._document(10)), "/export/summary/record") ], [ "total" ])
+		self.assertEqual(list(XMLParser().iterparse(io.BytesIO(self._document(10)), "/records/record")), [ ])
+		self.assertEqual([ value.getcdata() for value in XMLParser().iterparse(io.BytesIO(self._document(4)), "value") ], [ "0", "1", "4", "9" ])
+
+	def test_iterparse_clear(self):
+		parser = XMLParser()
+		maxchildren = 0
+		for record in parser.iterparse(io.BytesIO(self._document(1000)), "record", chunksize = 256):
+			maxchildren = max(maxchildren, len(list(record.getparent().getallchildren())))
+		self.assertLess(maxchildren, 10)
+		# The last match (in <summary>) also removed the preceding <records>
+		self.assertIsNone(parser.getrootnode().getchild("records"))
+
+		parser = XMLParser()
+		for record in parser.iterparse(io.BytesIO(self._document(1000)), "record", clear = False):
+			pass
+		self.assertEqual(len(list(parser.getrootnode().records.getchildren("record"))), 1000)
+
+	def test_iterparse_clear_nested(self):
+		groups = "".join("<group id=\"%d\"><meta>%d</meta><record id=\"%d\" /></group>\n" % (i, i, i) for i in range(2000))
+		document = ("<root><header />%s<footer /></root>" % (groups)).encode("ascii")
+		parser = XMLParser()
+		(count, maxnodes) = (0, 0)
+		for record in parser.iterparse(io.BytesIO(document), "record", chunksize = 512):
+			self.assertEqual(record.getparent()["id"], record["id"])
+			root = parser.getrootnode()
+			maxnodes = max(maxnodes, len(list(root.search(None))))
+			count += 1
+		self.assertEqual(count, 2000)
+		self.assertLess(maxnodes, 100)
+		# Only what follows the last match remains
+		self.assertEqual([ child.getname() for child in parser.getrootnode().getallchildren() ], [ "group", "#cdata", "footer" ])
+		self.assertEqual(parser.getrootnode().group["id"], "1999")
+
+	def test_iterparsefile(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, "export.xml")
+			with open(filename, "wb") as f:
+				f.write(self._document(20))
+			self.assertEqual(len(list(XMLParser().iterparsefile(filename, "record", id = "total"))), 1)
+
+	def test_feed(self):
+		document = self._document(5).replace(b"Record 3", "Récord 3".encode("utf-8"))
+		parser = XMLParser()
+		for i in range(len(document)):
+			self.assertEqual(parser.feed(document[i : i + 1]), [ ])
+		tree = parser.close()
+		self.assertEqual(tree.records.record[3].name.getcdata(), "Récord 3")
+		self.assertEqual(tree.summary.record["id"], "total")
+
+	def test_feed_matches(self):
+		parser = XMLParser()
+		parser.setmatch("record", parity = "even")
+		document = self._document(50)
+		ids = [ ]
+		for offset in range(0, len(document), 100):
+			ids += [ node["id"] for node in parser.feed(document[offset : offset + 100]) ]
+		tree = parser.close()
+		self.assertEqual(ids, [ str(i) for i in range(0, 50, 2) ])
+		self.assertLess(len(list(tree.records.getchildren("record"))), 5)
+
+	def test_reuse(self):
+		parser = XMLParser()
+		first = parser.parse(self._document(2))
+		second = parser.parse(self._document(3))
+		self.assertIsNot(first, second)
+		self.assertEqual(len(list(second.records.getchildren("record"))), 3)
+
+		parser.feed(b"<foo><bar>")
+		with self.assertRaises(Exception):
+			parser.close()
+		parser.feed(b"<foo><bar /></foo>")
+		self.assertEqual(parser.close().bar.getname(), "bar")
+		self.assertEqual(parser.parse("<x>text</x>").getcdata(), "text")
+		self.assertEqual(len(list(parser.iterparse(io.BytesIO(self._document(7)), "record"))), 8)
+
+	def test_iterparse_match_scope(self):
+		parser = XMLParser()
+		self.assertEqual(len(list(parser.iterparse(io.BytesIO(b"<r><a /><a /></r>"), "a"))), 2)
+		self.assertEqual(parser.feed(b"<r><a /><a /></r>"), [ ])
+		self.assertEqual(len(list(parser.close().getchildren("a"))), 2)
+
+		parser.setmatch("a", clear = False)
+		self.assertEqual(len(list(parser.iterparse(io.BytesIO(b"<r><b /><a /></r>"), "b"))), 1)
+		self.assertEqual(len(parser.feed(b"<r><a /><a /></r>")), 2)
+		self.assertEqual(len(list(parser.close().getchildren("a"))), 2)
+
+	def test_async(self):
+		async def parse(parser, document, nodename = None):
+			reader = asyncio.StreamReader()
+			reader.feed_data(document)
+			reader.feed_eof()
+			if nodename is None:
+				return await parser.parseasync(reader, chunksize = 16)
+			return [ node["id"] async for node in parser.iterparseasync(reader, nodename, chunksize = 16) ]
+
+		parser = XMLParser()
+		loop = asyncio.new_event_loop()
+		try:
+			tree = loop.run_until_complete(parse(parser, self._document(4)))
+			self.assertEqual(tree.records.record[3].value.getcdata(), "9")
+			self.assertEqual(loop.run_until_complete(parse(parser, self._document(4), "/export/records/record")), [ "0", "1", "2", "3" ])
+			tree = loop.run_until_complete(parse(parser, self._document(4)))
+			self.assertEqual(len(list(tree.records.getchildren("record"))), 4)
+		finally:
+			loop.close()
+
+	def test_clear(self):
+		node = XMLNode("foo", { "bar": "1" })
+		node.addchild("child")
+		node.appendcdata("text")
+		node.clear()
+		self.assertEqual(node.getattrs(), { })
+		self.assertEqual(list(node.getallchildren()), [ ])
@@ -22,3 +22,9 @@
 from .AdvancedColorPaletteTests import AdvancedColorPaletteTests
 from .Vector2dTests import Vector2dTests
 from .PasswordGenTests import PasswordGenTests
+from .CacheDecoratorTests import CacheDecoratorTests
+from .PnmPictureTests import PnmPictureTests
+from .PictureCodecsTests import PictureCodecsTests
+from .PnmPipelineTests import PnmPipelineTests
+from .XMLParserTests import XMLParserTests
+from .CachedRequestsTests import CachedRequestsTests